@@ -0,0 +1,241 @@
+"""
+Activation checkpointing chọn lọc cho GPT-2: chỉ recompute mỗi block thứ k.
+
+`model.activation_checkpointing: k` trong config (0 = tắt, 1 = mọi block,
+2 = block 0, 2, 4, ...). Block được checkpoint không giữ activation trung gian
+khi forward, chỉ giữ input (`[B, L, n_embd]`) và chạy lại forward của nó trong
+backward (`torch.utils.checkpoint`, non-reentrant, RNG dropout được giữ nên
+loss giống hệt khi không checkpoint). Key state_dict không đổi, eval / no_grad
+chạy forward bình thường.
+
+Ước lượng đánh đổi memory ↔ compute (`estimate_checkpointing`):
+- Activation mỗi block đo thật: forward ở train mode, cộng dung lượng các
+  tensor autograd giữ lại cho backward (`saved_tensors_hooks`, bỏ parameter,
+  mỗi storage tính một lần) theo block đang chạy; phần ngoài block
+  (embedding, logits, loss) tính riêng. Đo ở micro-batch 1 và 2 để tách phần
+  tỉ lệ với batch và phần cố định (bản cast bf16 của weights khi autocast).
+- Checkpoint mỗi k block: block thường giữ nguyên activation, block checkpoint
+  chỉ giữ input, cộng activation của một block khi recompute trong backward.
+- Recompute: mỗi block checkpoint chạy thêm một forward ≈ (24·d² + 4·d·L)
+  FLOPs/token so với `gpt2_flops_per_token` của cả step; biết tokens/s thì đổi
+  ra giây mỗi step.
+
+    python -m training.trainer.activation_checkpointing \\
+        --config training/configs/training_config.json --micro-batch 4 --tokens-per-s 9000
+"""
+
+from __future__ import annotations
+
+import argparse
+from typing import Any, Dict, List, Optional
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+from .train_metrics import gpt2_flops_per_token
+
+
+def checkpointed_blocks(num_layers: int, every: int) -> List[int]:
+    """Chỉ số block được checkpoint khi bật mỗi `every` block (0 = không block nào)."""
+    if every <= 0:
+        return []
+    return list(range(0, num_layers, every))
+
+
+def checkpoint_label(every: int) -> str:
+    if not every:
+        return "off"
+    return "mọi block" if every == 1 else f"mỗi {every} block"
+
+
+def checkpoint_blocks(model, every: int) -> List[int]:
+    """Bọc forward của block `i % every == 0` bằng activation checkpointing (chỉ khi train)."""
+    blocks = model.transformer.h
+    selected = checkpointed_blocks(len(blocks), every)
+    if selected:
+        model.config.use_cache = False  # KV cache vô nghĩa khi train và không tương thích recompute
+    for index in selected:
+        block = blocks[index]
+        forward = block.forward
+
+        def checkpointed_forward(*args, _block=block, _forward=forward, **kwargs):
+            if _block.training and torch.is_grad_enabled():
+                return checkpoint(_forward, *args, use_reentrant=False, **kwargs)
+            return _forward(*args, **kwargs)
+
+        block.forward = checkpointed_forward
+    return selected
+
+
+def saved_activation_bytes(model, input_ids: torch.Tensor) -> Dict[str, Any]:
+    """Byte activation autograd giữ cho backward trong một forward: theo từng block + phần còn lại."""
+    param_storages = {param.untyped_storage().data_ptr() for param in model.parameters()}
+    blocks = model.transformer.h
+    per_block = [0] * len(blocks)
+    other = 0
+    seen = set()
+    current: List[Optional[int]] = [None]
+
+    def pack(tensor: torch.Tensor) -> torch.Tensor:
+        nonlocal other
+        storage = tensor.untyped_storage()
+        key = storage.data_ptr()
+        if key not in param_storages and key not in seen:
+            seen.add(key)
+            if current[0] is None:
+                other += storage.nbytes()
+            else:
+                per_block[current[0]] += storage.nbytes()
+        return tensor
+
+    handles = []
+    for index, block in enumerate(blocks):
+        handles.append(block.register_forward_pre_hook(lambda module, args, index=index: current.__setitem__(0, index)))
+        handles.append(block.register_forward_hook(lambda module, args, output: current.__setitem__(0, None)))
+    was_training = model.training
+    model.train()
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            loss = model(input_ids=input_ids, labels=input_ids).loss
+        del loss
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(was_training)
+    return {"per_block": per_block, "other": other}
+
+
+def activation_profile(model, seq_len: int, device: torch.device, amp_dtype=None) -> Dict[str, Any]:
+    """Activation = fixed + micro_batch × per_sample, cho từng block và phần ngoài block."""
+    samples = []
+    for micro_batch in (1, 2):
+        input_ids = torch.randint(0, model.config.vocab_size, (micro_batch, seq_len), device=device)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype or torch.float32, enabled=amp_dtype is not None):
+            samples.append(saved_activation_bytes(model, input_ids))
+    one, two = samples
+    return {
+        "block_per_sample": [max(b - a, 0) for a, b in zip(one["per_block"], two["per_block"])],
+        "block_fixed": [max(2 * a - b, 0) for a, b in zip(one["per_block"], two["per_block"])],
+        "other_per_sample": max(two["other"] - one["other"], 0),
+        "other_fixed": max(2 * one["other"] - two["other"], 0),
+    }
+
+
+def estimate_checkpointing(
+    config,
+    profile: Dict[str, Any],
+    micro_batch: int,
+    seq_len: int,
+    every: int,
+    *,
+    activation_bytes: int = 4,
+    tokens_per_s: Optional[float] = None,
+) -> Dict[str, Any]:
+    """Activation memory (GB) và chi phí recompute khi checkpoint mỗi `every` block.
+
+    `profile`: kết quả `activation_profile` (cùng seq_len, dtype, attention
+    kernel); `activation_bytes`: byte mỗi phần tử của hidden state giữ làm
+    input block checkpoint (2 với bf16/fp16 autocast).
+    """
+    per_block = [
+        fixed + per_sample * micro_batch
+        for fixed, per_sample in zip(profile["block_fixed"], profile["block_per_sample"])
+    ]
+    other = profile["other_fixed"] + profile["other_per_sample"] * micro_batch
+    selected = set(checkpointed_blocks(len(per_block), every))
+    block_input = micro_batch * seq_len * config.n_embd * activation_bytes
+    full = other + sum(per_block)
+    stored = other + sum(block_input if i in selected else size for i, size in enumerate(per_block))
+    recompute_peak = max((per_block[i] for i in selected), default=0)
+    checkpointed = stored + recompute_peak
+    block_forward_flops = 24.0 * config.n_embd ** 2 + 4.0 * config.n_embd * seq_len
+    recompute_fraction = len(selected) * block_forward_flops / gpt2_flops_per_token(config, seq_len)
+    result = {
+        "every": every,
+        "checkpointed_blocks": len(selected),
+        "activation_gb": checkpointed / 1024 ** 3,
+        "saved_gb": (full - checkpointed) / 1024 ** 3,
+        "recompute_fraction": recompute_fraction,
+    }
+    if tokens_per_s:
+        step_seconds = micro_batch * seq_len / tokens_per_s
+        result["recompute_s_per_micro_batch"] = step_seconds * recompute_fraction
+    return result
+
+
+def checkpointing_options(num_layers: int) -> List[int]:
+    """Các giá trị `every` cho số block checkpoint khác nhau: 0, rồi từ ít recompute đến nhiều."""
+    options: Dict[int, int] = {}
+    for every in range(num_layers, 0, -1):
+        options.setdefault(len(checkpointed_blocks(num_layers, every)), every)
+    return [0] + sorted(options.values(), reverse=True)
+
+
+def measure_model_activations(model_cfg: Dict[str, Any], seq_len: int, device: torch.device, amp_dtype=None):
+    """Dựng model (không checkpoint) trên `device` → (GPT2Config, `activation_profile`)."""
+    from .train_lm import build_model
+
+    model = build_model({**model_cfg, "activation_checkpointing": 0}).to(device)
+    try:
+        return model.config, activation_profile(model, seq_len, device, amp_dtype)
+    finally:
+        del model
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Ước lượng activation memory tiết kiệm vs recompute khi checkpoint")
+    parser.add_argument("--config", type=str, required=True, help="File config training (JSON)")
+    parser.add_argument("--micro-batch", type=int, default=None, help="Mặc định training.micro_batch_size")
+    parser.add_argument("--seq-len", type=int, default=None, help="Mặc định training.seq_len / n_positions")
+    parser.add_argument("--tokens-per-s", type=float, default=None, help="Throughput đo được để đổi recompute ra giây")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+def main() -> None:
+    from pathlib import Path
+
+    from .train_lm import load_config
+    from .utils import setup_encoding
+
+    setup_encoding()
+    args = parse_args()
+    config = load_config(Path(args.config))
+    model_cfg, train_cfg = config.get("model", {}), config.get("training", {})
+    device = torch.device(args.device)
+    micro_batch = args.micro_batch or train_cfg.get("micro_batch_size", 1)
+    seq_len = args.seq_len or train_cfg.get("seq_len") or model_cfg.get("n_positions", model_cfg.get("n_ctx", 1024))
+    mixed = train_cfg.get("mixed_precision", "").lower()
+    amp_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(mixed) if device.type == "cuda" else None
+
+    gpt_config, profile = measure_model_activations(model_cfg, seq_len, device, amp_dtype)
+    blocks = sum(profile["block_fixed"]) + sum(profile["block_per_sample"]) * micro_batch
+    other = profile["other_fixed"] + profile["other_per_sample"] * micro_batch
+    print(
+        f"📐 Activation micro_batch={micro_batch} seq_len={seq_len} ({device}, {mixed if amp_dtype else 'fp32'}): "
+        f"{blocks / 1024 ** 3:.2f}GB trong {gpt_config.n_layer} block + {other / 1024 ** 3:.2f}GB embedding/logits/loss"
+    )
+    for every in checkpointing_options(gpt_config.n_layer):
+        estimate = estimate_checkpointing(
+            gpt_config,
+            profile,
+            micro_batch,
+            seq_len,
+            every,
+            activation_bytes=2 if amp_dtype else 4,
+            tokens_per_s=args.tokens_per_s,
+        )
+        line = (
+            f"  every={every:<3} ckpt_blocks={estimate['checkpointed_blocks']:<3} "
+            f"activation={estimate['activation_gb']:.2f}GB saved={estimate['saved_gb']:.2f}GB "
+            f"recompute=+{estimate['recompute_fraction']:.1%} FLOPs"
+        )
+        if "recompute_s_per_micro_batch" in estimate:
+            line += f" (+{1000 * estimate['recompute_s_per_micro_batch']:.0f}ms/micro-batch)"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Eval bất đồng bộ: training publish snapshot weights, một process riêng chấm val.
+
+Bật bằng `training.async_eval: true`. Tại mỗi điểm eval, training chỉ copy
+weights về CPU (như checkpoint); thread nền ghi snapshot
+`<output_dir>/eval_snapshots/step<N>.safetensors` rồi đẩy (step, path) vào
+queue. Process evaluator (spawn, chạy trên `async_eval_device`: CPU với
+`async_eval_threads` thread, hoặc cùng GPU) lần lượt load snapshot vào model
+của nó, chạy `evaluate` với cùng cấu hình eval (`eval_batch_size`,
+`max_eval_batches`, `eval_token_weighted`), ghi `eval_results.jsonl`, tự
+promote `hf_best` khi val_loss tốt hơn và xoá snapshot.
+
+Training `poll()` kết quả mỗi optimizer step (không chờ) để log, theo dõi
+best và cập nhật val_loss cho retention keep-best; `close()` ở cuối run chờ
+các eval còn lại. Tối đa `async_eval_max_backlog` snapshot chờ chấm cùng lúc
+(mỗi snapshot là full weights trên đĩa): đạt giới hạn thì điểm eval đó bị bỏ
+qua, training không bị chặn.
+"""
+
+from __future__ import annotations
+
+import json
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from .checkpointing import HF_BEST_NAME, StateSnapshotter, dedupe_tensors, save_hf_snapshot
+from .utils import ensure_dir
+
+
+SNAPSHOT_DIR = "eval_snapshots"
+RESULTS_NAME = "eval_results.jsonl"
+AMP_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def load_snapshot(model, path: Path, device: torch.device) -> None:
+    """Load snapshot weights (tied weights chỉ lưu một lần, alias ghi trong metadata)."""
+    with safe_open(str(path), framework="pt") as f:
+        aliases = json.loads((f.metadata() or {}).get("aliases", "{}"))
+    missing, unexpected = model.load_state_dict(load_file(str(path), device=str(device)), strict=False)
+    missing = set(missing) - set(aliases)
+    if missing or unexpected:
+        raise KeyError(f"Snapshot {path} không khớp model: thiếu {sorted(missing)[:5]}, thừa {unexpected[:5]}")
+
+
+def evaluator_main(
+    jobs: "mp.Queue",
+    results: "mp.Queue",
+    model_cfg: Dict[str, Any],
+    eval_spec: Dict[str, Any],
+    output_dir: str,
+    device_str: str,
+    num_threads: int,
+) -> None:
+    """Vòng lặp của process evaluator: nhận (step, path) cho tới khi gặp None."""
+    from torch.utils.data import DataLoader
+
+    from .train_lm import build_model, collate_token_rows, eval_subset, evaluate, load_val_dataset
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    device = torch.device(device_str)
+    model = build_model(model_cfg).to(device)
+    model.config.pad_token_id = eval_spec["pad_token_id"]
+    val_ds = load_val_dataset(
+        eval_spec["val_tokens"],
+        Path(eval_spec["val_bin"]),
+        eval_spec["seq_len"],
+        eval_spec["pad_token_id"],
+        eval_spec["batch_size"],
+        eval_spec["seed"],
+    )
+    loader = DataLoader(
+        eval_subset(val_ds, eval_spec["max_batches"] * eval_spec["batch_size"], eval_spec["seed"]),
+        batch_size=eval_spec["batch_size"],
+        shuffle=False,
+        collate_fn=collate_token_rows,
+    )
+    amp_dtype = AMP_DTYPES.get(eval_spec["amp_dtype"]) if device.type == "cuda" else None
+    best_val = float("inf")
+    results_path = Path(output_dir) / RESULTS_NAME
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        step, path = job
+        try:
+            started = time.perf_counter()
+            load_snapshot(model, Path(path), device)
+            val_loss = evaluate(
+                model,
+                loader,
+                device,
+                eval_spec["pad_token_id"],
+                eval_spec["use_attention_mask"],
+                max_batches=eval_spec["max_batches"],
+                amp_dtype=amp_dtype,
+                token_weighted=eval_spec["token_weighted"],
+            )
+            is_best = val_loss < best_val
+            if is_best:
+                best_val = val_loss
+                save_hf_snapshot(model, model.state_dict(), Path(output_dir) / HF_BEST_NAME)
+            record = {"step": step, "val_loss": val_loss, "eval_s": time.perf_counter() - started, "best": is_best}
+            with open(results_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"time": time.time(), **record}, ensure_ascii=False) + "\n")
+        except Exception as exc:  # báo về training, evaluator vẫn chạy tiếp
+            record = {"step": step, "error": repr(exc)}
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        results.put(record)
+
+
+class AsyncEvaluator:
+    """Phía training: publish snapshot và nhận kết quả eval từ process evaluator."""
+
+    def __init__(
+        self,
+        model_cfg: Dict[str, Any],
+        eval_spec: Dict[str, Any],
+        output_dir: Path,
+        device: str = "cpu",
+        num_threads: int = 0,
+        max_backlog: int = 2,
+    ):
+        self.snapshot_dir = output_dir / SNAPSHOT_DIR
+        ensure_dir(self.snapshot_dir)
+        ctx = mp.get_context("spawn")
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(
+            target=evaluator_main,
+            args=(self.jobs, self.results, model_cfg, eval_spec, str(output_dir), device, num_threads),
+            name="async-eval",
+            daemon=True,
+        )
+        self.process.start()
+        self.snapshotter = StateSnapshotter()
+        self.max_backlog = max_backlog
+        self.pending = 0
+        self._writer: Optional[threading.Thread] = None
+
+    def _write(self, step: int, state: Dict[str, torch.Tensor]) -> None:
+        try:
+            tensors, aliases = dedupe_tensors(state)
+            path = self.snapshot_dir / f"step{step}.safetensors"
+            tmp_path = path.with_name(path.name + ".tmp")
+            save_file(tensors, str(tmp_path), metadata={"aliases": json.dumps(aliases)})
+            os.replace(tmp_path, path)
+            self.jobs.put((step, str(path)))
+        except Exception as exc:
+            self.results.put({"step": step, "error": repr(exc)})
+
+    def _wait_writer(self) -> None:
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def publish(self, step: int, model) -> bool:
+        """Snapshot weights (chỉ chặn cho bước copy về CPU) và xếp hàng eval.
+
+        Trả về False (không ghi snapshot) khi đã có `max_backlog` snapshot chờ chấm.
+        """
+        self._wait_writer()
+        if self.pending >= self.max_backlog:
+            print(f"⚠️ Async eval chậm hơn training: {self.pending} snapshot đang chờ chấm, bỏ qua eval step {step}.")
+            return False
+        state = self.snapshotter.snapshot(model.state_dict())
+        self._writer = threading.Thread(target=self._write, args=(step, state), name=f"eval-snapshot-{step}")
+        self._writer.start()
+        self.pending += 1
+        return True
+
+    def poll(self) -> List[Dict[str, Any]]:
+        """Kết quả eval đã xong (không chờ)."""
+        done = []
+        while True:
+            try:
+                done.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        self.pending -= len(done)
+        if self.pending and not self.process.is_alive():
+            print(f"⚠️ Process async eval đã dừng (exit code {self.process.exitcode}); bỏ {self.pending} eval.")
+            self.pending = 0
+        return done
+
+    def close(self) -> List[Dict[str, Any]]:
+        """Chờ các eval còn lại, dừng process evaluator và trả về kết quả cuối."""
+        self._wait_writer()
+        self.jobs.put(None)
+        done = []
+        while self.pending > 0 and self.process.is_alive():
+            try:
+                done.append(self.results.get(timeout=1.0))
+                self.pending -= 1
+            except queue.Empty:
+                continue
+        done.extend(self.poll())
+        self.process.join(timeout=30)
+        return done
@@ -0,0 +1,217 @@
+"""
+Tự chọn `micro_batch_size` / `gradient_accumulation_steps` trước khi train.
+
+Bật bằng `training.auto_batch: true` (hoặc dict tuỳ chọn bên dưới). Trước khi
+dựng model train, finder dựng model + AdamW tạm và chạy vài train step đầy đủ
+(forward / backward / optimizer step) trên batch token ngẫu nhiên
+`[micro, seq_len]`, với `micro` tăng dần qua các ước của batch mỗi rank
+(`training.batch_size / world_size`) để accumulation chia hết:
+
+- GPU: `micro` vừa khi không OOM và peak memory reserved
+  ≤ (1 - `safety_margin`) × VRAM; dừng ở `micro` đầu tiên không vừa.
+- CPU: không đo memory, chỉ đo tokens/s (tối đa `max_micro_batch`).
+
+Probe không checkpointing trước; nếu chưa chứa nổi cả batch mỗi rank thì
+probe thêm các micro lớn hơn với activation checkpointing chọn lọc
+(`model.activation_checkpointing: k`, xem `activation_checkpointing`): đo
+activation từng block một lần, lấy phần memory cố định (weights, optimizer,
+workspace) = peak của micro lớn nhất đã vừa − activation ước lượng của nó,
+rồi với mỗi micro chọn `k` lớn nhất (ít recompute nhất) mà ước lượng còn vừa.
+Cấu hình có tokens/s cao nhất được chọn và
+`gradient_accumulation_steps = batch_size / (micro × world_size)`. Kết quả
+(kèm bảng probe) ghi vào `<output_dir>/auto_batch.json` và dòng start của
+`metrics.jsonl`.
+
+Tuỳ chọn (`training.auto_batch`):
+- `safety_margin` (0.1): phần VRAM chừa lại cho DDP bucket, fragmentation, eval
+- `probe_steps` (3): số step đo tokens/s (sau 1 step warmup)
+- `max_micro_batch` (64): trần của micro (CPU hoặc GPU rất lớn)
+- `checkpointing` (true): có probe activation checkpointing không
+"""
+
+from __future__ import annotations
+
+import gc
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import torch
+
+from .activation_checkpointing import (
+    checkpoint_label,
+    checkpointing_options,
+    estimate_checkpointing,
+    measure_model_activations,
+)
+
+DEFAULT_OPTIONS: Dict[str, Any] = {
+    "safety_margin": 0.1,
+    "probe_steps": 3,
+    "max_micro_batch": 64,
+    "checkpointing": True,
+}
+RESULT_NAME = "auto_batch.json"
+
+
+def candidate_micro_batches(rank_batch: int, max_micro_batch: int) -> List[int]:
+    """Các ước của batch mỗi rank (≤ `max_micro_batch`), tăng dần."""
+    return [size for size in range(1, min(rank_batch, max_micro_batch) + 1) if rank_batch % size == 0]
+
+
+def release_memory(device: torch.device) -> None:
+    gc.collect()
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+
+
+def probe_micro_batch(
+    model_cfg: Dict[str, Any],
+    micro_batch: int,
+    seq_len: int,
+    device: torch.device,
+    *,
+    checkpoint_every: int,
+    amp_dtype: Optional[torch.dtype],
+    steps: int,
+    memory_limit: Optional[int],
+) -> Dict[str, Any]:
+    """Chạy `steps + 1` train step với batch ngẫu nhiên; trả về fits / peak memory / tokens/s."""
+    from .train_lm import build_model
+
+    result: Dict[str, Any] = {"micro_batch_size": micro_batch, "activation_checkpointing": checkpoint_every}
+    model = optimizer = input_ids = loss = None
+    try:
+        model = build_model({**model_cfg, "activation_checkpointing": checkpoint_every}).to(device)
+        model.train()
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+        input_ids = torch.randint(0, model.config.vocab_size, (micro_batch, seq_len), device=device)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        started = 0.0
+        for step in range(steps + 1):
+            if step == 1:  # step đầu cấp phát optimizer state / autotune kernel → không tính giờ
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                started = time.perf_counter()
+            with torch.autocast(
+                device_type=device.type, dtype=amp_dtype or torch.float32, enabled=amp_dtype is not None
+            ):
+                loss = model(input_ids=input_ids, labels=input_ids).loss
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+            peak = torch.cuda.max_memory_reserved(device)
+            result["peak_mem_gb"] = peak / 1024 ** 3
+            result["peak_mem_bytes"] = peak
+            result["fits"] = memory_limit is None or peak <= memory_limit
+        else:
+            result["fits"] = True
+        result["tokens_per_s"] = micro_batch * seq_len * steps / max(time.perf_counter() - started, 1e-9)
+    except torch.cuda.OutOfMemoryError:
+        result.update(fits=False, oom=True)
+    finally:
+        del model, optimizer, input_ids, loss
+        release_memory(device)
+    return result
+
+
+def find_micro_batch(
+    model_cfg: Dict[str, Any],
+    seq_len: int,
+    global_batch: int,
+    device: torch.device,
+    *,
+    world_size: int = 1,
+    amp_dtype: Optional[torch.dtype] = None,
+    options: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Probe micro-batch (± activation checkpointing) và chọn cấu hình nhanh nhất vừa memory."""
+    opts = {**DEFAULT_OPTIONS, **(options or {})}
+    if global_batch % world_size:
+        raise ValueError(f"batch_size={global_batch} không chia hết cho world_size={world_size}.")
+    rank_batch = global_batch // world_size
+    memory_limit = None
+    if device.type == "cuda":
+        total = torch.cuda.get_device_properties(device).total_memory
+        memory_limit = int(total * (1.0 - opts["safety_margin"]))
+    candidates = candidate_micro_batches(rank_batch, opts["max_micro_batch"])
+
+    probes: List[Dict[str, Any]] = []
+
+    def run_probe(micro: int, every: int, estimate: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        result = probe_micro_batch(
+            model_cfg,
+            micro,
+            seq_len,
+            device,
+            checkpoint_every=every,
+            amp_dtype=amp_dtype,
+            steps=opts["probe_steps"],
+            memory_limit=memory_limit,
+        )
+        if estimate:
+            result["estimated_activation_gb"] = estimate["activation_gb"]
+            result["recompute_fraction"] = estimate["recompute_fraction"]
+        probes.append(result)
+        mem = f" peak={result['peak_mem_gb']:.2f}GB" if "peak_mem_gb" in result else ""
+        speed = f" {result['tokens_per_s']:,.0f} tok/s" if "tokens_per_s" in result else ""
+        status = "✔" if result["fits"] else ("OOM" if result.get("oom") else "✘ vượt margin")
+        print(f"  🔎 micro={micro:<4} ckpt={checkpoint_label(every)}{mem}{speed} {status}")
+        return result
+
+    largest, largest_probe = 0, None
+    for micro in candidates:
+        result = run_probe(micro, 0)
+        if not result["fits"]:
+            break
+        largest, largest_probe = micro, result
+
+    # Micro lớn nhất đã vừa không cần checkpointing → checkpointing chỉ làm chậm.
+    if opts["checkpointing"] and largest < candidates[-1]:
+        gpt_config, profile = measure_model_activations(model_cfg, seq_len, device, amp_dtype)
+        activation_bytes = 2 if amp_dtype is not None else 4
+
+        def estimate(micro: int, every: int) -> Dict[str, Any]:
+            return estimate_checkpointing(
+                gpt_config, profile, micro, seq_len, every, activation_bytes=activation_bytes
+            )
+
+        static = None
+        if memory_limit is not None and largest_probe and "peak_mem_bytes" in largest_probe:
+            static = largest_probe["peak_mem_bytes"] - estimate(largest, 0)["activation_gb"] * 1024 ** 3
+        options = checkpointing_options(gpt_config.n_layer)[1:]  # ít recompute → nhiều
+        for micro in [size for size in candidates if size > largest]:
+            every = 1
+            if static is not None:
+                every = next(
+                    (k for k in options if static + estimate(micro, k)["activation_gb"] * 1024 ** 3 <= memory_limit),
+                    1,
+                )
+            if not run_probe(micro, every, estimate(micro, every))["fits"]:
+                break
+
+    fitting = [probe for probe in probes if probe["fits"]]
+    if not fitting:
+        raise RuntimeError(f"Micro-batch 1 (seq_len={seq_len}) không vừa memory kể cả khi bật activation checkpointing.")
+    best = max(fitting, key=lambda probe: (probe["tokens_per_s"], not probe["activation_checkpointing"]))
+    return {
+        "micro_batch_size": best["micro_batch_size"],
+        "gradient_accumulation_steps": rank_batch // best["micro_batch_size"],
+        "activation_checkpointing": best["activation_checkpointing"],
+        "tokens_per_s": best["tokens_per_s"],
+        "batch_size": global_batch,
+        "seq_len": seq_len,
+        "world_size": world_size,
+        "memory_limit_gb": memory_limit / 1024 ** 3 if memory_limit else None,
+        "probes": probes,
+    }
+
+
+def write_result(output_dir: Path, result: Dict[str, Any]) -> None:
+    with open(output_dir / RESULT_NAME, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,583 @@
+"""
+Lưu checkpoint bất đồng bộ, mỗi checkpoint chỉ serialize một lần.
+
+Luồng lưu:
+1. `StateSnapshotter` copy toàn bộ state (model/optimizer/scheduler/data) về CPU
+   – đây là phần duy nhất training loop phải chờ. Tensor CUDA được copy vào
+   pinned buffer dùng lại giữa các lần lưu; tensor dùng chung storage (wte ↔
+   lm_head tied) vẫn dùng chung sau snapshot nên chỉ được ghi một lần.
+2. Thread nền `torch.save` payload vào `checkpoint_<tag>.pt.tmp` rồi
+   `os.replace` sang tên thật; `checkpoint_latest.pt` là hardlink tới file đó
+   (đổi tên atomic, không ghi lại payload; filesystem không hỗ trợ hardlink
+   thì copy file). `hf_best` được `save_pretrained(state_dict=...)` từ chính
+   snapshot vào thư mục tạm rồi đổi tên.
+
+Tối đa một lần lưu chạy nền: lần lưu kế tiếp chờ lần trước xong (để giới hạn
+RAM và dùng lại pinned buffer). Lỗi ghi được giữ lại và raise ở lần `check()`
+tiếp theo (mỗi optimizer step) hoặc khi `wait()`.
+
+Format `sharded` (`training.checkpoint_format`) ghi mỗi checkpoint thành thư
+mục `checkpoint_<tag>/`:
+- `model-0000i-of-0000n.safetensors`     : weights (tied weights chỉ ghi một lần)
+- `optimizer-0000i-of-0000n.safetensors` : moment của optimizer (`state.<idx>.<key>`)
+- `trainer_state.pt`                      : scheduler, step, data_state, param_groups
+- `checkpoint_index.json`                 : weight map tensor → shard, alias tied
+Resume (`load_checkpoint`) stream từng tensor thẳng vào parameter hiện có thay
+vì `torch.load` cả pickle; chỉ truyền model thì chỉ đọc shard model (eval).
+
+`CheckpointManager` giữ manifest `checkpoints.json` (tag, step, val_loss) và
+xoá checkpoint xoay vòng (`step<N>`, `epoch<N>`) theo policy keep-last-K,
+keep-best-K theo val loss và keep-every-N-steps. Việc xoá chạy trên thread
+ghi nền ngay sau khi checkpoint mới ghi xong. `best`/`final`/`last`/`latest`
+không bao giờ bị xoá.
+"""
+
+from __future__ import annotations
+
+import copy
+import json
+import os
+import random
+import re
+import shutil
+import threading
+import time
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from .optimizer_state import decode_optimizer_state, encode_optimizer_state
+from .utils import ensure_dir
+
+
+PT_FORMAT = "pt"
+SHARDED_FORMAT = "sharded"
+INDEX_NAME = "checkpoint_index.json"
+TRAINER_STATE_NAME = "trainer_state.pt"
+DEFAULT_SHARD_BYTES = 1 << 30
+HF_BEST_NAME = "hf_best"
+MANIFEST_NAME = "checkpoints.json"
+ROTATING_TAG = re.compile(r"^(step|epoch)\d+$")
+
+
+def checkpoint_path(output_dir: Path, tag: str, fmt: str = PT_FORMAT) -> Path:
+    if fmt == SHARDED_FORMAT:
+        return output_dir / f"checkpoint_{tag}"
+    return output_dir / f"checkpoint_{tag}.pt"
+
+
+class StateSnapshotter:
+    """Copy state lồng nhau (dict/list/tensor) về CPU, dùng lại pinned buffer theo vị trí trong state."""
+
+    def __init__(self):
+        self._buffers: Dict[Tuple, torch.Tensor] = {}
+
+    def snapshot(self, state: Any) -> Any:
+        aliases: Dict[Tuple, torch.Tensor] = {}
+        copied_cuda = False
+
+        def visit(value: Any, key: Tuple) -> Any:
+            nonlocal copied_cuda
+            if isinstance(value, torch.Tensor):
+                alias = (value.device, value.data_ptr(), value.dtype, tuple(value.shape), value.stride())
+                if value.numel() and alias in aliases:
+                    return aliases[alias]
+                if value.is_cuda:
+                    buffer = self._buffers.get(key)
+                    if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                        buffer = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+                        self._buffers[key] = buffer
+                    buffer.copy_(value.detach(), non_blocking=True)
+                    copied_cuda = True
+                    result = buffer
+                else:
+                    result = value.detach().clone()
+                aliases[alias] = result
+                return result
+            if isinstance(value, dict):
+                return type(value)((k, visit(v, key + (k,))) for k, v in value.items())
+            if isinstance(value, (list, tuple)):
+                items = [visit(v, key + (i,)) for i, v in enumerate(value)]
+                return items if isinstance(value, list) else tuple(items)
+            return copy.deepcopy(value)
+
+        result = visit(state, ())
+        if copied_cuda:
+            torch.cuda.synchronize()
+        return result
+
+
+def remove_path(path: Path) -> None:
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def replace_dir(tmp_dir: Path, target: Path) -> None:
+    """Đưa thư mục đã ghi xong vào chỗ `target` (thư mục cũ bị đổi tên rồi xoá)."""
+    old_dir = target.with_name(target.name + ".old")
+    remove_path(old_dir)
+    if target.exists():
+        os.replace(target, old_dir)
+    os.replace(tmp_dir, target)
+    remove_path(old_dir)
+
+
+def link_latest(ckpt_path: Path, latest_path: Path) -> None:
+    """Trỏ `latest` tới checkpoint vừa ghi: hardlink + rename atomic, fallback copy.
+
+    Checkpoint sharded (thư mục) → `latest` là thư mục hardlink từng file.
+    """
+    tmp_path = latest_path.with_name(latest_path.name + ".tmp")
+    remove_path(tmp_path)
+    if ckpt_path.is_dir():
+        tmp_path.mkdir()
+        for item in ckpt_path.iterdir():
+            link_or_copy(item, tmp_path / item.name)
+        replace_dir(tmp_path, latest_path)
+        return
+    link_or_copy(ckpt_path, tmp_path)
+    os.replace(tmp_path, latest_path)
+
+
+def save_hf_snapshot(model, model_state: Dict[str, torch.Tensor], hf_dir: Path) -> None:
+    """`save_pretrained` từ state CPU vào thư mục tạm rồi thay thư mục cũ."""
+    tmp_dir = hf_dir.with_name(hf_dir.name + ".tmp")
+    remove_path(tmp_dir)
+    model.save_pretrained(tmp_dir, state_dict=model_state)
+    replace_dir(tmp_dir, hf_dir)
+
+
+def dedupe_tensors(state: Dict[str, torch.Tensor]) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """Bỏ tensor dùng chung storage (tied weights): trả về (tensor duy nhất, alias → tên gốc)."""
+    unique: Dict[str, torch.Tensor] = {}
+    aliases: Dict[str, str] = {}
+    seen: Dict[Tuple, str] = {}
+    for name, tensor in state.items():
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+        if tensor.numel() and key in seen:
+            aliases[name] = seen[key]
+            continue
+        seen[key] = name
+        unique[name] = tensor
+    return unique, aliases
+
+
+def split_tensors(tree: Dict, prefix: str = "") -> Tuple[Dict[str, torch.Tensor], Dict]:
+    """Tách tensor khỏi dict lồng nhau → ({"a.b.c": tensor}, cây còn lại không chứa tensor)."""
+    tensors: Dict[str, torch.Tensor] = {}
+    rest: Dict = {}
+    for key, value in tree.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, torch.Tensor):
+            tensors[name] = value
+        elif isinstance(value, dict):
+            sub_tensors, rest[key] = split_tensors(value, name + ".")
+            tensors.update(sub_tensors)
+        else:
+            rest[key] = value
+    return tensors, rest
+
+
+def put_tensor(tree: Dict, name: str, tensor: torch.Tensor) -> None:
+    """Ngược của `split_tensors` cho một tensor (khớp key theo `str(key)`)."""
+    *parents, leaf = name.split(".")
+    node = tree
+    for part in parents:
+        keys = {str(key): key for key in node}
+        node = node[keys[part]]
+    keys = {str(key): key for key in node}
+    node[keys.get(leaf, leaf)] = tensor
+
+
+def write_shards(directory: Path, prefix: str, tensors: Dict[str, torch.Tensor], max_shard_bytes: int) -> Dict[str, str]:
+    """Ghi tensor thành các file `<prefix>-0000i-of-0000n.safetensors`. Trả về weight_map tên → file."""
+    if not tensors:
+        return {}
+    groups: List[List[str]] = [[]]
+    size = 0
+    for name, tensor in tensors.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        if groups[-1] and size + nbytes > max_shard_bytes:
+            groups.append([])
+            size = 0
+        groups[-1].append(name)
+        size += nbytes
+    weight_map: Dict[str, str] = {}
+    for i, names in enumerate(groups, 1):
+        file_name = f"{prefix}-{i:05d}-of-{len(groups):05d}.safetensors"
+        save_file({name: tensors[name].contiguous() for name in names}, str(directory / file_name))
+        weight_map.update(dict.fromkeys(names, file_name))
+    return weight_map
+
+
+def write_sharded_checkpoint(ckpt_dir: Path, payload: Dict[str, Any], max_shard_bytes: int = DEFAULT_SHARD_BYTES) -> None:
+    """Ghi payload thành thư mục: shard safetensors model/optimizer + trainer_state.pt + index."""
+    tmp_dir = ckpt_dir.with_name(ckpt_dir.name + ".tmp")
+    remove_path(tmp_dir)
+    ensure_dir(tmp_dir)
+    model_tensors, aliases = dedupe_tensors(payload["model_state"])
+    optimizer_tensors, optimizer_rest = split_tensors(payload["optimizer_state"])
+    index = {
+        "format": SHARDED_FORMAT,
+        "step": payload.get("step"),
+        "model": {
+            "weight_map": write_shards(tmp_dir, "model", model_tensors, max_shard_bytes),
+            "aliases": aliases,
+        },
+        "optimizer": {"weight_map": write_shards(tmp_dir, "optimizer", optimizer_tensors, max_shard_bytes)},
+    }
+    trainer_state = {k: v for k, v in payload.items() if k not in ("model_state", "optimizer_state")}
+    trainer_state["optimizer_rest"] = optimizer_rest
+    torch.save(trainer_state, tmp_dir / TRAINER_STATE_NAME)
+    with open(tmp_dir / INDEX_NAME, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    replace_dir(tmp_dir, ckpt_dir)
+
+
+def write_checkpoint(
+    output_dir: Path,
+    tag: str,
+    payload: Dict[str, Any],
+    hf_model=None,
+    fmt: str = PT_FORMAT,
+    max_shard_bytes: int = DEFAULT_SHARD_BYTES,
+    optimizer_state_dtype: str = "fp32",
+) -> Path:
+    """Ghi payload (đã ở CPU) một lần, cập nhật `latest`, tuỳ chọn ghi `hf_best`.
+
+    `optimizer_state_dtype` (fp32/bf16/int8) nén moment optimizer trước khi ghi.
+    """
+    ensure_dir(output_dir)
+    payload = {**payload, "optimizer_state": encode_optimizer_state(payload["optimizer_state"], optimizer_state_dtype)}
+    ckpt_path = checkpoint_path(output_dir, tag, fmt)
+    if fmt == SHARDED_FORMAT:
+        write_sharded_checkpoint(ckpt_path, payload, max_shard_bytes)
+    else:
+        tmp_path = ckpt_path.with_name(ckpt_path.name + ".tmp")
+        torch.save(payload, tmp_path)
+        os.replace(tmp_path, ckpt_path)
+    link_latest(ckpt_path, checkpoint_path(output_dir, "latest", fmt))
+    if hf_model is not None:
+        save_hf_snapshot(hf_model, payload["model_state"], output_dir / HF_BEST_NAME)
+    return ckpt_path
+
+
+def is_sharded_checkpoint(path: Path) -> bool:
+    return path.is_dir() and (path / INDEX_NAME).exists()
+
+
+def iter_shard_groups(weight_map: Dict[str, str]) -> Iterator[Tuple[str, List[str]]]:
+    groups: Dict[str, List[str]] = {}
+    for name, file_name in weight_map.items():
+        groups.setdefault(file_name, []).append(name)
+    return iter(groups.items())
+
+
+def load_sharded_checkpoint(ckpt_dir: Path, model, optimizer=None, scheduler=None) -> Dict[str, Any]:
+    """Stream tensor từng shard thẳng vào parameter/optimizer state đang có.
+
+    Chỉ giữ một tensor tạm mỗi lần (safetensors mmap), không dựng bản copy
+    toàn bộ checkpoint trong RAM. `optimizer=None` → chỉ đọc shard model.
+    """
+    with open(ckpt_dir / INDEX_NAME, "r", encoding="utf-8") as f:
+        index = json.load(f)
+    device = next(model.parameters()).device
+    params = model.state_dict()
+    weight_map = index["model"]["weight_map"]
+    missing = set(params) - set(weight_map) - set(index["model"]["aliases"])
+    if missing:
+        raise KeyError(f"Checkpoint {ckpt_dir} thiếu tensor model: {sorted(missing)[:5]}")
+    with torch.no_grad():
+        for file_name, names in iter_shard_groups(weight_map):
+            with safe_open(str(ckpt_dir / file_name), framework="pt", device=str(device)) as shard:
+                for name in names:
+                    params[name].copy_(shard.get_tensor(name))
+
+    trainer_state = torch.load(ckpt_dir / TRAINER_STATE_NAME, map_location="cpu", weights_only=False)
+    optimizer_state = trainer_state.pop("optimizer_rest")
+    if optimizer is not None:
+        for file_name, names in iter_shard_groups(index["optimizer"]["weight_map"]):
+            with safe_open(str(ckpt_dir / file_name), framework="pt", device="cpu") as shard:
+                for name in names:
+                    tensor = shard.get_tensor(name)
+                    if not name.endswith(".step"):  # AdamW giữ step trên CPU
+                        tensor = tensor.to(device)
+                    put_tensor(optimizer_state, name, tensor)
+        optimizer.load_state_dict(decode_optimizer_state(optimizer_state))
+    if scheduler is not None and trainer_state.get("scheduler_state"):
+        scheduler.load_state_dict(trainer_state["scheduler_state"])
+    return trainer_state
+
+
+def load_checkpoint(path: Path, model, optimizer=None, scheduler=None) -> Dict[str, Any]:
+    """Load checkpoint `.pt` hoặc sharded vào model (+ optimizer/scheduler nếu truyền).
+
+    Trả về dict có `step`, `data_state`, ... Chỉ truyền `model` để load weights (eval).
+    """
+    if is_sharded_checkpoint(path):
+        return load_sharded_checkpoint(path, model, optimizer, scheduler)
+    ckpt = torch.load(path, map_location="cpu", mmap=True)
+    model.load_state_dict(ckpt["model_state"])
+    if optimizer is not None:
+        optimizer.load_state_dict(decode_optimizer_state(ckpt["optimizer_state"]))
+    if scheduler is not None and ckpt.get("scheduler_state"):
+        scheduler.load_state_dict(ckpt["scheduler_state"])
+    return ckpt
+
+
+def capture_rng_state() -> Dict[str, Any]:
+    """RNG python/numpy/torch/cuda (dropout) tại thời điểm lưu; numpy state đổi sang list cho torch.load an toàn."""
+    kind, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        "python": random.getstate(),
+        "numpy": [kind, keys.tolist(), pos, has_gauss, cached_gaussian],
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def restore_rng_state(state: Optional[Dict[str, Any]]) -> None:
+    if not state:
+        return
+    random.setstate((state["python"][0], tuple(state["python"][1]), state["python"][2]))
+    kind, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((kind, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] and torch.cuda.is_available() and len(state["cuda"]) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def build_payload(
+    model,
+    optimizer,
+    scheduler,
+    step: int,
+    data_state: Optional[Dict] = None,
+    rng_state: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """`rng_state`: RNG đã gom sẵn (DDP: của mọi rank); mặc định RNG của process này."""
+    return {
+        "model_state": model.state_dict(),
+        "optimizer_state": optimizer.state_dict(),
+        "scheduler_state": scheduler.state_dict() if scheduler else None,
+        "step": step,
+        "data_state": data_state,
+        "rng_state": rng_state if rng_state is not None else capture_rng_state(),
+    }
+
+
+def _val_step(entry: Dict[str, Any]) -> Optional[int]:
+    """Step của lần eval gắn với checkpoint (manifest cũ không có `val_step`)."""
+    if entry.get("val_loss") is None:
+        return None
+    return entry.get("val_step", entry["step"])
+
+
+class CheckpointManager:
+    """Manifest các checkpoint đã lưu + retention policy cho checkpoint xoay vòng.
+
+    `keep_last=None` → không xoá gì (hành vi cũ). Một checkpoint được giữ nếu
+    thoả ít nhất một policy: nằm trong `keep_last` bản mới nhất, trong
+    `keep_best` bản có val_loss thấp nhất, hoặc step chia hết cho
+    `keep_every_n_steps`.
+
+    Val loss của một checkpoint là kết quả eval gần nhất tại step ≤ step của
+    nó (`val_step` trong manifest), nên keep-best vẫn đúng khi `save_every`
+    và `eval_every` không trùng nhịp; eval đến sau (async) cập nhật lại.
+    `await_eval=True` (async eval + keep_best): checkpoint mới hơn lần eval đã
+    có kết quả gần nhất chưa bị xoá, vì eval đang chờ có thể chấm nó tốt nhất.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        keep_last: Optional[int] = None,
+        keep_best: int = 0,
+        keep_every_n_steps: int = 0,
+        await_eval: bool = False,
+    ):
+        self.output_dir = output_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.keep_every_n_steps = keep_every_n_steps
+        self.await_eval = await_eval
+        self.manifest_path = output_dir / MANIFEST_NAME
+        self.entries: List[Dict[str, Any]] = []
+        self.val_losses: Dict[int, float] = {}
+        self._lock = threading.Lock()  # async eval cập nhật val_loss từ thread training
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                entries = json.load(f).get("checkpoints", [])
+            self.entries = [e for e in entries if (output_dir / e["file"]).exists()]
+
+    @classmethod
+    def from_config(
+        cls, output_dir: Path, retention: Optional[Dict[str, Any]], await_eval: bool = False
+    ) -> "CheckpointManager":
+        retention = retention or {}
+        return cls(
+            output_dir,
+            keep_last=retention.get("keep_last"),
+            keep_best=retention.get("keep_best", 0),
+            keep_every_n_steps=retention.get("keep_every_n_steps", 0),
+            await_eval=await_eval,
+        )
+
+    def register(self, tag: str, step: int, file_name: str, val_loss: Optional[float] = None) -> None:
+        with self._lock:
+            val_step = step if val_loss is not None else None
+            if val_loss is None:
+                val_step = max((s for s in self.val_losses if s <= step), default=None)
+                val_loss = self.val_losses.get(val_step)
+            self.entries = [e for e in self.entries if e["file"] != file_name]
+            self.entries.append(
+                {
+                    "tag": tag,
+                    "file": file_name,
+                    "step": step,
+                    "val_loss": val_loss,
+                    "val_step": val_step,
+                    "saved_at": time.time(),
+                }
+            )
+            self.write_manifest()
+
+    def record_val_loss(self, step: int, val_loss: float) -> None:
+        """Ghi nhận một lần eval; gán cho checkpoint step ≥ `step` chưa có eval mới hơn."""
+        with self._lock:
+            self.val_losses[step] = val_loss
+            for entry in self.entries:
+                current = _val_step(entry)
+                if entry["step"] >= step and (current is None or current < step):
+                    entry["val_loss"] = val_loss
+                    entry["val_step"] = step
+            self.write_manifest()
+
+    def write_manifest(self) -> None:
+        policy = {
+            "keep_last": self.keep_last,
+            "keep_best": self.keep_best,
+            "keep_every_n_steps": self.keep_every_n_steps,
+        }
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"policy": policy, "checkpoints": self.entries}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def select_deletions(self) -> List[Dict[str, Any]]:
+        if self.keep_last is None:
+            return []
+        rotating = [e for e in self.entries if ROTATING_TAG.match(e["tag"])]
+        by_recency = sorted(rotating, key=lambda e: (e["step"], e["saved_at"]))
+        keep = {e["file"] for e in by_recency[-self.keep_last:]} if self.keep_last else set()
+        scored = sorted((e for e in rotating if e.get("val_loss") is not None), key=lambda e: e["val_loss"])
+        keep.update(e["file"] for e in scored[: self.keep_best])
+        if self.keep_best and self.await_eval:
+            last_scored = max(self.val_losses, default=-1)
+            keep.update(e["file"] for e in rotating if e["step"] > last_scored)
+        if self.keep_every_n_steps:
+            keep.update(e["file"] for e in rotating if e["step"] % self.keep_every_n_steps == 0)
+        return [e for e in rotating if e["file"] not in keep]
+
+    def prune(self) -> List[str]:
+        """Xoá checkpoint ngoài policy, cập nhật manifest. Trả về tên file đã xoá."""
+        with self._lock:
+            deleted = [entry["file"] for entry in self.select_deletions()]
+            if deleted:
+                self.entries = [e for e in self.entries if e["file"] not in deleted]
+                self.write_manifest()
+        for file_name in deleted:
+            remove_path(self.output_dir / file_name)
+        if deleted:
+            print(f"🗑️  Retention: xoá {', '.join(deleted)}")
+        return deleted
+
+
+class AsyncCheckpointer:
+    """Snapshot state về CPU trên thread training, ghi đĩa (+ retention) trên thread nền."""
+
+    def __init__(
+        self,
+        output_dir: Path,
+        async_save: bool = True,
+        manager: Optional[CheckpointManager] = None,
+        fmt: str = PT_FORMAT,
+        max_shard_bytes: int = DEFAULT_SHARD_BYTES,
+        optimizer_state_dtype: str = "fp32",
+    ):
+        self.output_dir = output_dir
+        self.async_save = async_save
+        self.fmt = fmt
+        self.max_shard_bytes = max_shard_bytes
+        self.optimizer_state_dtype = optimizer_state_dtype
+        self.manager = manager
+        self.snapshotter = StateSnapshotter()
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        self._error_tag: Optional[str] = None
+
+    def save(
+        self,
+        model,
+        optimizer,
+        scheduler,
+        step: int,
+        tag: str,
+        *,
+        save_hf: bool = False,
+        data_state: Optional[Dict] = None,
+        val_loss: Optional[float] = None,
+        rng_state: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """`val_loss`: loss eval tại đúng step này (nếu có), dùng cho keep-best."""
+        self.wait()
+        payload = self.snapshotter.snapshot(build_payload(model, optimizer, scheduler, step, data_state, rng_state))
+        job = partial(self._write, tag, payload, model if save_hf else None, step, val_loss)
+        if not self.async_save:
+            job()
+            return
+        self._thread = threading.Thread(target=self._run, args=(job, tag), name=f"checkpoint-{tag}")
+        self._thread.start()
+
+    def _write(self, tag: str, payload: Dict[str, Any], hf_model, step: int, val_loss: Optional[float]) -> None:
+        path = write_checkpoint(
+            self.output_dir, tag, payload, hf_model, self.fmt, self.max_shard_bytes, self.optimizer_state_dtype
+        )
+        if self.manager is not None:
+            self.manager.register(tag, step, path.name, val_loss)
+            self.manager.prune()
+
+    def _run(self, job: Callable[[], Any], tag: str) -> None:
+        try:
+            job()
+        except BaseException as exc:  # giữ lại, raise ở thread training
+            self._error = exc
+            self._error_tag = tag
+
+    def check(self) -> None:
+        """Raise lỗi của lần lưu nền đã kết thúc (không chờ)."""
+        if self._error is not None:
+            error, tag = self._error, self._error_tag
+            self._error = self._error_tag = None
+            raise RuntimeError(f"Lưu checkpoint '{tag}' thất bại: {error}") from error
+
+    def wait(self) -> None:
+        """Chờ lần lưu đang chạy (nếu có) rồi raise lỗi của nó."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.check()
@@ -0,0 +1,144 @@
+"""
+Đưa batch lên device trước và đo thời gian chờ dữ liệu trong training loop.
+
+`DevicePrefetcher` chạy một thread nền: lấy batch từ DataLoader, copy
+`non_blocking` lên GPU trên một CUDA stream riêng và dựng labels/mask ngay
+trên stream đó, giữ sẵn tối đa `depth` batch trong queue. Training loop chỉ
+chờ event của batch kế tiếp thay vì copy đồng bộ ở đầu mỗi step.
+
+`DataWaitTimer` bọc iterator batch và cộng dồn thời gian loop bị chặn chờ
+batch, để log data-wait mỗi step.
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+import torch
+
+
+BatchTransform = Callable[[torch.Tensor], Dict[str, torch.Tensor]]
+
+_DONE = object()
+
+
+def to_device_batch(
+    batch: Dict[str, torch.Tensor],
+    device: torch.device,
+    transform: BatchTransform,
+) -> Dict[str, torch.Tensor]:
+    """Copy input_ids lên device (non_blocking với pinned memory) rồi dựng input cho model."""
+    return transform(batch["input_ids"].to(device, non_blocking=True))
+
+
+class DevicePrefetcher:
+    """Iterable batch đã nằm trên device, được chuẩn bị trước bởi một thread nền."""
+
+    def __init__(
+        self,
+        loader: Iterable[Dict[str, torch.Tensor]],
+        device: torch.device,
+        transform: BatchTransform,
+        depth: int = 2,
+    ):
+        self.loader = loader
+        self.device = device
+        self.transform = transform
+        self.depth = max(depth, 1)
+
+    def _produce(self, out: "queue.Queue", stop: threading.Event) -> None:
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        try:
+            for batch in self.loader:
+                event: Optional[torch.cuda.Event] = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        prepared = to_device_batch(batch, self.device, self.transform)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    prepared = to_device_batch(batch, self.device, self.transform)
+                while not stop.is_set():
+                    try:
+                        out.put((prepared, event), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            out.put(_DONE)
+        except BaseException as exc:  # chuyển lỗi sang thread chính
+            out.put(exc)
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        out: "queue.Queue" = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(out, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = out.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    for tensor in batch.values():
+                        tensor.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    out.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.1)
+
+
+def iter_device_batches(
+    loader: Iterable[Dict[str, torch.Tensor]],
+    device: torch.device,
+    transform: BatchTransform,
+    prefetch: int = 0,
+) -> Iterable[Dict[str, torch.Tensor]]:
+    """`prefetch` > 0 → DevicePrefetcher, ngược lại copy từng batch ngay trong loop."""
+    if prefetch > 0:
+        return DevicePrefetcher(loader, device, transform, depth=prefetch)
+    return (to_device_batch(batch, device, transform) for batch in loader)
+
+
+class DataWaitTimer:
+    """Cộng dồn thời gian loop chờ batch kế tiếp; `pop()` trả về (giây chờ, số batch) rồi reset."""
+
+    def __init__(self):
+        self.wait_seconds = 0.0
+        self.batches = 0
+
+    def wrap(self, batches: Iterable) -> Iterator:
+        iterator = iter(batches)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+                self.wait_seconds += time.perf_counter() - started
+                self.batches += 1
+                yield batch
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()  # dừng thread prefetch khi loop thoát sớm (max_steps)
+
+    def pop(self) -> Tuple[float, int]:
+        result = (self.wait_seconds, self.batches)
+        self.wait_seconds = 0.0
+        self.batches = 0
+        return result
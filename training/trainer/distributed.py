@@ -0,0 +1,129 @@
+"""
+Train nhiều process với DistributedDataParallel (DDP), chạy bằng `torchrun`.
+
+    torchrun --nproc_per_node=2 -m training.trainer.train_lm \\
+        --config training/configs/training_config.json --device cpu
+
+`torchrun` đặt `RANK` / `WORLD_SIZE` / `LOCAL_RANK`; thiếu các biến này thì
+training chạy một process như cũ. Backend lấy từ `training.ddp_backend`
+(mặc định `nccl` trên GPU, `gloo` trên CPU); gloo chạy được cả CPU nên test
+local trên máy không có GPU bằng đúng code dùng cho node nhiều GPU.
+
+Quy ước trong `train_lm`:
+- Dữ liệu: map-style dùng `ResumableRandomSampler(num_replicas, rank)` (cùng
+  hoán vị mỗi epoch, rank `r` lấy `perm[r::W]`); dataset stream chia worker
+  toàn cục `rank * num_workers + worker`. Mỗi rank chạy cùng số batch/epoch.
+- Gradient accumulation: các micro-batch không phải cuối chạy trong
+  `model.no_sync()` → chỉ all-reduce gradient một lần mỗi optimizer step.
+- Chỉ rank 0 in log, ghi `metrics.jsonl` và checkpoint; RNG state của mọi
+  rank được gom vào checkpoint để resume đúng dropout từng rank.
+- Eval: mỗi rank chấm một phần val, tổng loss / số mẫu được all-reduce.
+"""
+
+from __future__ import annotations
+
+import builtins
+import os
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+import torch
+import torch.distributed as dist
+
+from .checkpointing import capture_rng_state, restore_rng_state
+
+
+@dataclass
+class DistInfo:
+    rank: int = 0
+    world_size: int = 1
+    local_rank: int = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.world_size > 1
+
+    @property
+    def is_main(self) -> bool:
+        return self.rank == 0
+
+
+def init_distributed(device_str: str, backend: Optional[str] = None) -> DistInfo:
+    """Khởi tạo process group từ biến môi trường của `torchrun` (không có → một process)."""
+    world_size = int(os.environ.get("WORLD_SIZE", "1"))
+    if world_size <= 1:
+        return DistInfo()
+    info = DistInfo(int(os.environ["RANK"]), world_size, int(os.environ.get("LOCAL_RANK", "0")))
+    use_cuda = torch.device(device_str).type == "cuda"
+    if use_cuda:
+        torch.cuda.set_device(info.local_rank)
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend or ("nccl" if use_cuda else "gloo"))
+    setup_for_distributed(info.is_main)
+    return info
+
+
+_builtin_print: Optional[Callable[..., None]] = None  # `print` gốc, trả lại trong `cleanup_distributed`
+
+
+def setup_for_distributed(is_main: bool) -> None:
+    """Tắt `print` trên rank khác 0 (truyền `force=True` để vẫn in)."""
+    global _builtin_print
+    if _builtin_print is None:
+        _builtin_print = builtins.print
+    builtin_print = _builtin_print
+
+    def print(*args: Any, **kwargs: Any) -> None:
+        force = kwargs.pop("force", False)
+        if is_main or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+def cleanup_distributed() -> None:
+    global _builtin_print
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+    if _builtin_print is not None:
+        builtins.print = _builtin_print
+        _builtin_print = None
+
+
+def all_reduce(tensor: torch.Tensor, op: str = "sum") -> torch.Tensor:
+    """All-reduce tại chỗ (no-op khi chạy một process)."""
+    if dist.is_available() and dist.is_initialized():
+        dist.all_reduce(tensor, op={"sum": dist.ReduceOp.SUM, "min": dist.ReduceOp.MIN}[op])
+    return tensor
+
+
+def broadcast_object(obj: Any, info: DistInfo) -> Any:
+    """Giá trị của rank 0 cho mọi rank (collective, mọi rank phải gọi)."""
+    if not info.enabled:
+        return obj
+    holder = [obj]
+    dist.broadcast_object_list(holder, src=0)
+    return holder[0]
+
+
+def gather_rng_state(info: DistInfo) -> Dict[str, Any]:
+    """RNG state của process này; chạy DDP thì gom của mọi rank (collective, mọi rank phải gọi)."""
+    state = capture_rng_state()
+    if not info.enabled:
+        return state
+    states = [None] * info.world_size
+    dist.all_gather_object(states, state)
+    return {"per_rank": states}
+
+
+def restore_rank_rng_state(state: Optional[Dict[str, Any]], info: DistInfo) -> None:
+    """Khôi phục RNG của đúng rank này từ checkpoint (bỏ qua nếu số rank đã đổi)."""
+    if state and "per_rank" in state:
+        states = state["per_rank"]
+        if len(states) != info.world_size:
+            print(f"⚠️ Checkpoint lưu RNG của {len(states)} rank, hiện có {info.world_size}; giữ RNG mới.")
+            return
+        state = states[info.rank]
+    elif state and info.enabled:
+        print("⚠️ Checkpoint một process: các rank dùng chung RNG state đã lưu.")
+    restore_rng_state(state)
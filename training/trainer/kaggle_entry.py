@@ -1,5 +1,6 @@
 """
-Kaggle runner: pack tokenized JSONL → .pt rồi gọi train_lm.run_training trong một script.
+Kaggle runner: train thẳng từ tokenized JSONL/.bin (pack on-the-fly trong DataLoader worker)
+hoặc, với `--pack`, pack trước thành .bin/.pt rồi gọi train_lm.run_training trong một script.
 
 Mặc định kỳ vọng bạn đã upload gói dữ liệu (tạo bằng prepare_kaggle_bundle.py) lên Kaggle.
 """
@@ -9,16 +10,20 @@ from __future__ import annotations
 import argparse
 import json
 from pathlib import Path
-from typing import Dict, List, Optional
-
-import torch
+from typing import Dict, List, Optional, Sequence, Tuple
 
 try:
     import sentencepiece as spm  # type: ignore
 except ImportError:  # pragma: no cover - optional
     spm = None
 
-from .pack_tokenized_dataset import pack_sequences
+from .pack_tokenized_dataset import (
+    PACKING_MODES,
+    iter_packed_lengths,
+    resolve_length_pairs,
+    save_packed,
+)
+from .token_store import is_token_store
 from .train_lm import run_training
 from .utils import ensure_dir, setup_encoding
 
@@ -39,7 +44,7 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--tokens-dir",
         type=Path,
-        help="Thư mục chứa *_tokens.jsonl (mặc định: <dataset-root>/dataset/tokenized).",
+        help="Thư mục chứa *_tokens.jsonl hoặc *_tokens.bin (mặc định: <dataset-root>/dataset/tokenized).",
     )
     parser.add_argument(
         "--tokenizer-model",
@@ -55,21 +60,56 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--pack-dir",
         type=Path,
-        help="Thư mục lưu .pt (mặc định: <work-dir>/packed_seq_<seq_len>).",
+        help="Thư mục lưu packed .bin/.pt (mặc định: <work-dir>/packed_seq_<seq_len>[_<seq_len>...]).",
     )
     parser.add_argument(
         "--output-dir",
         type=Path,
         help="Thư mục lưu checkpoint (mặc định: <work-dir>/model_output).",
     )
-    parser.add_argument("--seq-len", type=int, default=1024)
-    parser.add_argument("--stride", type=int, default=1024)
+    parser.add_argument(
+        "--seq-len",
+        type=int,
+        nargs="+",
+        default=[1024],
+        help="Một hoặc nhiều context length; mọi length được pack từ một lần đọc tokenized input. "
+        "Training dùng length đầu tiên.",
+    )
+    parser.add_argument(
+        "--stride",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Stride (mặc định = seq_len). Một giá trị dùng chung hoặc một giá trị cho mỗi --seq-len.",
+    )
     parser.add_argument("--drop-remainder", action="store_true")
+    parser.add_argument(
+        "--pack-format",
+        choices=["bin", "pt"],
+        default="bin",
+        help="Định dạng packed output: bin (raw, memory-map khi train) hoặc pt (torch pickle).",
+    )
+    parser.add_argument(
+        "--packing",
+        choices=list(PACKING_MODES),
+        default="stream",
+        help="stream (cắt theo seq_len/stride) hoặc bfd (best-fit, giữ nguyên paragraph).",
+    )
     parser.add_argument("--include-test", action="store_true", help="Pack thêm test split.")
-    parser.add_argument("--skip-pack", action="store_true", help="Bỏ qua bước pack (dùng sẵn .pt).")
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Pack trước train/val thành .bin/.pt trong --pack-dir (mặc định: không pack, "
+        "train pack on-the-fly từ tokenized output nên bước đầu tiên bắt đầu sau vài giây).",
+    )
+    parser.add_argument(
+        "--skip-pack",
+        action="store_true",
+        help="Giữ cho tương thích: không pack (đã là mặc định nếu không có --pack).",
+    )
     parser.add_argument("--skip-train", action="store_true", help="Chỉ pack, không train.")
-    parser.add_argument("--train-bin", type=Path, help="Đường dẫn train .pt nếu skip-pack.")
-    parser.add_argument("--val-bin", type=Path, help="Đường dẫn val .pt nếu skip-pack.")
+    parser.add_argument("--train-bin", type=Path, help="Đường dẫn train .bin/.pt có sẵn (bỏ qua on-the-fly).")
+    parser.add_argument("--val-bin", type=Path, help="Đường dẫn val .bin/.pt có sẵn (bỏ qua on-the-fly).")
     parser.add_argument("--pad-token-id", type=int, help="Override pad token ID.")
     parser.add_argument("--resume", type=Path, help="Checkpoint để resume training.")
     parser.add_argument("--device", type=str, help="Thiết bị ('cuda', 'cpu', ...).")
@@ -102,47 +142,64 @@ def resolve_pad_id(explicit: Optional[int], cfg: Dict, tokenizer_model: Optional
     return 0
 
 
+def resolve_token_file(tokens_dir: Path, split: str) -> Path:
+    """Ưu tiên token store `<split>_tokens.bin` nếu có, ngược lại dùng JSONL."""
+    bin_path = tokens_dir / f"{split}_tokens.bin"
+    if is_token_store(bin_path):
+        return bin_path
+    return tokens_dir / f"{split}_tokens.jsonl"
+
+
 def pack_if_needed(
     split_names: List[str],
     token_files: Dict[str, Path],
     pack_dir: Path,
-    seq_len: int,
-    stride: int,
+    pairs: Sequence[Tuple[int, int]],
     drop_remainder: bool,
     pad_token_id: int,
     show_progress: bool,
-) -> Dict[str, Path]:
+    pack_format: str = "bin",
+    packing: str = "stream",
+) -> Dict[int, Dict[str, Path]]:
+    """Pack mỗi split cho mọi cặp (seq_len, stride); trả về {seq_len: {split: path}}."""
     ensure_dir(pack_dir)
-    produced: Dict[str, Path] = {}
+    if len({seq_len for seq_len, _ in pairs}) != len(pairs):
+        raise ValueError(f"Mỗi seq_len chỉ được một stride (tên file theo seq_len): {list(pairs)}")
+    produced: Dict[int, Dict[str, Path]] = {seq_len: {} for seq_len, _ in pairs}
     for split in split_names:
         input_path = token_files[split]
         if not input_path.exists():
-            raise FileNotFoundError(f"Không tìm thấy tokenized JSONL cho split '{split}': {input_path}")
-        output_path = pack_dir / f"{split}_{seq_len}.pt"
-        print(f"🔁 Packing {split}: {input_path} → {output_path}")
-        tensor, stats = pack_sequences(
+            raise FileNotFoundError(f"Không tìm thấy tokenized file cho split '{split}': {input_path}")
+        print(f"🔁 Packing {split}: {input_path} → {pack_dir} (seq_len={[seq_len for seq_len, _ in pairs]})")
+        results = iter_packed_lengths(
             input_path=input_path,
-            seq_len=seq_len,
-            stride=stride,
+            pairs=pairs,
             drop_remainder=drop_remainder,
             pad_token_id=pad_token_id,
             show_progress=show_progress,
+            packing=packing,
         )
-        meta = {
-            "num_sequences": tensor.size(0),
-            "seq_len": tensor.size(1),
-            "split": split,
-            "pad_token_id": pad_token_id,
-            "stride": stride,
-            "drop_remainder": drop_remainder,
-            **stats,
-        }
-        torch.save({"input_ids": tensor, "meta": meta}, output_path)
-        produced[split] = output_path
-        print(
-            f"✅ {split}: {tensor.size(0):,} sequences | total_tokens={stats['total_input_tokens']:,} "
-            f"| pad_seq={stats['padded_sequences']}"
-        )
+        for seq_len, stride, result in results:
+            output_path = pack_dir / f"{split}_{seq_len}.{pack_format}"
+            stats = result.stats
+            meta = {
+                "num_sequences": result.sequences.shape[0],
+                "seq_len": seq_len,
+                "split": split,
+                "pad_token_id": pad_token_id,
+                "stride": stride,
+                "drop_remainder": drop_remainder,
+                "packing": packing,
+                "source": str(input_path),
+                **stats,
+            }
+            save_packed(output_path, result.sequences, meta, carry=result.carry)
+            produced[seq_len][split] = output_path
+            print(
+                f"✅ {split}@{seq_len}: {result.sequences.shape[0]:,} sequences | "
+                f"total_tokens={stats['total_input_tokens']:,} "
+                f"| pad_seq={stats['padded_sequences']} | fill={stats['fill_ratio']:.2%} → {output_path}"
+            )
     return produced
 
 
@@ -155,14 +212,12 @@ def main() -> None:
     cfg = load_training_config(config_path)
 
     tokens_dir = args.tokens_dir or (dataset_root / "dataset" / "tokenized")
-    token_files = {
-        "train": tokens_dir / "train_tokens.jsonl",
-        "val": tokens_dir / "val_tokens.jsonl",
-        "test": tokens_dir / "test_tokens.jsonl",
-    }
+    token_files = {split: resolve_token_file(tokens_dir, split) for split in ("train", "val", "test")}
     tokenizer_model = args.tokenizer_model or (dataset_root / "tokenizer" / "sp_model.model")
 
-    pack_dir = args.pack_dir or (args.work_dir / f"packed_seq_{args.seq_len}")
+    pairs = resolve_length_pairs(args.seq_len, args.stride)
+    train_seq_len = pairs[0][0]
+    pack_dir = args.pack_dir or (args.work_dir / f"packed_seq_{'_'.join(str(seq_len) for seq_len, _ in pairs)}")
     output_dir = args.output_dir or (args.work_dir / "model_output")
 
     pad_token_id = resolve_pad_id(args.pad_token_id, cfg, tokenizer_model)
@@ -173,27 +228,41 @@ def main() -> None:
         split_names.append("test")
 
     packed_paths: Dict[str, Path] = {}
-    if not args.skip_pack:
-        packed_paths = pack_if_needed(
+    if args.pack and not args.skip_pack:
+        packed_by_len = pack_if_needed(
             split_names=split_names,
             token_files=token_files,
             pack_dir=pack_dir,
-            seq_len=args.seq_len,
-            stride=args.stride,
+            pairs=pairs,
             drop_remainder=args.drop_remainder,
             pad_token_id=pad_token_id,
             show_progress=args.show_progress,
+            pack_format=args.pack_format,
+            packing=args.packing,
         )
-    else:
-        print("⚠️ Skip pack enabled. Sẽ dùng đường dẫn .pt do bạn cung cấp.")
+        packed_paths = packed_by_len[train_seq_len]
+        if len(packed_by_len) > 1:
+            print(f"ℹ️ Train với seq_len={train_seq_len}; các length khác đã lưu trong {pack_dir}.")
 
     train_bin = args.train_bin or packed_paths.get("train")
     val_bin = args.val_bin or packed_paths.get("val")
-    if not train_bin or not val_bin:
-        raise ValueError("Thiếu train_bin/val_bin. Cần pack hoặc truyền --train-bin / --val-bin.")
+    train_tokens = None if train_bin else token_files["train"]
+    val_tokens = None if val_bin else token_files["val"]
+    for split, tokens_path in (("train", train_tokens), ("val", val_tokens)):
+        if tokens_path is None:
+            continue
+        if not tokens_path.exists():
+            raise FileNotFoundError(
+                f"Không tìm thấy tokenized file cho split '{split}': {tokens_path} (hoặc dùng --pack / --{split}-bin)."
+            )
+        print(f"⚡ {split}: pack on-the-fly từ {tokens_path} (seq_len={train_seq_len}, không ghi file packed).")
+    if (train_tokens or val_tokens) and (
+        pairs[0][1] != train_seq_len or args.drop_remainder or args.packing != "stream"
+    ):
+        print("⚠️ Pack on-the-fly chỉ cắt window không overlap và pad window cuối; bỏ qua --stride/--drop-remainder/--packing.")
 
     if args.skip_train:
-        print("⏭️ Đã skip training, chỉ thực hiện pack.")
+        print("⏭️ Đã skip training." + (" Chỉ thực hiện pack." if packed_paths else ""))
         return
 
     run_training(
@@ -204,6 +273,9 @@ def main() -> None:
         resume=args.resume,
         seed=args.seed,
         device_str=args.device,
+        train_tokens_override=train_tokens,
+        val_tokens_override=val_tokens,
+        seq_len_override=train_seq_len,
     )
 
 
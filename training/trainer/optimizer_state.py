@@ -0,0 +1,231 @@
+"""
+Lưu optimizer state (AdamW `exp_avg` / `exp_avg_sq`) ở độ chính xác thấp trong checkpoint.
+
+`training.optimizer_state_dtype`:
+- `fp32` : giữ nguyên (mặc định)
+- `bf16` : cast moment sang bfloat16 (một nửa dung lượng)
+- `int8` : lượng tử hoá theo block `BLOCK_SIZE` phần tử (~1/4 dung lượng)
+    * `exp_avg`    : int8 tuyến tính theo absmax của block (có dấu)
+    * `exp_avg_sq` : mã uint8 trên log2(v) giữa min/max của block; mã 0 = 0.
+      Tuyến tính sẽ làm tròn v nhỏ về 0 → update m/(sqrt(v)+eps) nổ; log giữ
+      sai số tương đối đều trên toàn dải.
+
+Encode chạy trên snapshot CPU (thread ghi nền), decode chạy khi resume trước
+`optimizer.load_state_dict` (optimizer tự cast bf16 về dtype của param, tức fp32).
+
+Công cụ kiểm tra parity: load một checkpoint, ghi lại với từng dtype, resume
+từ mỗi bản rồi train cùng N step trên cùng batch và so sánh loss:
+
+    python -m training.trainer.optimizer_state \\
+        --config training/configs/training_config.json \\
+        --checkpoint training/model/350m_fast/checkpoint_latest.pt --steps 50
+"""
+
+from __future__ import annotations
+
+import argparse
+import copy
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List
+
+import torch
+import torch.nn.functional as F
+
+OPTIMIZER_STATE_DTYPES = ("fp32", "bf16", "int8")
+MOMENT_KEYS = ("exp_avg", "exp_avg_sq")
+BLOCK_SIZE = 256
+QUANT_KEY = "__quant__"
+LOG_LEVELS = 254  # mã 1..255 cho giá trị dương, 0 cho giá trị 0
+
+
+def _blocks(tensor: torch.Tensor) -> torch.Tensor:
+    flat = tensor.reshape(-1).float()
+    return F.pad(flat, (0, (-flat.numel()) % BLOCK_SIZE)).view(-1, BLOCK_SIZE)
+
+
+def _unblock(blocks: torch.Tensor, shape: List[int]) -> torch.Tensor:
+    numel = 1
+    for dim in shape:
+        numel *= dim
+    return blocks.reshape(-1)[:numel].view(shape)
+
+
+def quantize_signed(tensor: torch.Tensor) -> Dict[str, Any]:
+    blocks = _blocks(tensor)
+    absmax = blocks.abs().amax(dim=1)
+    scale = torch.where(absmax > 0, absmax, torch.ones_like(absmax)) / 127.0
+    q = torch.round(blocks / scale[:, None]).clamp_(-127, 127).to(torch.int8)
+    return {QUANT_KEY: "int8_absmax", "q": q, "absmax": absmax, "shape": list(tensor.shape)}
+
+
+def dequantize_signed(entry: Dict[str, Any]) -> torch.Tensor:
+    absmax = entry["absmax"].float()
+    scale = torch.where(absmax > 0, absmax, torch.ones_like(absmax)) / 127.0
+    return _unblock(entry["q"].float() * scale[:, None], entry["shape"])
+
+
+def quantize_log(tensor: torch.Tensor) -> Dict[str, Any]:
+    blocks = _blocks(tensor)
+    positive = blocks > 0
+    log_v = torch.log2(torch.where(positive, blocks, torch.ones_like(blocks)))
+    lo = torch.where(positive, log_v, torch.full_like(log_v, float("inf"))).amin(dim=1)
+    hi = torch.where(positive, log_v, torch.full_like(log_v, float("-inf"))).amax(dim=1)
+    empty = ~positive.any(dim=1)
+    lo = torch.where(empty, torch.zeros_like(lo), lo)
+    span = torch.where(empty, torch.zeros_like(hi), hi - lo)
+    level = torch.round((log_v - lo[:, None]) / span.clamp_min(1e-12)[:, None] * LOG_LEVELS)
+    q = torch.where(positive, 1 + level.clamp_(0, LOG_LEVELS), torch.zeros_like(level)).to(torch.uint8)
+    return {QUANT_KEY: "uint8_log2", "q": q, "lo": lo, "span": span, "shape": list(tensor.shape)}
+
+
+def dequantize_log(entry: Dict[str, Any]) -> torch.Tensor:
+    q = entry["q"].float()
+    log_v = entry["lo"].float()[:, None] + (q - 1) / LOG_LEVELS * entry["span"].float()[:, None]
+    return _unblock(torch.where(q > 0, torch.exp2(log_v), torch.zeros_like(q)), entry["shape"])
+
+
+def encode_optimizer_state(state_dict: Dict[str, Any], dtype: str) -> Dict[str, Any]:
+    """Trả về optimizer state_dict với moment đã nén theo `dtype` (không sửa bản gốc)."""
+    if dtype not in OPTIMIZER_STATE_DTYPES:
+        raise ValueError(f"optimizer_state_dtype phải là một trong {OPTIMIZER_STATE_DTYPES}, nhận {dtype!r}")
+    if dtype == "fp32":
+        return state_dict
+    encoded_state = {}
+    for idx, param_state in state_dict["state"].items():
+        encoded = dict(param_state)
+        for key in MOMENT_KEYS:
+            value = encoded.get(key)
+            if not isinstance(value, torch.Tensor) or not value.is_floating_point():
+                continue
+            if dtype == "bf16":
+                encoded[key] = value.to(torch.bfloat16)
+            elif key == "exp_avg_sq":
+                encoded[key] = quantize_log(value)
+            else:
+                encoded[key] = quantize_signed(value)
+        encoded_state[idx] = encoded
+    return {**state_dict, "state": encoded_state}
+
+
+def decode_optimizer_state(state_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """Giải nén moment int8 tại chỗ (bf16 để optimizer tự cast về dtype của param)."""
+    for param_state in state_dict.get("state", {}).values():
+        for key, value in param_state.items():
+            if isinstance(value, dict) and QUANT_KEY in value:
+                kind = value[QUANT_KEY]
+                param_state[key] = dequantize_log(value) if kind == "uint8_log2" else dequantize_signed(value)
+    return state_dict
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Kiểm tra loss parity khi resume với optimizer state nén")
+    parser.add_argument("--config", type=Path, required=True, help="File config training (JSON)")
+    parser.add_argument("--checkpoint", type=Path, required=True, help="Checkpoint gốc (.pt hoặc thư mục sharded)")
+    parser.add_argument("--data", type=Path, default=None, help="Packed .bin/.pt để lấy batch (mặc định paths.train_bin)")
+    parser.add_argument("--steps", type=int, default=20, help="Số optimizer step train sau khi resume")
+    parser.add_argument(
+        "--dtypes", nargs="+", default=list(OPTIMIZER_STATE_DTYPES), choices=OPTIMIZER_STATE_DTYPES
+    )
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+def main() -> None:
+    from torch.utils.data import DataLoader
+    from transformers import get_linear_schedule_with_warmup
+
+    from .checkpointing import (
+        SHARDED_FORMAT,
+        StateSnapshotter,
+        build_payload,
+        is_sharded_checkpoint,
+        load_checkpoint,
+        write_checkpoint,
+    )
+    from .train_lm import build_model, collate_token_rows, lm_inputs, load_config, load_packed_dataset
+    from .utils import setup_encoding
+
+    setup_encoding()
+    args = parse_args()
+    config = load_config(args.config)
+    model_cfg, train_cfg = config.get("model", {}), config.get("training", {})
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    pad_token_id = train_cfg.get("pad_token_id", 0)
+    grad_accum = train_cfg.get("gradient_accumulation_steps", 1)
+    clip_norm = train_cfg.get("clip_grad_norm", 1.0)
+    data_path = args.data or Path(config.get("paths", {}).get("train_bin", "train.pt"))
+
+    loader = DataLoader(
+        load_packed_dataset(data_path, pad_token_id=pad_token_id),
+        batch_size=train_cfg.get("micro_batch_size", 1),
+        shuffle=False,
+        collate_fn=collate_token_rows,
+    )
+    batches = []
+    for batch in loader:
+        batches.append(batch["input_ids"])
+        if len(batches) == args.steps * grad_accum:
+            break
+
+    def fresh():
+        model = build_model(model_cfg).to(device)
+        optimizer = torch.optim.AdamW(
+            model.parameters(),
+            lr=train_cfg.get("learning_rate", 3e-4),
+            weight_decay=train_cfg.get("weight_decay", 0.1),
+            betas=(0.9, 0.95),
+        )
+        scheduler = get_linear_schedule_with_warmup(
+            optimizer,
+            num_warmup_steps=train_cfg.get("warmup_steps", 1000),
+            num_training_steps=train_cfg.get("max_steps") or 10**9,
+        )
+        return model, optimizer, scheduler
+
+    model, optimizer, scheduler = fresh()
+    source = load_checkpoint(args.checkpoint, model, optimizer, scheduler)
+    payload = StateSnapshotter().snapshot(build_payload(model, optimizer, scheduler, source.get("step", 0)))
+    fmt = SHARDED_FORMAT if is_sharded_checkpoint(args.checkpoint) else "pt"
+
+    work_dir = Path(tempfile.mkdtemp(prefix="optim_parity_"))
+    curves: Dict[str, List[float]] = {}
+    sizes: Dict[str, int] = {}
+    try:
+        for dtype in args.dtypes:
+            path = write_checkpoint(work_dir, dtype, copy.deepcopy(payload), fmt=fmt, optimizer_state_dtype=dtype)
+            files = path.rglob("*") if path.is_dir() else [path]
+            sizes[dtype] = sum(f.stat().st_size for f in files if f.is_file())
+            model, optimizer, scheduler = fresh()
+            load_checkpoint(path, model, optimizer, scheduler)
+            torch.manual_seed(args.seed)
+            model.train()
+            losses = []
+            for i, input_ids in enumerate(batches):
+                loss = model(**lm_inputs(input_ids.to(device), pad_token_id)).loss / grad_accum
+                loss.backward()
+                if (i + 1) % grad_accum == 0:
+                    if clip_norm:
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), clip_norm)
+                    optimizer.step()
+                    scheduler.step()
+                    optimizer.zero_grad()
+                    losses.append(loss.item() * grad_accum)
+            curves[dtype] = losses
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    reference = curves.get("fp32")
+    print(f"📊 Loss sau resume ({len(batches) // grad_accum} step, checkpoint step {source.get('step')}):")
+    for dtype, losses in curves.items():
+        line = f"  {dtype:>5}: size={sizes[dtype] / 1024 ** 2:.1f}MB final_loss={losses[-1]:.4f}" if losses else f"  {dtype:>5}:"
+        if reference and dtype != "fp32" and losses:
+            diffs = [abs(a - b) for a, b in zip(losses, reference)]
+            line += f" max|Δloss|={max(diffs):.4f} mean|Δloss|={sum(diffs) / len(diffs):.4f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
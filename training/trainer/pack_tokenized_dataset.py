@@ -1,25 +1,50 @@
 """
-Pack tokenized JSONL paragraphs thành fixed-length sequence tensors (.pt).
+Pack tokenized paragraphs (JSONL hoặc token store .bin) thành fixed-length sequence tensors.
 
 Sử dụng khi chuẩn bị dữ liệu cho training loop trên Kaggle (hoặc môi trường GPU).
+Output `.pt` là pickle `{"input_ids": LongTensor, "meta": ...}`; output `.bin`
+là packed store raw (uint16/int32 + meta JSON, xem packed_store.py) để trainer
+memory-map thay vì load toàn bộ vào RAM.
 
 Ví dụ:
     python -m training.trainer.pack_tokenized_dataset \
         --input training/dataset/tokenized/train_tokens.jsonl \
-        --output training/dataset/tokenized/train_1024.pt \
+        --output training/dataset/tokenized/train_1024.bin \
         --seq-len 1024 \
         --stride 1024 \
         --show-progress
+
+Nhiều context length từ một lần đọc input (token stream dùng chung):
+    python -m training.trainer.pack_tokenized_dataset \
+        --input training/dataset/tokenized/train_tokens.jsonl \
+        --output "training/dataset/tokenized/train_{seq_len}.bin" \
+        --seq-len 512 1024 2048
+
+Nối dữ liệu mới vào store có sẵn (chỉ tốn O(dữ liệu mới), remainder lần
+trước được dùng tiếp thay vì padding):
+    python -m training.trainer.pack_tokenized_dataset \
+        --input training/dataset/tokenized/new_novels_tokens.jsonl \
+        --output training/dataset/tokenized/train_1024.bin \
+        --append
+
+Với stride < seq_len, `--layout stream` chỉ ghi token stream một lần và để
+trainer cắt window lúc sample (SlidingWindowDataset), thay vì materialize
+seq_len / stride lần dữ liệu.
 """
 
 from __future__ import annotations
 
 import argparse
 import json
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
+import numpy as np
 import torch
+from numpy.lib.stride_tricks import sliding_window_view
 from tqdm import tqdm
 
 try:
@@ -27,36 +52,59 @@ try:
 except ImportError:  # pragma: no cover - optional dependency
     spm = None
 
+from .packed_store import (
+    PACKED_STREAM_FORMAT,
+    append_packed_rows,
+    append_packed_stream,
+    is_packed_bin,
+    read_packed_carry,
+    read_packed_meta,
+    write_packed_bin,
+    write_packed_carry,
+    write_packed_meta,
+    write_packed_stream,
+)
+from .token_store import TokenStore, is_token_store
 from .utils import ensure_dir, setup_encoding
 
 
+PACKING_MODES = ("stream", "bfd")
+OUTPUT_LAYOUTS = ("rows", "stream")
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
-        description="Pack tokenized JSONL vào fixed-length tensor (.pt)."
+        description="Pack tokenized JSONL/.bin vào fixed-length sequences (.pt hoặc .bin)."
     )
     parser.add_argument(
         "--input",
         type=Path,
         required=True,
-        help="Đường dẫn JSONL chứa token IDs (từ tokenize_dataset.py).",
+        help="Đường dẫn JSONL hoặc token store .bin chứa token IDs (từ tokenize_dataset.py).",
     )
     parser.add_argument(
         "--output",
         type=Path,
         required=True,
-        help="Đường dẫn file .pt sẽ lưu tensor packed sequences.",
+        help="File output: .pt (torch pickle) hoặc .bin (raw + meta JSON, memory-map được). "
+        "Khi truyền nhiều --seq-len, dùng placeholder {seq_len} (và {stride} nếu cần), "
+        "vd. train_{seq_len}.bin.",
     )
     parser.add_argument(
         "--seq-len",
         type=int,
-        default=1024,
-        help="Chiều dài sequence cố định (mặc định: 1024).",
+        nargs="+",
+        default=[1024],
+        help="Chiều dài sequence cố định (mặc định: 1024). Truyền nhiều giá trị để pack "
+        "tất cả từ một lần đọc input.",
     )
     parser.add_argument(
         "--stride",
         type=int,
-        default=1024,
-        help="Số token dịch mỗi lần cắt (mặc định = seq_len, tức là không overlap).",
+        nargs="+",
+        default=None,
+        help="Số token dịch mỗi lần cắt (mặc định = seq_len, tức là không overlap). "
+        "Một giá trị dùng chung, hoặc một giá trị cho mỗi --seq-len.",
     )
     parser.add_argument(
         "--drop-remainder",
@@ -76,6 +124,40 @@ def parse_args() -> argparse.Namespace:
         default=None,
         help="Đường dẫn SentencePiece .model (nếu muốn auto lấy pad_id).",
     )
+    parser.add_argument(
+        "--packing",
+        choices=list(PACKING_MODES),
+        default="stream",
+        help="stream: nối paragraph thành một dòng rồi cắt theo seq_len/stride (mặc định). "
+        "bfd: best-fit-decreasing, xếp nguyên paragraph vào sequence để giảm padding.",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=list(OUTPUT_LAYOUTS),
+        default="rows",
+        help="rows: ghi ma trận [N, seq_len] (mặc định). stream: chỉ ghi token stream phẳng "
+        "+ meta window, trainer cắt window i = stream[i*stride : i*stride+seq_len] khi đọc "
+        "(cần output .bin, hợp với --stride < --seq-len).",
+    )
+    parser.add_argument(
+        "--eos-token-id",
+        type=int,
+        default=None,
+        help="(bfd) Chèn EOS sau mỗi paragraph làm separator. Nếu không truyền nhưng có "
+        "--add-eos thì lấy eos_id từ --tokenizer-model.",
+    )
+    parser.add_argument(
+        "--add-eos",
+        action="store_true",
+        help="(bfd) Bật EOS separator, lấy eos_id từ tokenizer nếu không có --eos-token-id.",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Nối --input (dữ liệu mới) vào packed store .bin có sẵn ở --output: dùng tiếp "
+        "remainder của lần pack trước thay vì padding, cập nhật meta + segment manifest. "
+        "seq_len/stride/pad lấy từ meta của store.",
+    )
     parser.add_argument(
         "--show-progress",
         action="store_true",
@@ -84,37 +166,30 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def pack_sequences(
+def iter_token_ids(
     input_path: Path,
-    seq_len: int,
-    stride: int,
-    drop_remainder: bool,
-    pad_token_id: int,
+    stats: Dict[str, int],
     show_progress: bool,
-) -> Tuple[torch.Tensor, Dict[str, int]]:
-    """Đọc JSONL token IDs và pack thành tensor cố định."""
-    if stride <= 0:
-        print(f"⚠️ stride={stride} không hợp lệ. Auto set = seq_len ({seq_len}).")
-        stride = seq_len
-    if stride > seq_len:
-        stride = seq_len
-    elif stride < seq_len:
-        print(
-            f"⚠️ stride ({stride}) < seq_len ({seq_len}). "
-            "Bạn đang bật chế độ sliding window (overlap)."
-        )
-
-    stats = {
-        "total_input_tokens": 0,
-        "total_output_sequences": 0,
-        "invalid_records": 0,
-        "empty_records": 0,
-        "padded_sequences": 0,
-        "dropped_tokens": 0,
-    }
+    worker_id: int = 0,
+    num_workers: int = 1,
+) -> Iterator[List[int]]:
+    """Yield token IDs của từng paragraph hợp lệ từ JSONL hoặc token store (.bin).
 
-    sequences: List[List[int]] = []
-    buffer: List[int] = []
+    `worker_id`/`num_workers` chỉ lấy paragraph (hoặc dòng JSONL) thứ
+    `worker_id::num_workers`; dòng của worker khác không bị parse.
+    """
+    if is_token_store(input_path):
+        store = TokenStore(input_path)
+        indices: Iterable[int] = range(worker_id, len(store), num_workers)
+        if show_progress:
+            indices = tqdm(indices, total=len(indices), desc=f"Packing {input_path.name}")
+        for idx in indices:
+            token_ids = store[idx]
+            if token_ids.size == 0:
+                stats["empty_records"] += 1
+                continue
+            yield token_ids.tolist()
+        return
 
     open_kwargs = {"encoding": "utf-8"}
 
@@ -129,8 +204,8 @@ def pack_sequences(
             line_count = sum(1 for _ in f)
         iterator = tqdm(iter_lines(), total=line_count, desc=f"Packing {input_path.name}")
 
-    for line in iterator:
-        if not line.strip():
+    for line_index, line in enumerate(iterator):
+        if line_index % num_workers != worker_id or not line.strip():
             continue
         record = json.loads(line)
         token_ids = record.get("input_ids")
@@ -146,31 +221,671 @@ def pack_sequences(
         if not all(isinstance(tid, int) for tid in token_ids):
             stats["invalid_records"] += 1
             continue
+        yield token_ids
+
+
+def new_pack_stats() -> Dict[str, float]:
+    return {
+        "total_input_tokens": 0,
+        "total_output_sequences": 0,
+        "invalid_records": 0,
+        "empty_records": 0,
+        "padded_sequences": 0,
+        "dropped_tokens": 0,
+        "padding_tokens": 0,
+        "fill_ratio": 0.0,
+    }
 
-        stats["total_input_tokens"] += len(token_ids)
-        buffer.extend(token_ids)
-        while len(buffer) >= seq_len:
-            chunk = buffer[:seq_len]
-            sequences.append(chunk)
-            buffer = buffer[stride:]
 
-    if buffer and not drop_remainder:
-        if len(buffer) < max(8, seq_len // 8):
+def resolve_stride(seq_len: int, stride: int) -> int:
+    """Chuẩn hoá stride về khoảng (0, seq_len] và cảnh báo khi bật sliding window."""
+    if stride <= 0:
+        print(f"⚠️ stride={stride} không hợp lệ. Auto set = seq_len ({seq_len}).")
+        stride = seq_len
+    if stride > seq_len:
+        stride = seq_len
+    elif stride < seq_len:
+        print(
+            f"⚠️ stride ({stride}) < seq_len ({seq_len}). "
+            "Bạn đang bật chế độ sliding window (overlap)."
+        )
+    return stride
+
+
+def stream_dtype(max_token_id: int, min_token_id: int = 0) -> np.dtype:
+    """uint16 nếu mọi token (kể cả pad) vừa 16 bit, ngược lại int32."""
+    if min_token_id >= 0 and max_token_id <= np.iinfo(np.uint16).max:
+        return np.dtype(np.uint16)
+    return np.dtype(np.int32)
+
+
+def resolve_length_pairs(
+    seq_lens: Sequence[int],
+    strides: Optional[Sequence[int]],
+) -> List[Tuple[int, int]]:
+    """Ghép --seq-len với --stride: None → stride = seq_len, một stride dùng chung, hoặc từng cặp."""
+    if not seq_lens:
+        raise ValueError("Cần ít nhất một --seq-len.")
+    if strides is None:
+        strides = list(seq_lens)
+    elif len(strides) == 1:
+        strides = list(strides) * len(seq_lens)
+    elif len(strides) != len(seq_lens):
+        raise ValueError(
+            f"--stride cần 1 giá trị hoặc {len(seq_lens)} giá trị (theo --seq-len), nhận {len(strides)}."
+        )
+    pairs = list(zip(seq_lens, strides))
+    if len(set(pairs)) != len(pairs):
+        raise ValueError(f"Cặp seq_len/stride bị trùng: {pairs}")
+    return pairs
+
+
+def pair_output_path(template: Path, seq_len: int, stride: int, num_pairs: int) -> Path:
+    """Điền {seq_len}/{stride} vào output template (bắt buộc khi pack nhiều length)."""
+    text = str(template)
+    if "{seq_len}" not in text and "{stride}" not in text:
+        if num_pairs > 1:
+            raise ValueError("Pack nhiều --seq-len cần --output chứa placeholder {seq_len}.")
+        return template
+    return Path(text.format(seq_len=seq_len, stride=stride))
+
+
+def count_windows(total_tokens: int, seq_len: int, stride: int) -> Tuple[int, int]:
+    """Số window đầy đủ và số token còn lại trong buffer khi cắt stream theo stride.
+
+    Tương đương vòng lặp `while len(buffer) >= seq_len: emit; buffer = buffer[stride:]`.
+    """
+    if total_tokens < seq_len:
+        return 0, total_tokens
+    num_full = (total_tokens - seq_len) // stride + 1
+    return num_full, total_tokens - num_full * stride
+
+
+@dataclass
+class PackResult:
+    sequences: np.ndarray
+    stats: Dict[str, int]
+    peak_bytes: int
+    carry: Optional[np.ndarray] = None  # token dư chưa pad (packing=stream), dùng khi append
+    stride: Optional[int] = None  # stride thực tế sau `resolve_stride` (packing=stream)
+
+
+@dataclass
+class StreamScan:
+    """Kết quả pass 1: tổng số token hợp lệ, token ID lớn nhất và độ dài paragraph."""
+
+    store: Optional[TokenStore]
+    total_tokens: int
+    max_token_id: int
+    lengths: np.ndarray
+
+
+def scan_token_stream(input_path: Path, stats: Dict[str, int], show_progress: bool) -> StreamScan:
+    """Pass 1: đếm token hợp lệ (token store: đọc thẳng từ offsets)."""
+    if is_token_store(input_path):
+        store = TokenStore(input_path)
+        stats["empty_records"] = int((store.lengths() == 0).sum())
+        max_token_id = int(store.tokens.max()) if store.num_tokens else 0
+        lengths = store.lengths()
+        scan = StreamScan(
+            store=store,
+            total_tokens=store.num_tokens,
+            max_token_id=max_token_id,
+            lengths=lengths[lengths > 0],
+        )
+    else:
+        collected = array("q")
+        max_token_id = 0
+        for token_ids in iter_token_ids(input_path, stats, show_progress):
+            collected.append(len(token_ids))
+            max_token_id = max(max_token_id, max(token_ids))
+        lengths = np.frombuffer(collected, dtype=np.int64) if collected else np.empty(0, dtype=np.int64)
+        scan = StreamScan(
+            store=None,
+            total_tokens=int(lengths.sum()),
+            max_token_id=max_token_id,
+            lengths=lengths,
+        )
+    stats["total_input_tokens"] = scan.total_tokens
+    return scan
+
+
+def fill_token_stream(input_path: Path, out: np.ndarray, show_progress: bool) -> None:
+    """Pass 2: ghi token của mọi paragraph hợp lệ liên tiếp vào `out`."""
+    position = 0
+    for token_ids in iter_token_ids(input_path, new_pack_stats(), show_progress):
+        out[position:position + len(token_ids)] = token_ids
+        position += len(token_ids)
+
+
+def build_token_stream(
+    input_path: Path,
+    pad_token_id: int,
+    stats: Dict[str, int],
+    show_progress: bool,
+) -> Tuple[np.ndarray, StreamScan]:
+    """Token stream phẳng của input: memmap với token store, mảng cấp phát sẵn với JSONL."""
+    scan = scan_token_stream(input_path, stats, show_progress)
+    if scan.store is not None:
+        return scan.store.tokens, scan
+    dtype = stream_dtype(max(scan.max_token_id, pad_token_id), min_token_id=min(pad_token_id, 0))
+    stream = np.empty(scan.total_tokens, dtype=dtype)
+    fill_token_stream(input_path, stream, show_progress)
+    return stream, scan
+
+
+def plan_windows(
+    total_tokens: int,
+    seq_len: int,
+    stride: int,
+    drop_remainder: bool,
+    stats: Dict[str, int],
+) -> Tuple[int, int, bool]:
+    """Tính số window, remainder và cập nhật stats (padding/dropped/fill_ratio)."""
+    num_full, remainder = count_windows(total_tokens, seq_len, stride)
+    keep_remainder = remainder > 0 and not drop_remainder
+    num_rows = num_full + int(keep_remainder)
+    if num_rows == 0:
+        raise ValueError("Không tạo được sequence nào. Kiểm tra seq_len/stride hoặc dữ liệu đầu vào.")
+
+    if keep_remainder:
+        if remainder < max(8, seq_len // 8):
             print(
-                f"⚠️ Remainder nhỏ ({len(buffer)} tokens). Padding gần full sequence có thể gây nhiễu."
+                f"⚠️ Remainder nhỏ ({remainder} tokens). Padding gần full sequence có thể gây nhiễu."
             )
-        padded = buffer + [pad_token_id] * (seq_len - len(buffer))
-        sequences.append(padded[:seq_len])
         stats["padded_sequences"] += 1
-    elif buffer and drop_remainder:
-        stats["dropped_tokens"] += len(buffer)
+        stats["padding_tokens"] = seq_len - remainder
+    elif remainder:
+        stats["dropped_tokens"] += remainder
+
+    stats["total_output_sequences"] = num_rows
+    stats["fill_ratio"] = 1.0 - stats["padding_tokens"] / (num_rows * seq_len)
+    return num_full, remainder, keep_remainder
+
+
+def window_sequences(
+    stream: np.ndarray,
+    out: np.ndarray,
+    num_full: int,
+    remainder: int,
+    keep_remainder: bool,
+    stride: int,
+    pad_token_id: int,
+) -> None:
+    """Ghi các window [i*stride, i*stride + seq_len) (và remainder đã pad) vào `out`."""
+    seq_len = out.shape[1]
+    if num_full:
+        out[:num_full] = sliding_window_view(stream, seq_len)[::stride][:num_full]
+    if keep_remainder:
+        last = out[num_full]
+        last[:remainder] = stream[stream.shape[0] - remainder:]
+        last[remainder:] = pad_token_id
+
 
-    if not sequences:
+def pack_sequences_array(
+    input_path: Path,
+    seq_len: int,
+    stride: int,
+    drop_remainder: bool,
+    pad_token_id: int,
+    show_progress: bool,
+    packing: str = "stream",
+    eos_token_id: Optional[int] = None,
+) -> PackResult:
+    """Pack hai pass vào mảng numpy cấp phát sẵn (uint16/int32).
+
+    Pass 1 đếm token hợp lệ (token store: đọc thẳng từ offsets), pass 2 ghi
+    token vào buffer phẳng rồi cắt window bằng `sliding_window_view`. Khi
+    stride == seq_len, stream được ghi thẳng vào buffer output nên peak memory
+    chỉ bằng kích thước output. `packing="bfd"` chuyển sang `pack_best_fit`.
+    """
+    if packing not in PACKING_MODES:
+        raise ValueError(f"packing phải là một trong {PACKING_MODES}, nhận {packing!r}")
+    if packing == "bfd":
+        if stride != seq_len or drop_remainder:
+            print("⚠️ packing=bfd bỏ qua --stride/--drop-remainder (không cắt theo stream).")
+        return pack_best_fit(input_path, seq_len, pad_token_id, eos_token_id, show_progress)
+
+    stride = resolve_stride(seq_len, stride)
+    stats = new_pack_stats()
+    scan = scan_token_stream(input_path, stats, show_progress)
+    total_tokens = scan.total_tokens
+    num_full, remainder, keep_remainder = plan_windows(total_tokens, seq_len, stride, drop_remainder, stats)
+    num_rows = num_full + int(keep_remainder)
+
+    dtype = stream_dtype(max(scan.max_token_id, pad_token_id), min_token_id=min(pad_token_id, 0))
+    if scan.store is None and stride == seq_len:
+        # Window không overlap: ghi stream thẳng vào buffer output, reshape là xong.
+        output_buffer = np.empty(max(total_tokens, num_rows * seq_len), dtype=dtype)
+        fill_token_stream(input_path, output_buffer, show_progress)
+        carry = output_buffer[num_full * seq_len:total_tokens].copy()
+        sequences = output_buffer[: num_rows * seq_len].reshape(num_rows, seq_len)
+        if keep_remainder:
+            sequences[num_full, remainder:] = pad_token_id
+        return PackResult(
+            sequences=sequences, stats=stats, peak_bytes=output_buffer.nbytes, carry=carry, stride=stride
+        )
+
+    sequences = np.empty((num_rows, seq_len), dtype=dtype)
+    if scan.store is not None:
+        stream = scan.store.tokens
+        peak_bytes = sequences.nbytes
+    else:
+        stream = np.empty(total_tokens, dtype=dtype)
+        fill_token_stream(input_path, stream, show_progress)
+        peak_bytes = stream.nbytes + sequences.nbytes
+    window_sequences(stream, sequences, num_full, remainder, keep_remainder, stride, pad_token_id)
+    carry = np.array(stream[num_full * stride:])
+    return PackResult(sequences=sequences, stats=stats, peak_bytes=peak_bytes, carry=carry, stride=stride)
+
+
+def iter_packed_lengths(
+    input_path: Path,
+    pairs: Sequence[Tuple[int, int]],
+    drop_remainder: bool,
+    pad_token_id: int,
+    show_progress: bool,
+    packing: str = "stream",
+    eos_token_id: Optional[int] = None,
+) -> Iterator[Tuple[int, int, PackResult]]:
+    """Pack nhiều cặp (seq_len, stride) từ một lần parse input, yield lần lượt từng output.
+
+    Token stream (và độ dài paragraph cho bfd) được dựng một lần rồi dùng chung
+    cho mọi cặp; mỗi output chỉ tốn thêm mảng sequences của chính nó, nên
+    caller nên ghi xong output trước khi lấy output kế tiếp. Một cặp duy nhất
+    đi thẳng qua `pack_sequences_array` (giữ nhánh ghi in-place).
+    """
+    if packing not in PACKING_MODES:
+        raise ValueError(f"packing phải là một trong {PACKING_MODES}, nhận {packing!r}")
+    if len(pairs) == 1:
+        seq_len, stride = pairs[0]
+        result = pack_sequences_array(
+            input_path=input_path,
+            seq_len=seq_len,
+            stride=stride,
+            drop_remainder=drop_remainder,
+            pad_token_id=pad_token_id,
+            show_progress=show_progress,
+            packing=packing,
+            eos_token_id=eos_token_id,
+        )
+        yield seq_len, result.stride or seq_len, result
+        return
+
+    base_stats = new_pack_stats()
+    stream, scan = build_token_stream(input_path, pad_token_id, base_stats, show_progress)
+    stream_bytes = 0 if scan.store is not None else stream.nbytes
+
+    if packing == "bfd":
+        if any(stride != seq_len for seq_len, stride in pairs) or drop_remainder:
+            print("⚠️ packing=bfd bỏ qua --stride/--drop-remainder (không cắt theo stream).")
+        offsets = np.concatenate(([0], np.cumsum(scan.lengths)))
+        for seq_len, _ in pairs:
+            records = (stream[offsets[i]:offsets[i + 1]] for i in range(scan.lengths.size))
+            result = best_fit_pack_records(
+                records, scan.lengths, scan.max_token_id, seq_len, pad_token_id, eos_token_id, dict(base_stats)
+            )
+            result.peak_bytes += stream_bytes
+            yield seq_len, seq_len, result
+        return
+
+    dtype = stream_dtype(max(scan.max_token_id, pad_token_id), min_token_id=min(pad_token_id, 0))
+    for seq_len, stride in pairs:
+        stride = resolve_stride(seq_len, stride)
+        stats = dict(base_stats)
+        num_full, remainder, keep_remainder = plan_windows(stream.shape[0], seq_len, stride, drop_remainder, stats)
+        sequences = np.empty((num_full + int(keep_remainder), seq_len), dtype=dtype)
+        window_sequences(stream, sequences, num_full, remainder, keep_remainder, stride, pad_token_id)
+        yield seq_len, stride, PackResult(
+            sequences=sequences,
+            stats=stats,
+            peak_bytes=stream_bytes + sequences.nbytes,
+            carry=np.array(stream[num_full * stride:]),
+            stride=stride,
+        )
+
+
+def pack_stream_layout(
+    input_path: Path,
+    pairs: Sequence[Tuple[int, int]],
+    drop_remainder: bool,
+    pad_token_id: int,
+    show_progress: bool,
+) -> Tuple[np.ndarray, List[Tuple[int, int, Dict[str, int]]]]:
+    """Layout stream: trả về token stream phẳng + (seq_len, stride, stats) cho từng cặp.
+
+    Không materialize window; số window/stats giống hệt `pack_sequences_array`
+    với cùng tham số.
+    """
+    base_stats = new_pack_stats()
+    stream, _ = build_token_stream(input_path, pad_token_id, base_stats, show_progress)
+    planned = []
+    for seq_len, stride in pairs:
+        stride = resolve_stride(seq_len, stride)
+        stats = dict(base_stats)
+        plan_windows(stream.shape[0], seq_len, stride, drop_remainder, stats)
+        planned.append((seq_len, stride, stats))
+    return stream, planned
+
+
+class _CapacityIndex:
+    """Fenwick tree đếm số sequence theo dung lượng còn trống (1..capacity).
+
+    Cho phép tìm sequence có chỗ trống nhỏ nhất >= size trong O(log capacity).
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.tree = [0] * (capacity + 1)
+        self.total = 0
+        self.top_bit = 1 << (capacity.bit_length() - 1)
+
+    def add(self, index: int, delta: int) -> None:
+        self.total += delta
+        while index <= self.capacity:
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index: int) -> int:
+        result = 0
+        while index > 0:
+            result += self.tree[index]
+            index -= index & -index
+        return result
+
+    def smallest_at_least(self, size: int) -> int:
+        """Dung lượng trống nhỏ nhất >= size đang có sequence, hoặc 0 nếu không có."""
+        rank = self.prefix(size - 1) + 1
+        if rank > self.total:
+            return 0
+        position = 0
+        step = self.top_bit
+        while step:
+            nxt = position + step
+            if nxt <= self.capacity and self.tree[nxt] < rank:
+                position = nxt
+                rank -= self.tree[nxt]
+            step >>= 1
+        return position + 1
+
+
+def best_fit_decreasing(sizes: np.ndarray, capacity: int) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Xếp item (kích thước <= capacity) vào bin theo best-fit-decreasing.
+
+    Trả về (bin của từng item, offset trong bin, số bin).
+    """
+    bin_of = np.empty(sizes.size, dtype=np.int64)
+    offset_of = np.empty(sizes.size, dtype=np.int64)
+    index = _CapacityIndex(capacity)
+    bins_by_space: List[List[int]] = [[] for _ in range(capacity + 1)]
+    num_bins = 0
+    for item in np.argsort(-sizes, kind="stable").tolist():
+        size = int(sizes[item])
+        space = index.smallest_at_least(size)
+        if space:
+            target = bins_by_space[space].pop()
+            index.add(space, -1)
+        else:
+            target = num_bins
+            num_bins += 1
+            space = capacity
+        bin_of[item] = target
+        offset_of[item] = capacity - space
+        space -= size
+        if space:
+            bins_by_space[space].append(target)
+            index.add(space, 1)
+    return bin_of, offset_of, num_bins
+
+
+def pack_best_fit(
+    input_path: Path,
+    seq_len: int,
+    pad_token_id: int,
+    eos_token_id: Optional[int],
+    show_progress: bool,
+) -> PackResult:
+    """Pack nguyên paragraph vào sequence bằng best-fit-decreasing.
+
+    Paragraph (kèm EOS nếu bật) chỉ bị cắt khi dài hơn seq_len: các đoạn đủ
+    seq_len thành sequence riêng, phần dư được xếp như một paragraph ngắn.
+    Pass 1 chỉ cần độ dài paragraph để tính vị trí, pass 2 ghi token thẳng
+    vào mảng output cấp phát sẵn.
+    """
+    stats = new_pack_stats()
+    scan = scan_token_stream(input_path, stats, show_progress)
+    if scan.store is not None:
+        records: Iterable = (scan.store[idx] for idx in np.flatnonzero(scan.store.lengths() > 0))
+    else:
+        records = iter_token_ids(input_path, new_pack_stats(), show_progress)
+    return best_fit_pack_records(
+        records, scan.lengths, scan.max_token_id, seq_len, pad_token_id, eos_token_id, stats
+    )
+
+
+def best_fit_pack_records(
+    records: Iterable,
+    lengths: np.ndarray,
+    max_token_id: int,
+    seq_len: int,
+    pad_token_id: int,
+    eos_token_id: Optional[int],
+    stats: Dict[str, int],
+) -> PackResult:
+    """Xếp `records` (theo đúng thứ tự của `lengths`) vào sequence bằng best-fit-decreasing."""
+    extra = 1 if eos_token_id is not None else 0
+    if lengths.size == 0:
         raise ValueError("Không tạo được sequence nào. Kiểm tra seq_len/stride hoặc dữ liệu đầu vào.")
 
-    tensor = torch.tensor(sequences, dtype=torch.long)
-    stats["total_output_sequences"] = tensor.size(0)
-    return tensor, stats
+    record_lengths = lengths + extra
+    full_chunks = record_lengths // seq_len
+    tails = record_lengths % seq_len
+    items_per_record = full_chunks + (tails > 0)
+    first_item = np.concatenate(([0], np.cumsum(items_per_record)))
+    item_sizes = np.full(int(first_item[-1]), seq_len, dtype=np.int64)
+    has_tail = tails > 0
+    item_sizes[first_item[1:][has_tail] - 1] = tails[has_tail]
+    stats["split_records"] = int((record_lengths > seq_len).sum())
+    stats["eos_tokens"] = int(extra * lengths.size)
+
+    bin_of, offset_of, num_bins = best_fit_decreasing(item_sizes, seq_len)
+
+    ids = [max_token_id, pad_token_id] + ([eos_token_id] if eos_token_id is not None else [])
+    dtype = stream_dtype(max(ids), min_token_id=min(ids))
+    sequences = np.full((num_bins, seq_len), pad_token_id, dtype=dtype)
+    peak_bytes = sequences.nbytes + 3 * item_sizes.nbytes
+
+    item = 0
+    for token_ids in records:
+        tokens = np.asarray(token_ids)
+        if extra:
+            tokens = np.append(tokens, eos_token_id)
+        start = 0
+        while start < tokens.size:
+            size = int(item_sizes[item])
+            row, offset = bin_of[item], offset_of[item]
+            sequences[row, offset:offset + size] = tokens[start:start + size]
+            start += size
+            item += 1
+
+    fill = np.bincount(bin_of, weights=item_sizes, minlength=num_bins)
+    stats["padding_tokens"] = int(num_bins * seq_len - fill.sum())
+    stats["padded_sequences"] = int((fill < seq_len).sum())
+    stats["total_output_sequences"] = num_bins
+    stats["fill_ratio"] = 1.0 - stats["padding_tokens"] / (num_bins * seq_len)
+    return PackResult(sequences=sequences, stats=stats, peak_bytes=peak_bytes)
+
+
+APPEND_SUMMED_STATS = ("total_input_tokens", "invalid_records", "empty_records")
+
+
+def append_to_packed(
+    bin_path: Path,
+    stream: np.ndarray,
+    scan: StreamScan,
+    new_stats: Dict[str, int],
+    source: str,
+) -> Dict:
+    """Nối token stream mới vào packed store `.bin` có sẵn, chi phí O(dữ liệu mới).
+
+    - packing=stream, layout rows: bỏ row remainder đã pad (nếu có), nối token
+      dư trong sidecar với dữ liệu mới rồi cắt window tiếp → kết quả giống hệt
+      pack lại toàn bộ input nối tiếp nhau.
+    - layout stream: ghi nối token vào stream, tính lại số window.
+    - packing=bfd: dữ liệu mới được best-fit thành các row riêng rồi ghi nối.
+
+    Meta (kèm segment manifest) được ghi sau cùng. Trả về meta mới.
+    """
+    meta = read_packed_meta(bin_path)
+    seq_len = int(meta["seq_len"])
+    pad_token_id = int(meta["pad_token_id"])
+    eos_token_id = meta.get("eos_token_id")
+    drop_remainder = bool(meta.get("drop_remainder", False))
+    dtype = np.dtype(meta["dtype"])
+    ids = [scan.max_token_id, pad_token_id] + ([eos_token_id] if eos_token_id is not None else [])
+    if max(ids) > np.iinfo(dtype).max:
+        raise ValueError(f"Token ID {max(ids)} không vừa dtype {dtype.name} của {bin_path}. Hãy pack lại.")
+
+    stats = {key: meta.get(key, value) for key, value in new_pack_stats().items()}
+    for key in APPEND_SUMMED_STATS:
+        stats[key] += new_stats[key]
+    old_sequences = int(meta["num_sequences"])
+
+    if meta["format"] == PACKED_STREAM_FORMAT:
+        append_packed_stream(bin_path, stream, meta)
+        num_tokens = int(meta["num_tokens"]) + stream.shape[0]
+        for key in ("padded_sequences", "padding_tokens", "dropped_tokens"):
+            stats[key] = 0
+        plan_windows(num_tokens, seq_len, int(meta["stride"]), drop_remainder, stats)
+        meta["num_tokens"] = num_tokens
+        kept_rows = old_sequences - int(meta.get("padded_sequences", 0) > 0)
+        num_sequences = stats["total_output_sequences"]
+    elif meta.get("packing") == "bfd":
+        offsets = np.concatenate(([0], np.cumsum(scan.lengths)))
+        records = (stream[offsets[i]:offsets[i + 1]] for i in range(scan.lengths.size))
+        result = best_fit_pack_records(
+            records, scan.lengths, scan.max_token_id, seq_len, pad_token_id, eos_token_id, new_pack_stats()
+        )
+        append_packed_rows(bin_path, result.sequences, old_sequences, meta)
+        for key in ("padded_sequences", "padding_tokens", "split_records", "eos_tokens"):
+            stats[key] = meta.get(key, 0) + result.stats[key]
+        kept_rows = old_sequences
+        num_sequences = old_sequences + result.sequences.shape[0]
+    else:
+        stride = min(int(meta["stride"]), seq_len)
+        carry = read_packed_carry(bin_path, meta)
+        kept_rows = old_sequences - int(carry.size > 0 and not drop_remainder)
+        combined = np.concatenate((carry.astype(dtype), stream.astype(dtype, copy=False)))
+        num_full, remainder = count_windows(combined.shape[0], seq_len, stride)
+        keep_remainder = remainder > 0 and not drop_remainder
+        rows = np.empty((num_full + int(keep_remainder), seq_len), dtype=dtype)
+        window_sequences(combined, rows, num_full, remainder, keep_remainder, stride, pad_token_id)
+        append_packed_rows(bin_path, rows, kept_rows, meta)
+        write_packed_carry(bin_path, combined[combined.shape[0] - remainder:])
+        meta["carry_tokens"] = remainder
+        stats["padded_sequences"] = int(keep_remainder)
+        stats["padding_tokens"] = seq_len - remainder if keep_remainder else 0
+        stats["dropped_tokens"] = remainder if drop_remainder else 0
+        num_sequences = kept_rows + rows.shape[0]
+
+    if num_sequences == 0:
+        raise ValueError(f"{bin_path} vẫn chưa có sequence nào sau khi append.")
+    stats["total_output_sequences"] = num_sequences
+    stats["fill_ratio"] = 1.0 - stats["padding_tokens"] / (num_sequences * seq_len)
+    segments = meta.get("segments", [])
+    segments.append(new_segment(source, new_stats["total_input_tokens"], kept_rows, num_sequences - kept_rows))
+    meta.update(stats)
+    meta["num_sequences"] = num_sequences
+    meta["segments"] = segments
+    write_packed_meta(bin_path, meta)
+    return meta
+
+
+def pack_sequences(
+    input_path: Path,
+    seq_len: int,
+    stride: int,
+    drop_remainder: bool,
+    pad_token_id: int,
+    show_progress: bool,
+) -> Tuple[torch.Tensor, Dict[str, int]]:
+    """Đọc token IDs (JSONL hoặc .bin) và pack thành tensor cố định."""
+    result = pack_sequences_array(
+        input_path=input_path,
+        seq_len=seq_len,
+        stride=stride,
+        drop_remainder=drop_remainder,
+        pad_token_id=pad_token_id,
+        show_progress=show_progress,
+    )
+    tensor = torch.from_numpy(result.sequences.astype(np.int64))
+    print(
+        f"📦 Peak memory packing: {format_bytes(result.peak_bytes)} buffer + "
+        f"{format_bytes(tensor.numel() * tensor.element_size())} LongTensor"
+    )
+    return tensor, result.stats
+
+
+def new_segment(source: str, input_tokens: int, first_sequence: int, num_sequences: int) -> Dict:
+    """Một entry của segment manifest (mỗi lần pack/append thêm một entry)."""
+    return {
+        "source": source,
+        "input_tokens": int(input_tokens),
+        "first_sequence": int(first_sequence),
+        "num_sequences": int(num_sequences),
+        "packed_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def save_packed(
+    output_path: Path,
+    sequences: np.ndarray,
+    meta: Dict,
+    carry: Optional[np.ndarray] = None,
+) -> None:
+    """Lưu packed sequences: `.bin` → raw + meta JSON, còn lại → torch.save LongTensor.
+
+    Với `.bin`, `carry` được lưu làm remainder sidecar và meta có segment
+    manifest đầu tiên, để `--append` nối dữ liệu mới về sau.
+    """
+    if is_packed_bin(output_path):
+        segment = new_segment(
+            meta.get("source", ""), meta.get("total_input_tokens", 0), 0, sequences.shape[0]
+        )
+        write_packed_bin(output_path, sequences, {**meta, "segments": [segment]}, carry=carry)
+        return
+    tensor = torch.from_numpy(sequences.astype(np.int64))
+    torch.save({"input_ids": tensor, "meta": meta}, output_path)
+
+
+def format_bytes(num_bytes: int) -> str:
+    size = float(num_bytes)
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def append_main(args: argparse.Namespace) -> None:
+    """`--append`: parse input mới một lần rồi nối vào từng packed store đích."""
+    pairs = resolve_length_pairs(args.seq_len, args.stride)
+    outputs = list(dict.fromkeys(pair_output_path(args.output, *pair, len(pairs)) for pair in pairs))
+    for output_path in outputs:
+        if not is_packed_bin(output_path) or not output_path.exists():
+            raise FileNotFoundError(f"--append cần packed store .bin có sẵn: {output_path}")
+
+    new_stats = new_pack_stats()
+    stream, scan = build_token_stream(args.input, 0, new_stats, args.show_progress)
+    print(f"➕ Append {args.input}: {scan.total_tokens:,} tokens mới")
+    for output_path in outputs:
+        old_sequences = read_packed_meta(output_path)["num_sequences"]
+        meta = append_to_packed(output_path, stream, scan, new_stats, str(args.input))
+        print(
+            f"✅ {output_path}: {old_sequences:,} → {meta['num_sequences']:,} sequences "
+            f"| carry={meta.get('carry_tokens', 0)} tokens | segments={len(meta['segments'])} "
+            f"| fill_ratio={meta['fill_ratio']:.2%}"
+        )
 
 
 def main() -> None:
@@ -180,7 +895,9 @@ def main() -> None:
     if not args.input.exists():
         raise FileNotFoundError(f"Không tìm thấy file input: {args.input}")
 
-    ensure_dir(args.output.parent)
+    if args.append:
+        append_main(args)
+        return
 
     pad_token_id: Optional[int] = args.pad_token_id
     tokenizer_meta: Dict[str, str] = {}
@@ -215,34 +932,101 @@ def main() -> None:
             "Nên truyền giá trị rõ ràng để tránh nhiễu."
         )
 
-    print(f"🔁 Packing {args.input} → {args.output}")
+    eos_token_id: Optional[int] = args.eos_token_id
+    if eos_token_id is None and args.add_eos:
+        if args.tokenizer_model and spm is not None:
+            sp = spm.SentencePieceProcessor(model_file=str(args.tokenizer_model))
+            eos_token_id = sp.eos_id() if sp.eos_id() >= 0 else None
+        if eos_token_id is None:
+            raise ValueError("--add-eos cần --eos-token-id hoặc --tokenizer-model có eos_id.")
+    if eos_token_id is not None and args.packing != "bfd":
+        print("⚠️ EOS separator chỉ áp dụng cho --packing bfd. Bỏ qua.")
+        eos_token_id = None
 
-    tensor, stats = pack_sequences(
-        input_path=args.input,
-        seq_len=args.seq_len,
-        stride=args.stride,
-        drop_remainder=args.drop_remainder,
-        pad_token_id=pad_token_id,
-        show_progress=args.show_progress,
+    pairs = resolve_length_pairs(args.seq_len, args.stride)
+    outputs = {pair: pair_output_path(args.output, *pair, len(pairs)) for pair in pairs}
+    if len(set(outputs.values())) != len(outputs):
+        raise ValueError(f"Output template {args.output} cho ra trùng file giữa các cặp {pairs}.")
+    for path in outputs.values():
+        ensure_dir(path.parent)
+
+    lengths_desc = ", ".join(f"{seq_len}/{stride}" for seq_len, stride in pairs)
+    print(
+        f"🔁 Packing {args.input} → {args.output} "
+        f"(mode={args.packing}, layout={args.layout}, seq_len/stride={lengths_desc})"
     )
 
-    meta = {
-        "num_sequences": tensor.size(0),
-        "seq_len": tensor.size(1),
-        "stride": args.stride,
+    base_meta = {
         "drop_remainder": args.drop_remainder,
         "pad_token_id": pad_token_id,
+        "packing": args.packing,
+        "eos_token_id": eos_token_id,
         "source": str(args.input),
-        **stats,
-        **tokenizer_meta,
     }
 
-    torch.save({"input_ids": tensor, "meta": meta}, args.output)
-    print(
-        f"✅ Done. Saved {tensor.size(0):,} sequences of length {tensor.size(1)} "
-        f"→ {args.output}"
+    if args.layout == "stream":
+        if args.packing != "stream" or not all(is_packed_bin(path) for path in outputs.values()):
+            raise ValueError("--layout stream chỉ hỗ trợ --packing stream và output .bin.")
+        stream, planned = pack_stream_layout(
+            input_path=args.input,
+            pairs=pairs,
+            drop_remainder=args.drop_remainder,
+            pad_token_id=pad_token_id,
+            show_progress=args.show_progress,
+        )
+        for (pair, output_path), (seq_len, stride, stats) in zip(outputs.items(), planned):
+            meta = {
+                **base_meta,
+                "num_sequences": stats["total_output_sequences"],
+                "seq_len": seq_len,
+                "stride": stride,
+                **stats,
+                **tokenizer_meta,
+                "segments": [
+                    new_segment(str(args.input), stats["total_input_tokens"], 0, stats["total_output_sequences"])
+                ],
+            }
+            write_packed_stream(output_path, stream, meta)
+            materialized = stats["total_output_sequences"] * seq_len
+            print(
+                f"✅ Done. Saved stream {stream.shape[0]:,} tokens "
+                f"({stats['total_output_sequences']:,} windows, thay vì {materialized:,} tokens materialized) "
+                f"→ {output_path}"
+            )
+        return
+
+    results = iter_packed_lengths(
+        input_path=args.input,
+        pairs=pairs,
+        drop_remainder=args.drop_remainder,
+        pad_token_id=pad_token_id,
+        show_progress=args.show_progress,
+        packing=args.packing,
+        eos_token_id=eos_token_id,
     )
+    for pair, (seq_len, stride, result) in zip(pairs, results):
+        output_path = outputs[pair]
+        num_sequences = result.sequences.shape[0]
+        meta = {
+            "num_sequences": num_sequences,
+            "seq_len": seq_len,
+            "stride": stride,
+            **base_meta,
+            **result.stats,
+            **tokenizer_meta,
+        }
 
+        save_packed(output_path, result.sequences, meta, carry=result.carry)
+        print(f"📦 Peak memory packing: {format_bytes(result.peak_bytes)}")
+        print(
+            f"📊 fill_ratio={result.stats['fill_ratio']:.2%} | "
+            f"padding_tokens={result.stats['padding_tokens']:,} | "
+            f"padded_sequences={result.stats['padded_sequences']:,}"
+        )
+        print(
+            f"✅ Done. Saved {num_sequences:,} sequences of length {seq_len} "
+            f"→ {output_path}"
+        )
 
 if __name__ == "__main__":
     main()
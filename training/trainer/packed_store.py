@@ -0,0 +1,153 @@
+"""
+Định dạng raw on-disk cho packed sequences (thay cho pickle `.pt`).
+
+Một packed store gồm:
+- `<name>.bin`  : ma trận [num_sequences, seq_len] ghi liên tục (uint16 hoặc int32)
+- `<name>.json` : meta (format, dtype, seq_len, stride, pad_token_id, stats, ...)
+
+Trainer memory-map file `.bin` bằng numpy và chỉ convert các row được sample
+sang int64, nên startup gần như tức thời và RSS tỉ lệ với batch thay vì dataset.
+
+Layout "stream" (format `packed_stream`) chỉ ghi token stream phẳng một lần
+cùng meta window (seq_len, stride, num_sequences); window `i` là slice
+`[i * stride, i * stride + seq_len)` của stream, không materialize overlap.
+
+Store `.bin` có thể append (xem `pack_tokenized_dataset.py --append`):
+- `<name>.remainder.npy` : token dư sau window đầy đủ cuối cùng (chưa pad),
+                           được nối vào đầu dữ liệu mới thay vì padding
+- meta `segments`        : manifest từng lần pack/append (source, số token,
+                           sequence đầu tiên, số sequence)
+"""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from .token_store import open_token_array, token_store_paths
+from .utils import ensure_dir
+
+
+PACKED_FORMAT = "packed"
+PACKED_STREAM_FORMAT = "packed_stream"
+PACKED_FORMATS = (PACKED_FORMAT, PACKED_STREAM_FORMAT)
+PACKED_SUFFIX = ".bin"
+
+
+def packed_meta_path(bin_path: Path) -> Path:
+    return token_store_paths(bin_path)["header"]
+
+
+def packed_carry_path(bin_path: Path) -> Path:
+    return Path(str(bin_path.with_suffix("")) + ".remainder.npy")
+
+
+def is_packed_bin(path: Path) -> bool:
+    return path.suffix == PACKED_SUFFIX
+
+
+def read_packed_meta(bin_path: Path) -> Dict[str, Any]:
+    meta_path = packed_meta_path(bin_path)
+    if not meta_path.exists():
+        raise FileNotFoundError(f"Không tìm thấy meta cho {bin_path}: {meta_path}")
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("format") not in PACKED_FORMATS:
+        raise ValueError(f"{bin_path} không phải packed store (format={meta.get('format')!r})")
+    return meta
+
+
+def write_packed_meta(bin_path: Path, meta: Dict[str, Any]) -> None:
+    with open(packed_meta_path(bin_path), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+def write_packed_bin(
+    bin_path: Path,
+    sequences: np.ndarray,
+    meta: Dict[str, Any],
+    carry: Optional[np.ndarray] = None,
+) -> Dict[str, Any]:
+    """Ghi ma trận sequences + meta JSON. Trả về meta đã bổ sung format/dtype/shape.
+
+    `carry` (token dư chưa pad) được lưu vào sidecar `.remainder.npy` để store
+    có thể append tiếp; không truyền thì store không append được.
+    """
+    ensure_dir(bin_path.parent)
+    sequences = np.ascontiguousarray(sequences)
+    sequences.tofile(bin_path)
+    full_meta = {
+        **meta,
+        "format": PACKED_FORMAT,
+        "dtype": sequences.dtype.name,
+        "num_sequences": int(sequences.shape[0]),
+        "seq_len": int(sequences.shape[1]),
+    }
+    if carry is not None:
+        write_packed_carry(bin_path, carry.astype(sequences.dtype))
+        full_meta["carry_tokens"] = int(carry.shape[0])
+    write_packed_meta(bin_path, full_meta)
+    return full_meta
+
+
+def write_packed_carry(bin_path: Path, carry: np.ndarray) -> None:
+    np.save(packed_carry_path(bin_path), np.ascontiguousarray(carry))
+
+
+def read_packed_carry(bin_path: Path, meta: Dict[str, Any]) -> np.ndarray:
+    """Token dư của lần pack trước (rỗng nếu window cuối vừa khít)."""
+    if "carry_tokens" not in meta:
+        raise ValueError(
+            f"{bin_path} không có remainder sidecar (pack bằng bản cũ hoặc packing=bfd). "
+            "Hãy pack lại một lần để store append được."
+        )
+    if int(meta["carry_tokens"]) == 0:
+        return np.empty(0, dtype=np.dtype(meta["dtype"]))
+    return np.load(packed_carry_path(bin_path))
+
+
+def append_packed_rows(bin_path: Path, rows: np.ndarray, keep_rows: int, meta: Dict[str, Any]) -> None:
+    """Giữ `keep_rows` row đầu của store rồi ghi nối `rows` (cùng dtype/seq_len)."""
+    dtype = np.dtype(meta["dtype"])
+    row_bytes = int(meta["seq_len"]) * dtype.itemsize
+    with open(bin_path, "r+b") as f:
+        f.truncate(keep_rows * row_bytes)
+        f.seek(0, 2)
+        np.ascontiguousarray(rows, dtype=dtype).tofile(f)
+
+
+def append_packed_stream(bin_path: Path, tokens: np.ndarray, meta: Dict[str, Any]) -> None:
+    """Ghi nối token vào token stream của layout stream (cắt phần thừa nếu lần trước bị ngắt)."""
+    dtype = np.dtype(meta["dtype"])
+    with open(bin_path, "r+b") as f:
+        f.truncate(int(meta["num_tokens"]) * dtype.itemsize)
+        f.seek(0, 2)
+        np.ascontiguousarray(tokens, dtype=dtype).tofile(f)
+
+
+def write_packed_stream(bin_path: Path, stream: np.ndarray, meta: Dict[str, Any]) -> Dict[str, Any]:
+    """Ghi token stream phẳng + meta window (layout stream)."""
+    ensure_dir(bin_path.parent)
+    np.ascontiguousarray(stream).tofile(bin_path)
+    full_meta = {
+        **meta,
+        "format": PACKED_STREAM_FORMAT,
+        "dtype": stream.dtype.name,
+        "num_tokens": int(stream.shape[0]),
+    }
+    write_packed_meta(bin_path, full_meta)
+    return full_meta
+
+
+def open_packed_stream(bin_path: Path, meta: Dict[str, Any]) -> np.ndarray:
+    """Memory-map token stream của layout stream."""
+    return open_token_array(bin_path, np.dtype(meta["dtype"]), int(meta["num_tokens"]))
+
+
+def open_packed_bin(bin_path: Path, meta: Dict[str, Any]) -> np.ndarray:
+    """Memory-map packed store read-only với shape [num_sequences, seq_len]."""
+    shape = (int(meta["num_sequences"]), int(meta["seq_len"]))
+    return np.memmap(bin_path, dtype=np.dtype(meta["dtype"]), mode="r", shape=shape)
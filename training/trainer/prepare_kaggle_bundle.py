@@ -15,6 +15,7 @@ from pathlib import Path
 from typing import Dict, List, Tuple
 
 from .config import Paths
+from .token_store import token_store_paths
 from .utils import ensure_dir, setup_encoding
 
 
@@ -31,6 +32,12 @@ CORE_ITEMS: Dict[str, Path] = {
     "dataset/tokenized/test_tokens.jsonl": Paths.TOKENIZED_DIR / "test_tokens.jsonl",
 }
 
+BINARY_TOKEN_ITEMS: Dict[str, Path] = {
+    f"dataset/tokenized/{path.name}": path
+    for split in ("train", "val", "test")
+    for path in token_store_paths(Paths.TOKENIZED_DIR / f"{split}_tokens.bin").values()
+}
+
 REPORT_ITEMS: Dict[str, Path] = {
     "reports/preprocessing_summary.json": Paths.PREPROCESSING_SUMMARY_JSON,
     "reports/clean_noise_report.json": Paths.CLEAN_NOISE_REPORT_JSON,
@@ -58,6 +65,11 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Thêm các file thống kê QA (preprocessing_summary, splits_summary...).",
     )
+    parser.add_argument(
+        "--include-binary-tokens",
+        action="store_true",
+        help="Thêm token store nhị phân (*_tokens.bin/.idx.npy/.meta.npz/.json) từ tokenize_dataset --format bin.",
+    )
     parser.add_argument(
         "--include-preprocessed",
         action="store_true",
@@ -135,6 +147,11 @@ def main() -> None:
         copied.update(report_copied)
         missing.extend(report_missing)
 
+    if args.include_binary_tokens:
+        binary_copied, binary_missing = copy_items(BINARY_TOKEN_ITEMS, args.output_dir)
+        copied.update(binary_copied)
+        missing.extend(binary_missing)
+
     if args.include_preprocessed:
         preproc_copied, preproc_missing = copy_items(PREPROCESSED_ITEMS, args.output_dir)
         copied.update(preproc_copied)
@@ -0,0 +1,6 @@
+"""
+Kiểm tra cho pipeline data/training (pytest hoặc chạy từng file như script).
+
+    python -m pytest training/trainer/tests -q
+    python -m training.trainer.tests.test_resume
+"""
@@ -0,0 +1,113 @@
+"""
+Dữ liệu giả + config GPT-2 tí hon dùng chung cho các bài kiểm tra (chạy được trên CPU).
+"""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from ..pack_tokenized_dataset import pack_sequences_array, pack_stream_layout, save_packed
+from ..packed_store import write_packed_stream
+from ..token_store import TokenStoreWriter
+
+VOCAB_SIZE = 512
+SEQ_LEN = 32
+PAD_TOKEN_ID = 0
+
+TINY_MODEL = {"vocab_size": VOCAB_SIZE, "n_ctx": SEQ_LEN, "n_positions": SEQ_LEN, "n_embd": 32, "n_layer": 2, "n_head": 2}
+TINY_TRAINING = {
+    "num_epochs": 1,
+    "learning_rate": 1e-3,
+    "warmup_steps": 2,
+    "micro_batch_size": 2,
+    "gradient_accumulation_steps": 2,
+    "mixed_precision": "",
+    "log_every": 1,
+    "eval_every": 0,
+    "save_every": 4,
+    "pad_token_id": PAD_TOKEN_ID,
+    "num_workers": 0,
+    "device_prefetch": 0,
+    "shuffle_buffer": 16,
+    "async_checkpoint": False,
+}
+
+
+def make_paragraphs(num_paragraphs: int, seed: int = 0, min_len: int = 3, max_len: int = 70) -> List[List[int]]:
+    """Paragraph token IDs ngẫu nhiên (không chứa pad id)."""
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(min_len, max_len + 1, size=num_paragraphs)
+    return [rng.integers(1, VOCAB_SIZE, size=int(length)).tolist() for length in lengths]
+
+
+def write_tokens_jsonl(path: Path, paragraphs: Iterable[List[int]]) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for token_ids in paragraphs:
+            f.write(json.dumps({"input_ids": token_ids}) + "\n")
+    return path
+
+
+def write_token_store(path: Path, paragraphs: Iterable[List[int]]) -> Path:
+    writer = TokenStoreWriter(path, VOCAB_SIZE)
+    for token_ids in paragraphs:
+        writer.add(token_ids)
+    writer.close()
+    return path
+
+
+def pack_file(
+    tokens_path: Path,
+    output_path: Path,
+    seq_len: int = SEQ_LEN,
+    stride: Optional[int] = None,
+    layout: str = "rows",
+) -> Path:
+    """Pack giống CLI `pack_tokenized_dataset` (layout rows → .bin/.pt, stream → .bin)."""
+    stride = stride or seq_len
+    base_meta = {"drop_remainder": False, "pad_token_id": PAD_TOKEN_ID, "packing": "stream", "source": str(tokens_path)}
+    if layout == "stream":
+        stream, [(seq_len, stride, stats)] = pack_stream_layout(tokens_path, [(seq_len, stride)], False, PAD_TOKEN_ID, False)
+        meta = {**base_meta, "num_sequences": stats["total_output_sequences"], "seq_len": seq_len, "stride": stride, **stats}
+        write_packed_stream(output_path, stream, meta)
+        return output_path
+    result = pack_sequences_array(tokens_path, seq_len, stride, False, PAD_TOKEN_ID, False)
+    meta = {"num_sequences": result.sequences.shape[0], "seq_len": seq_len, "stride": stride, **base_meta, **result.stats}
+    save_packed(output_path, result.sequences, meta, carry=result.carry)
+    return output_path
+
+
+def write_config(path: Path, paths: Dict[str, str], model: Optional[Dict] = None, **training) -> Path:
+    config = {
+        "model": {**TINY_MODEL, **(model or {})},
+        "training": {**TINY_TRAINING, **training},
+        "paths": paths,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+    return path
+
+
+def read_events(output_dir: Path, event: str) -> List[Dict]:
+    with open(output_dir / "metrics.jsonl", "r", encoding="utf-8") as f:
+        return [record for record in map(json.loads, f) if record.get("event") == event]
+
+
+def train_losses(config_path: Path, output_dir: Path, resume: Optional[Path] = None) -> Dict[int, float]:
+    """Chạy `run_training` trên CPU, trả về {step: loss} từ `metrics.jsonl` (cần log_every=1)."""
+    from ..train_lm import run_training
+
+    run_training(config_path, output_dir_override=output_dir, resume=resume, device_str="cpu")
+    return {record["step"]: record["loss"] for record in read_events(output_dir, "train")}
+
+
+def run_checks(namespace: Dict[str, Callable]) -> None:
+    """Chạy mọi hàm `test_*` trong module (khi gọi file như script)."""
+    for name, check in list(namespace.items()):
+        if name.startswith("test_") and callable(check):
+            check()
+            print(f"✅ {name}")
@@ -0,0 +1,93 @@
+"""
+Retention checkpoint: keep_last (ít hơn / nhiều hơn số checkpoint, bằng 0),
+keep_best theo lần eval gần nhất, keep_every_n_steps, val_loss đến muộn
+(async eval) và bảo vệ checkpoint chưa được chấm khi `await_eval`.
+
+    python -m training.trainer.tests.test_checkpoint_retention
+"""
+
+from __future__ import annotations
+
+import json
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set
+
+from ..checkpointing import MANIFEST_NAME, CheckpointManager
+from .helpers import run_checks
+
+
+def saved_manager(
+    root: Path,
+    steps: Iterable[int],
+    val_losses: Optional[Dict[int, float]] = None,
+    **policy,
+) -> CheckpointManager:
+    """Ghi file giả `checkpoint_step{N}.pt` + register từng cái (eval ghi trước checkpoint cùng step)."""
+    manager = CheckpointManager(root, **policy)
+    for step in steps:
+        if val_losses and step in val_losses:
+            manager.record_val_loss(step, val_losses[step])
+        file_name = f"checkpoint_step{step}.pt"
+        (root / file_name).write_bytes(b"")
+        manager.register(f"step{step}", step, file_name)
+    return manager
+
+
+def kept_steps(root: Path) -> Set[int]:
+    on_disk = {int(path.stem[len("checkpoint_step"):]) for path in root.glob("checkpoint_step*.pt")}
+    with open(root / MANIFEST_NAME, "r", encoding="utf-8") as f:
+        in_manifest = {entry["step"] for entry in json.load(f)["checkpoints"]}
+    assert on_disk == in_manifest, f"manifest {in_manifest} != đĩa {on_disk}"
+    return on_disk
+
+
+def test_keep_last():
+    # keep_last lớn hơn số checkpoint: không xoá gì (slice không được quay vòng).
+    for keep_last, expected in ((5, {10, 20, 30}), (3, {10, 20, 30}), (2, {20, 30}), (0, set())):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            saved_manager(root, (10, 20, 30), keep_last=keep_last).prune()
+            assert kept_steps(root) == expected, f"keep_last={keep_last}: {kept_steps(root)}"
+
+
+def test_keep_best_uses_latest_eval_before_checkpoint():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        # eval ở step 15 (không trùng step checkpoint) gán cho checkpoint step 20.
+        manager = saved_manager(root, (10, 20, 30, 40), {10: 3.0, 30: 2.5, 40: 2.8}, keep_last=1, keep_best=1)
+        manager.record_val_loss(15, 1.0)
+        manager.prune()
+        assert kept_steps(root) == {20, 40}, kept_steps(root)
+
+
+def test_keep_every_n_steps():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        saved_manager(root, (10, 20, 30, 40, 50), keep_last=1, keep_every_n_steps=20).prune()
+        assert kept_steps(root) == {20, 40, 50}, kept_steps(root)
+
+
+def test_late_val_loss_protects_pending_checkpoints():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        manager = saved_manager(root, (10, 20, 30), {10: 2.0}, keep_last=1, keep_best=1, await_eval=True)
+        manager.prune()
+        assert kept_steps(root) == {10, 20, 30}, "checkpoint chưa có eval không được xoá"
+        manager.record_val_loss(20, 1.5)  # kết quả async đến muộn
+        manager.prune()
+        assert kept_steps(root) == {20, 30}, kept_steps(root)
+        manager.record_val_loss(30, 1.8)
+        manager.prune()
+        assert kept_steps(root) == {20, 30}, kept_steps(root)
+
+
+def test_sync_eval_prunes_unscored_checkpoints():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        saved_manager(root, (10, 20, 30), {10: 2.0}, keep_last=1, keep_best=1).prune()
+        assert kept_steps(root) == {10, 30}, kept_steps(root)
+
+
+if __name__ == "__main__":
+    run_checks(globals())
@@ -0,0 +1,132 @@
+"""
+Optimizer state nén bf16/int8: encode → decode giữ shape/dtype, sai số nằm trong
+giới hạn lượng tử hoá của từng block, không sửa state gốc, và đi trọn vòng
+qua checkpoint `.pt` lẫn sharded rồi train tiếp được.
+
+    python -m training.trainer.tests.test_optimizer_state
+"""
+
+from __future__ import annotations
+
+import copy
+import tempfile
+from pathlib import Path
+from typing import Dict
+
+import torch
+
+from ..checkpointing import PT_FORMAT, SHARDED_FORMAT, StateSnapshotter, build_payload, load_checkpoint, write_checkpoint
+from ..optimizer_state import (
+    BLOCK_SIZE,
+    LOG_LEVELS,
+    MOMENT_KEYS,
+    OPTIMIZER_STATE_DTYPES,
+    _blocks,
+    decode_optimizer_state,
+    encode_optimizer_state,
+)
+from ..train_lm import build_model
+from .helpers import SEQ_LEN, TINY_MODEL, VOCAB_SIZE, run_checks
+
+
+def trained_model(seed: int = 0):
+    """Model tí hon + AdamW sau vài step (moment khác 0, có cả param không được cập nhật)."""
+    torch.manual_seed(seed)
+    model = build_model(TINY_MODEL)
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    for _ in range(3):
+        input_ids = torch.randint(1, VOCAB_SIZE, (2, SEQ_LEN))
+        model(input_ids=input_ids, labels=input_ids).loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    return model, optimizer
+
+
+def assert_within_quantization(original: torch.Tensor, decoded: torch.Tensor, key: str, dtype: str) -> None:
+    assert decoded.shape == original.shape, f"{key}: shape {decoded.shape} != {original.shape}"
+    original, decoded = original.float(), decoded.float()
+    if dtype == "fp32":
+        assert torch.equal(decoded, original), key
+    elif dtype == "bf16":
+        assert torch.allclose(decoded, original, rtol=2 ** -8, atol=0), key
+    elif key == "exp_avg":
+        # int8 tuyến tính theo absmax của block: sai số ≤ nửa bước lượng tử.
+        error = _blocks(decoded - original).abs().amax(dim=1)
+        bound = _blocks(original).abs().amax(dim=1) / 254.0
+        assert bool((error <= bound * (1 + 1e-5) + 1e-12).all()), f"exp_avg vượt sai số int8: {(error - bound).max()}"
+    else:
+        # uint8 trên log2: 0 giữ nguyên 0, sai số tương đối ≤ 2^(span / 2·LOG_LEVELS) - 1.
+        assert torch.equal(decoded == 0, original == 0), "exp_avg_sq: vị trí giá trị 0 bị đổi"
+        positive = _blocks(original) > 0
+        log_v = torch.log2(torch.where(positive, _blocks(original), torch.ones_like(_blocks(original))))
+        span = (
+            torch.where(positive, log_v, torch.full_like(log_v, -float("inf"))).amax(dim=1)
+            - torch.where(positive, log_v, torch.full_like(log_v, float("inf"))).amin(dim=1)
+        ).clamp_min(0.0)  # block toàn 0: -inf → 0
+        bound = torch.exp2(span / (2 * LOG_LEVELS)) - 1
+        relative = torch.where(positive, (_blocks(decoded) / _blocks(original).clamp_min(1e-38) - 1).abs(), 0.0)
+        assert bool((relative.amax(dim=1) <= bound * (1 + 1e-4) + 1e-5).all()), "exp_avg_sq vượt sai số log-int8"
+
+
+def assert_state_close(original: Dict, decoded: Dict, dtype: str) -> None:
+    assert set(decoded["state"]) == set(original["state"])
+    for idx, param_state in original["state"].items():
+        for key, value in param_state.items():
+            restored = decoded["state"][idx][key]
+            if key in MOMENT_KEYS:
+                assert_within_quantization(value, restored, key, dtype)
+            else:
+                assert torch.equal(torch.as_tensor(restored), torch.as_tensor(value)), key
+    assert decoded["param_groups"] == original["param_groups"]
+
+
+def test_encode_decode_roundtrip():
+    _, optimizer = trained_model()
+    original = optimizer.state_dict()
+    assert any(p["exp_avg"].numel() % BLOCK_SIZE for p in original["state"].values()), "cần tensor lẻ block"
+    untouched = copy.deepcopy(original)
+    for dtype in OPTIMIZER_STATE_DTYPES:
+        encoded = encode_optimizer_state(original, dtype)
+        decoded = decode_optimizer_state(copy.deepcopy(encoded))
+        assert_state_close(original, decoded, dtype)
+        assert_state_close(untouched, original, "fp32")  # encode không sửa state gốc
+
+
+def test_zero_and_constant_blocks():
+    state = {
+        "state": {
+            0: {"step": torch.tensor(1.0), "exp_avg": torch.zeros(300), "exp_avg_sq": torch.zeros(300)},
+            1: {"step": torch.tensor(1.0), "exp_avg": torch.full((3, 7), -0.5), "exp_avg_sq": torch.full((3, 7), 1e-12)},
+        },
+        "param_groups": [{"params": [0, 1]}],
+    }
+    for dtype in ("bf16", "int8"):
+        decoded = decode_optimizer_state(encode_optimizer_state(state, dtype))
+        assert_state_close(state, decoded, dtype)
+
+
+def test_checkpoint_roundtrip_and_continue_training():
+    for fmt in (PT_FORMAT, SHARDED_FORMAT):
+        for dtype in OPTIMIZER_STATE_DTYPES:
+            model, optimizer = trained_model()
+            payload = StateSnapshotter().snapshot(build_payload(model, optimizer, None, step=3))
+            with tempfile.TemporaryDirectory() as tmp:
+                path = write_checkpoint(Path(tmp), "step3", payload, fmt=fmt, optimizer_state_dtype=dtype)
+                restored_model, restored_optimizer = trained_model(seed=1)
+                ckpt = load_checkpoint(path, restored_model, restored_optimizer)
+            assert ckpt["step"] == 3
+            for name, tensor in model.state_dict().items():
+                assert torch.equal(restored_model.state_dict()[name], tensor), f"{fmt}/{dtype}: weight {name}"
+            assert_state_close(optimizer.state_dict(), restored_optimizer.state_dict(), dtype)
+
+            input_ids = torch.randint(1, VOCAB_SIZE, (2, SEQ_LEN))
+            loss = restored_model(input_ids=input_ids, labels=input_ids).loss
+            loss.backward()
+            restored_optimizer.step()
+            assert torch.isfinite(loss), f"{fmt}/{dtype}: loss {loss}"
+            assert all(torch.isfinite(p).all() for p in restored_model.parameters()), f"{fmt}/{dtype}: NaN weights"
+
+
+if __name__ == "__main__":
+    run_checks(globals())
@@ -0,0 +1,135 @@
+"""
+Packer hai pass (numpy, cấp phát sẵn) phải cho đúng output của packer list
+ban đầu: cùng sequences, cùng stats, với input JSONL lẫn token store, mọi tổ
+hợp seq_len/stride/drop_remainder, pack nhiều length một lần, layout stream
+và append vào store có sẵn.
+
+    python -m training.trainer.tests.test_pack
+"""
+
+from __future__ import annotations
+
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from ..pack_tokenized_dataset import (
+    append_to_packed,
+    build_token_stream,
+    iter_packed_lengths,
+    new_pack_stats,
+    pack_sequences,
+    pack_sequences_array,
+)
+from ..packed_store import open_packed_bin, read_packed_meta
+from ..train_lm import SlidingWindowDataset
+from .helpers import PAD_TOKEN_ID, make_paragraphs, pack_file, run_checks, write_token_store, write_tokens_jsonl
+
+CASES = [
+    # (seq_len, stride, drop_remainder)
+    (32, 32, False),
+    (32, 32, True),
+    (32, 16, False),
+    (32, 7, True),
+    (50, 50, False),
+    (64, 1, False),
+]
+STAT_KEYS = ("total_input_tokens", "total_output_sequences", "empty_records", "padded_sequences", "dropped_tokens")
+
+
+def reference_pack(
+    paragraphs: List[List[int]], seq_len: int, stride: int, drop_remainder: bool
+) -> Tuple[np.ndarray, Dict[str, int]]:
+    """Thuật toán packer list ban đầu (buffer Python, cắt window rồi dịch `stride`)."""
+    stats = {key: 0 for key in STAT_KEYS}
+    sequences: List[List[int]] = []
+    buffer: List[int] = []
+    for token_ids in paragraphs:
+        if not token_ids:
+            stats["empty_records"] += 1
+            continue
+        stats["total_input_tokens"] += len(token_ids)
+        buffer.extend(token_ids)
+        while len(buffer) >= seq_len:
+            sequences.append(buffer[:seq_len])
+            buffer = buffer[stride:]
+    if buffer and not drop_remainder:
+        sequences.append(buffer + [PAD_TOKEN_ID] * (seq_len - len(buffer)))
+        stats["padded_sequences"] += 1
+    elif buffer:
+        stats["dropped_tokens"] += len(buffer)
+    stats["total_output_sequences"] = len(sequences)
+    return np.array(sequences, dtype=np.int64).reshape(-1, seq_len), stats
+
+
+def sample_inputs(root: Path) -> Tuple[List[List[int]], List[Path]]:
+    paragraphs = make_paragraphs(40, seed=7)
+    paragraphs[5] = []  # paragraph rỗng được đếm nhưng bỏ qua
+    return paragraphs, [
+        write_tokens_jsonl(root / "tokens.jsonl", paragraphs),
+        write_token_store(root / "tokens.bin", paragraphs),
+    ]
+
+
+def assert_same(sequences: np.ndarray, stats: Dict, expected: np.ndarray, expected_stats: Dict, label: str) -> None:
+    assert sequences.shape == expected.shape, f"{label}: shape {sequences.shape} != {expected.shape}"
+    assert np.array_equal(np.asarray(sequences, dtype=np.int64), expected), f"{label}: sequences khác"
+    for key in STAT_KEYS:
+        assert stats[key] == expected_stats[key], f"{label}: {key} {stats[key]} != {expected_stats[key]}"
+
+
+def test_pack_array_matches_reference():
+    with tempfile.TemporaryDirectory() as tmp:
+        paragraphs, inputs = sample_inputs(Path(tmp))
+        for seq_len, stride, drop_remainder in CASES:
+            expected, expected_stats = reference_pack(paragraphs, seq_len, stride, drop_remainder)
+            for path in inputs:
+                result = pack_sequences_array(path, seq_len, stride, drop_remainder, PAD_TOKEN_ID, False)
+                label = f"{path.name} seq_len={seq_len} stride={stride} drop={drop_remainder}"
+                assert_same(result.sequences, result.stats, expected, expected_stats, label)
+                assert result.stride == stride, f"{label}: stride {result.stride}"
+                tensor, stats = pack_sequences(path, seq_len, stride, drop_remainder, PAD_TOKEN_ID, False)
+                assert_same(tensor.numpy(), stats, expected, expected_stats, f"pack_sequences {label}")
+
+
+def test_multi_length_matches_reference():
+    with tempfile.TemporaryDirectory() as tmp:
+        paragraphs, inputs = sample_inputs(Path(tmp))
+        pairs = [(seq_len, stride) for seq_len, stride, _ in CASES if seq_len != 64]
+        for path in inputs:
+            for seq_len, stride, result in iter_packed_lengths(path, pairs, False, PAD_TOKEN_ID, False):
+                expected, expected_stats = reference_pack(paragraphs, seq_len, stride, False)
+                assert_same(result.sequences, result.stats, expected, expected_stats, f"{path.name} {seq_len}/{stride}")
+
+
+def test_stream_layout_windows_match_reference():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        paragraphs, inputs = sample_inputs(root)
+        for seq_len, stride, _ in CASES:
+            expected, _ = reference_pack(paragraphs, seq_len, stride, False)
+            dataset = SlidingWindowDataset(pack_file(inputs[1], root / f"stream_{seq_len}_{stride}.bin", seq_len, stride, "stream"))
+            windows = np.stack([np.asarray(dataset[i], dtype=np.int64) for i in range(len(dataset))])
+            assert np.array_equal(windows, expected), f"layout stream seq_len={seq_len} stride={stride}"
+
+
+def test_append_matches_packing_everything_at_once():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        first, second = make_paragraphs(20, seed=1), make_paragraphs(15, seed=2)
+        for seq_len, stride, _ in CASES:
+            store = pack_file(write_token_store(root / "first.bin", first), root / f"packed_{seq_len}_{stride}.bin", seq_len, stride)
+            new_tokens = write_token_store(root / "second.bin", second)
+            stats = new_pack_stats()
+            stream, scan = build_token_stream(new_tokens, PAD_TOKEN_ID, stats, False)
+            meta = append_to_packed(store, stream, scan, stats, str(new_tokens))
+            expected, _ = reference_pack(first + second, seq_len, stride, False)
+            rows = np.asarray(open_packed_bin(store, read_packed_meta(store)), dtype=np.int64)
+            assert meta["num_sequences"] == expected.shape[0], f"append {seq_len}/{stride}: {meta['num_sequences']}"
+            assert np.array_equal(rows, expected), f"append {seq_len}/{stride}: sequences khác"
+
+
+if __name__ == "__main__":
+    run_checks(globals())
@@ -0,0 +1,97 @@
+"""
+Resume chính xác: train liền 10 step vs train đến step 4 rồi resume từ checkpoint
+phải cho loss giống hệt ở step 5-10 (cùng batch, cùng dropout), với mọi nguồn
+dữ liệu train: packed `.bin` (rows / layout stream), thư mục shard, pack
+on-the-fly từ token store và từ JSONL. Các run (trừ JSONL, vốn không biết
+trước độ dài epoch) đều đi qua ranh giới epoch sau điểm resume.
+
+    python -m training.trainer.tests.test_resume
+"""
+
+from __future__ import annotations
+
+import tempfile
+from pathlib import Path
+from typing import Dict
+
+from .helpers import (
+    SEQ_LEN,
+    make_paragraphs,
+    pack_file,
+    read_events,
+    run_checks,
+    train_losses,
+    write_config,
+    write_token_store,
+    write_tokens_jsonl,
+)
+
+MAX_STEPS = 10
+RESUME_STEP = 4
+
+
+def assert_exact_resume(root: Path, paths: Dict[str, str], **training) -> None:
+    val_bin = pack_file(write_token_store(root / "val_tokens.bin", make_paragraphs(12, seed=99)), root / "val.bin")
+    config = write_config(root / "config.json", {"val_bin": str(val_bin), **paths}, max_steps=MAX_STEPS, **training)
+    full = train_losses(config, root / "full")
+    resumed = train_losses(config, root / "resumed", resume=root / "full" / f"checkpoint_step{RESUME_STEP}.pt")
+
+    assert sorted(full) == list(range(1, MAX_STEPS + 1)), full
+    assert sorted(resumed) == list(range(RESUME_STEP + 1, MAX_STEPS + 1)), resumed
+    for step, loss in resumed.items():
+        assert loss == full[step], f"step {step}: resume {loss!r} != liền mạch {full[step]!r}"
+    if training.get("eval_every"):
+        full_evals = {record["step"]: record["val_loss"] for record in read_events(root / "full", "eval")}
+        for record in read_events(root / "resumed", "eval"):
+            assert record["val_loss"] == full_evals[record["step"]], record
+
+
+def test_resume_packed_bin_with_eval_and_persistent_workers():
+    # Val loader persistent tạo iterator ở lần eval đầu của process → không được đụng RNG global.
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        train_bin = pack_file(write_tokens_jsonl(root / "train.jsonl", make_paragraphs(24)), root / "train.bin")
+        assert_exact_resume(
+            root,
+            {"train_bin": str(train_bin)},
+            eval_every=3,
+            max_eval_batches=2,
+            num_workers=2,
+            persistent_workers=True,
+        )
+
+
+def test_resume_sliding_window_stream():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        tokens = write_token_store(root / "train_tokens.bin", make_paragraphs(12))
+        train_bin = pack_file(tokens, root / "train_stream.bin", stride=SEQ_LEN // 2, layout="stream")
+        assert_exact_resume(root, {"train_bin": str(train_bin)})
+
+
+def test_resume_sharded():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        shard_dir = root / "shards"
+        for shard in range(3):
+            tokens = write_token_store(root / f"shard{shard}_tokens.bin", make_paragraphs(8, seed=shard))
+            pack_file(tokens, shard_dir / f"shard{shard}.bin")
+        assert_exact_resume(root, {"train_shards": str(shard_dir)}, num_workers=2)
+
+
+def test_resume_on_the_fly_token_store():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        tokens = write_token_store(root / "train_tokens.bin", make_paragraphs(24))
+        assert_exact_resume(root, {"train_tokens": str(tokens)}, seq_len=SEQ_LEN, num_workers=2)
+
+
+def test_resume_on_the_fly_jsonl():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        tokens = write_tokens_jsonl(root / "train.jsonl", make_paragraphs(60))
+        assert_exact_resume(root, {"train_tokens": str(tokens)}, seq_len=SEQ_LEN)
+
+
+if __name__ == "__main__":
+    run_checks(globals())
@@ -0,0 +1,168 @@
+"""
+Persistent tokenization cache keyed by tokenizer fingerprint and paragraph hash.
+
+Layout (one sub-directory per tokenizer model, so retraining the tokenizer
+never serves stale IDs):
+
+    <cache_dir>/<model_fingerprint>/
+        tokens.bin   : token IDs of every cached paragraph, concatenated
+        index.bin    : fixed-size records (key_hi, key_lo, offset, length)
+        cache.json   : header (fingerprint, dtype, model path)
+
+Keys are 128-bit BLAKE2b digests of the UTF-8 paragraph text. Both files are
+append-only: tokens are written before their index records, and a truncated
+trailing index record is ignored on load, so an interrupted run never
+corrupts the cache. New encodings are buffered as compact numpy arrays and
+flushed every `flush_tokens` tokens, so a cold run over a large corpus keeps
+only a bounded amount of pending tokens in RAM.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .token_store import open_token_array, token_dtype_for_vocab
+from .utils import ensure_dir
+
+
+INDEX_DTYPE = np.dtype(
+    [("key_hi", "<u8"), ("key_lo", "<u8"), ("offset", "<i8"), ("length", "<i4")]
+)
+DEFAULT_FLUSH_TOKENS = 1 << 22  # ~8 MB pending với uint16
+
+
+def file_fingerprint(path: Path, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 (rút gọn 16 hex) của nội dung file, dùng làm định danh tokenizer."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def text_key(text: str) -> tuple:
+    """128-bit BLAKE2b của paragraph, tách thành hai uint64 (hi, lo)."""
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+class TokenizationCache:
+    """On-disk map paragraph text → token IDs for one tokenizer model."""
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        model_path: Path,
+        vocab_size: int,
+        flush_tokens: int = DEFAULT_FLUSH_TOKENS,
+    ):
+        self.fingerprint = file_fingerprint(model_path)
+        self.directory = cache_dir / self.fingerprint
+        ensure_dir(self.directory)
+        self.tokens_path = self.directory / "tokens.bin"
+        self.index_path = self.directory / "index.bin"
+        self.header_path = self.directory / "cache.json"
+        self.dtype = token_dtype_for_vocab(vocab_size)
+        self.flush_tokens = flush_tokens
+
+        if self.header_path.exists():
+            with open(self.header_path, "r", encoding="utf-8") as f:
+                header = json.load(f)
+            if header.get("dtype") != self.dtype.name:
+                raise ValueError(
+                    f"Cache {self.directory} dùng dtype {header.get('dtype')}, "
+                    f"tokenizer hiện tại cần {self.dtype.name}."
+                )
+        else:
+            with open(self.header_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {"fingerprint": self.fingerprint, "dtype": self.dtype.name, "model_path": str(model_path)},
+                    f,
+                    ensure_ascii=False,
+                    indent=2,
+                )
+
+        self.hits = 0
+        self.misses = 0
+        self._pending: Dict[tuple, np.ndarray] = {}
+        self._pending_tokens = 0
+        self._load()
+
+    def _load(self) -> None:
+        index = np.empty(0, dtype=INDEX_DTYPE)
+        if self.index_path.exists():
+            raw = self.index_path.read_bytes()
+            usable = len(raw) - len(raw) % INDEX_DTYPE.itemsize
+            index = np.frombuffer(raw[:usable], dtype=INDEX_DTYPE)
+        order = np.lexsort((index["key_lo"], index["key_hi"]))
+        self._index = index[order]
+        num_tokens = 0
+        if len(self._index):
+            num_tokens = int((self._index["offset"] + self._index["length"]).max())
+        self._tokens = open_token_array(self.tokens_path, self.dtype, num_tokens)
+        self._num_tokens = num_tokens
+
+    def __len__(self) -> int:
+        return len(self._index) + len(self._pending)
+
+    def _lookup(self, key: tuple) -> Optional[List[int]]:
+        pending = self._pending.get(key)
+        if pending is not None:
+            return pending.tolist()
+        key_hi, key_lo = key
+        keys_hi = self._index["key_hi"]
+        pos = int(np.searchsorted(keys_hi, key_hi))
+        while pos < len(keys_hi) and keys_hi[pos] == key_hi:
+            entry = self._index[pos]
+            if entry["key_lo"] == key_lo:
+                start = int(entry["offset"])
+                return self._tokens[start:start + int(entry["length"])].tolist()
+            pos += 1
+        return None
+
+    def encode(self, text: str, encoder: Callable[[str], Sequence[int]]) -> List[int]:
+        """Trả về token IDs từ cache, hoặc gọi `encoder` và ghi nhớ kết quả."""
+        key = text_key(text)
+        cached = self._lookup(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        token_ids = list(encoder(text))
+        self._pending[key] = np.asarray(token_ids, dtype=self.dtype)
+        self._pending_tokens += len(token_ids)
+        if self._pending_tokens >= self.flush_tokens:
+            self.flush()
+        return token_ids
+
+    def flush(self) -> int:
+        """Ghi các encoding mới xuống đĩa. Trả về số entry vừa ghi."""
+        if not self._pending:
+            return 0
+        records = np.empty(len(self._pending), dtype=INDEX_DTYPE)
+        offset = self._num_tokens
+        self._tokens = None  # nhả memmap trước khi truncate/append (Windows không cho phép)
+        with open(self.tokens_path, "ab") as tokens_file:
+            tokens_file.truncate(offset * self.dtype.itemsize)
+            for row, ((key_hi, key_lo), token_ids) in enumerate(self._pending.items()):
+                token_ids.tofile(tokens_file)
+                records[row] = (key_hi, key_lo, offset, len(token_ids))
+                offset += len(token_ids)
+        with open(self.index_path, "ab") as index_file:
+            index_file.truncate(len(self._index) * INDEX_DTYPE.itemsize)
+            index_file.write(records.tobytes())
+        written = len(records)
+        self._pending.clear()
+        self._pending_tokens = 0
+        self._load()
+        return written
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
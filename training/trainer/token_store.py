@@ -0,0 +1,240 @@
+"""
+Compact binary token store for tokenized dataset splits.
+
+A token store replaces the `*_tokens.jsonl` layout (one JSON list of ints per
+paragraph) with a few flat files next to each other:
+
+- `<name>.bin`       : every paragraph's token IDs concatenated (uint16 when
+                       vocab_size <= 65536, otherwise uint32)
+- `<name>.idx.npy`   : int64 offsets, length `num_records + 1`; paragraph `i`
+                       is `tokens[offsets[i]:offsets[i + 1]]`
+- `<name>.meta.npz`  : optional metadata columns (int64, `-1` = missing;
+                       string fields are stored as category codes)
+- `<name>.json`      : header (dtype, counts, vocab_size, categories, ...)
+
+Readers memory-map the token stream and offsets with numpy, so opening a store
+is instant and a paragraph is a zero-copy slice.
+"""
+
+from __future__ import annotations
+
+import json
+from array import array
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .utils import ensure_dir
+
+
+TOKEN_STORE_FORMAT = "token_store"
+TOKEN_STORE_VERSION = 1
+TOKEN_STORE_SUFFIX = ".bin"
+MISSING_VALUE = -1
+
+
+def token_dtype_for_vocab(vocab_size: int) -> np.dtype:
+    """Smallest unsigned dtype that can hold every token ID of the vocabulary."""
+    if vocab_size <= np.iinfo(np.uint16).max + 1:
+        return np.dtype(np.uint16)
+    return np.dtype(np.uint32)
+
+
+def token_store_paths(bin_path: Path) -> Dict[str, Path]:
+    """Return the companion file paths of a token store given its `.bin` path."""
+    base = str(bin_path.with_suffix(""))
+    return {
+        "tokens": bin_path,
+        "offsets": Path(base + ".idx.npy"),
+        "metadata": Path(base + ".meta.npz"),
+        "header": Path(base + ".json"),
+    }
+
+
+def read_header(bin_path: Path) -> Dict[str, Any]:
+    """Load the JSON header that sits next to a `.bin` file."""
+    header_path = token_store_paths(bin_path)["header"]
+    if not header_path.exists():
+        raise FileNotFoundError(f"Không tìm thấy header cho {bin_path}: {header_path}")
+    with open(header_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def is_token_store(path: Path) -> bool:
+    """True if `path` is a `.bin` token store written by `TokenStoreWriter`."""
+    if path.suffix != TOKEN_STORE_SUFFIX:
+        return False
+    try:
+        return read_header(path).get("format") == TOKEN_STORE_FORMAT
+    except FileNotFoundError:
+        return False
+
+
+def open_token_array(path: Path, dtype: np.dtype, count: int) -> np.ndarray:
+    """Memory-map a raw token file read-only (`np.memmap` refuses empty files)."""
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+class TokenStoreWriter:
+    """Append paragraphs to a token store; call `close()` to write index + header."""
+
+    def __init__(
+        self,
+        path: Path,
+        vocab_size: int,
+        metadata_fields: Sequence[str] = (),
+        split: Optional[str] = None,
+    ):
+        ensure_dir(path.parent)
+        self.path = path
+        self.paths = token_store_paths(path)
+        self.vocab_size = vocab_size
+        self.dtype = token_dtype_for_vocab(vocab_size)
+        self.split = split
+        self.metadata_fields = list(metadata_fields)
+        self._file = open(path, "wb")
+        self._offsets = array("q", [0])
+        self._columns: Dict[str, array] = {field: array("q") for field in self.metadata_fields}
+        self._categories: Dict[str, Dict[str, int]] = {}
+        self._kinds: Dict[str, str] = {}  # field → "str" | "int", cố định từ giá trị đầu tiên
+        self._closed = False
+
+    @property
+    def num_records(self) -> int:
+        return len(self._offsets) - 1
+
+    @property
+    def num_tokens(self) -> int:
+        return self._offsets[-1]
+
+    def _encode_value(self, field: str, value: Any) -> int:
+        if value is None:
+            return MISSING_VALUE
+        kind = "str" if isinstance(value, str) else "int"
+        if self._kinds.setdefault(field, kind) != kind:
+            raise ValueError(f"Field '{field}' lẫn kiểu str và số: {value!r} (trước đó là {self._kinds[field]})")
+        if kind == "str":
+            codes = self._categories.setdefault(field, {})
+            if value not in codes:
+                codes[value] = len(codes)
+            return codes[value]
+        # Cột là int64: không để float bị cắt hay bool thành 0/1 một cách im lặng.
+        if isinstance(value, (bool, np.bool_)) or not isinstance(value, (int, float, np.integer, np.floating)):
+            raise ValueError(f"Field '{field}' chỉ nhận str hoặc số nguyên, nhận {value!r}")
+        if isinstance(value, (float, np.floating)) and not float(value).is_integer():
+            raise ValueError(f"Field '{field}' chỉ lưu số nguyên, nhận {value!r}")
+        return int(value)
+
+    def add(self, token_ids: Sequence[int], metadata: Optional[Dict[str, Any]] = None) -> None:
+        """Append one paragraph (and its metadata fields, if configured)."""
+        tokens = np.asarray(token_ids, dtype=self.dtype)
+        tokens.tofile(self._file)
+        self._offsets.append(self._offsets[-1] + tokens.size)
+        for field, column in self._columns.items():
+            value = metadata.get(field) if metadata else None
+            column.append(self._encode_value(field, value))
+
+    def close(self, extra_header: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Flush the token stream and write offsets, metadata columns and header."""
+        if self._closed:
+            raise RuntimeError(f"TokenStoreWriter cho {self.path} đã đóng.")
+        self._file.close()
+        self._closed = True
+
+        np.save(self.paths["offsets"], np.frombuffer(self._offsets, dtype=np.int64))
+        if self._columns:
+            np.savez_compressed(
+                self.paths["metadata"],
+                **{field: np.frombuffer(column, dtype=np.int64) for field, column in self._columns.items()},
+            )
+
+        header: Dict[str, Any] = {
+            "format": TOKEN_STORE_FORMAT,
+            "version": TOKEN_STORE_VERSION,
+            "dtype": self.dtype.name,
+            "vocab_size": self.vocab_size,
+            "num_records": self.num_records,
+            "num_tokens": self.num_tokens,
+            "split": self.split,
+            "metadata_fields": self.metadata_fields,
+            "categories": {
+                field: sorted(codes, key=codes.__getitem__) for field, codes in self._categories.items()
+            },
+        }
+        if extra_header:
+            header.update(extra_header)
+        with open(self.paths["header"], "w", encoding="utf-8") as f:
+            json.dump(header, f, ensure_ascii=False, indent=2)
+        return header
+
+    def __enter__(self) -> "TokenStoreWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self._closed:
+            return
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            self._closed = True
+
+
+class TokenStore:
+    """Read-only, memory-mapped view over a token store."""
+
+    def __init__(self, path: Path):
+        if not path.exists():
+            raise FileNotFoundError(f"Không tìm thấy token store: {path}")
+        self.path = path
+        self.paths = token_store_paths(path)
+        self.header = read_header(path)
+        if self.header.get("format") != TOKEN_STORE_FORMAT:
+            raise ValueError(f"{path} không phải token store (format={self.header.get('format')!r})")
+        self.dtype = np.dtype(self.header["dtype"])
+        self.tokens = open_token_array(path, self.dtype, self.header["num_tokens"])
+        self.offsets: np.ndarray = np.load(self.paths["offsets"], mmap_mode="r")
+        self._metadata: Optional[Dict[str, np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        return self.tokens[self.offsets[idx]:self.offsets[idx + 1]]
+
+    @property
+    def num_tokens(self) -> int:
+        return int(self.header["num_tokens"])
+
+    def lengths(self) -> np.ndarray:
+        """Token count of every paragraph."""
+        return np.diff(self.offsets)
+
+    def _load_metadata(self) -> Dict[str, np.ndarray]:
+        if self._metadata is None:
+            meta_path = self.paths["metadata"]
+            if meta_path.exists():
+                with np.load(meta_path) as columns:
+                    self._metadata = {field: columns[field] for field in columns.files}
+            else:
+                self._metadata = {}
+        return self._metadata
+
+    def metadata(self, idx: int) -> Dict[str, Any]:
+        """Decode the metadata fields stored for paragraph `idx` (missing fields omitted)."""
+        categories: Dict[str, List[str]] = self.header.get("categories", {})
+        record: Dict[str, Any] = {}
+        for field, column in self._load_metadata().items():
+            value = int(column[idx])
+            if value == MISSING_VALUE:
+                continue
+            record[field] = categories[field][value] if field in categories else value
+        return record
+
+    def iter_records(self, include_metadata: bool = False) -> Iterator[Tuple[np.ndarray, Dict[str, Any]]]:
+        """Yield `(token_ids, metadata)` pairs in storage order."""
+        for idx in range(len(self)):
+            yield self[idx], (self.metadata(idx) if include_metadata else {})
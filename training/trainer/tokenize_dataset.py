@@ -1,8 +1,9 @@
 """
 Convert cleaned dataset splits into token IDs using SentencePiece.
 
-The script reads JSONL splits (`train/val/test.jsonl`) and produces
-JSONL files that contain SentencePiece token IDs plus basic metadata.
+The script reads JSONL splits (`train/val/test.jsonl`) and produces either
+JSONL files that contain SentencePiece token IDs plus basic metadata, or a
+compact binary token store (`--format bin`, see `token_store.py`).
 It does NOT run any training by itself.
 """
 
@@ -10,14 +11,23 @@ from __future__ import annotations
 
 import argparse
 import json
+import time
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Iterable, List, Sequence
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import sentencepiece as spm
 
 from .config import Paths
-from .utils import ensure_dir, read_jsonl, setup_encoding
+from .token_cache import TokenizationCache
+from .token_store import TOKEN_STORE_SUFFIX, TokenStoreWriter
+from .utils import ensure_dir, read_jsonl, save_json, setup_encoding
+from .vocab_stats import (
+    DEFAULT_BIGRAM_TOP_K,
+    TokenHistogram,
+    build_vocab_report,
+    save_histograms,
+)
 
 
 AVAILABLE_SPLITS = {
@@ -40,12 +50,19 @@ METADATA_FIELDS: Sequence[str] = (
     "global_paragraph_index",
 )
 
+OUTPUT_FORMATS: Sequence[str] = ("jsonl", "bin")
+
+DEFAULT_CACHE_DIR = Paths.TOKENIZED_DIR / "cache"
+
 
 @dataclass
 class TokenizationStats:
     total_records: int = 0
     total_tokens: int = 0
     max_tokens: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    seconds: float = 0.0
 
     def update(self, token_count: int) -> None:
         self.total_records += 1
@@ -59,19 +76,55 @@ class TokenizationStats:
             return 0.0
         return self.total_tokens / self.total_records
 
+    @property
+    def cache_hit_rate(self) -> float:
+        lookups = self.cache_hits + self.cache_misses
+        if lookups == 0:
+            return 0.0
+        return self.cache_hits / lookups
+
 
 class DatasetTokenizer:
     """Tokenize JSONL dataset splits into SentencePiece token IDs."""
 
-    def __init__(self, model_path: Path):
+    def __init__(self, model_path: Path, cache_dir: Optional[Path] = None):
         if not model_path.exists():
             raise FileNotFoundError(f"Tokenizer model not found: {model_path}")
         self.processor = spm.SentencePieceProcessor(model_file=str(model_path))
+        self.cache: Optional[TokenizationCache] = None
+        if cache_dir is not None:
+            self.cache = TokenizationCache(cache_dir, model_path, self.vocab_size)
+
+    @property
+    def vocab_size(self) -> int:
+        return self.processor.get_piece_size()
 
     def tokenize_text(self, text: str) -> List[int]:
-        """Return SentencePiece token IDs for the provided text."""
+        """Return SentencePiece token IDs for the provided text (cached if enabled)."""
+        if self.cache is not None:
+            return self.cache.encode(text, self._encode)
+        return self._encode(text)
+
+    def _encode(self, text: str) -> List[int]:
         return self.processor.encode(text, out_type=int)
 
+    def _iter_encoded(
+        self,
+        records: Iterable[Dict],
+        stats: TokenizationStats,
+        histogram: Optional[TokenHistogram] = None,
+    ) -> Iterator[Tuple[Dict, List[int]]]:
+        for record in records:
+            text = record.get("text", "")
+            if not text:
+                continue
+
+            token_ids = self.tokenize_text(text)
+            stats.update(len(token_ids))
+            if histogram is not None:
+                histogram.add(token_ids)
+            yield record, token_ids
+
     def tokenize_split(
         self,
         split_name: str,
@@ -79,36 +132,55 @@ class DatasetTokenizer:
         output_path: Path,
         include_metadata: bool = True,
         show_progress: bool = False,
+        output_format: str = "jsonl",
+        histogram: Optional[TokenHistogram] = None,
     ) -> TokenizationStats:
-        """Tokenize one dataset split and write tokens to JSONL."""
+        """Tokenize one dataset split and write tokens to JSONL or a binary token store.
+
+        If `histogram` is given, every encoded paragraph is also counted into it.
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"output_format phải là một trong {OUTPUT_FORMATS}, nhận {output_format!r}")
         ensure_dir(output_path.parent)
         stats = TokenizationStats()
+        started = time.perf_counter()
+        if self.cache is not None:
+            hits_before, misses_before = self.cache.hits, self.cache.misses
 
         iterator: Iterable[Dict] = read_jsonl(input_path, show_progress=show_progress)
-
-        with open(output_path, "w", encoding="utf-8") as output_file:
-            for index, record in enumerate(iterator):
-                text = record.get("text", "")
-                if not text:
-                    continue
-
-                token_ids = self.tokenize_text(text)
-                token_count = len(token_ids)
-                stats.update(token_count)
-
-                output_record: Dict = {
-                    "input_ids": token_ids,
-                    "token_count": token_count,
-                    "split": split_name,
-                }
-
-                if include_metadata:
-                    for field in METADATA_FIELDS:
-                        if field in record:
-                            output_record[field] = record[field]
-
-                output_file.write(json.dumps(output_record, ensure_ascii=False) + "\n")
-
+        encoded = self._iter_encoded(iterator, stats, histogram)
+
+        if output_format == "bin":
+            metadata_fields = METADATA_FIELDS if include_metadata else ()
+            with TokenStoreWriter(
+                output_path, self.vocab_size, metadata_fields=metadata_fields, split=split_name
+            ) as writer:
+                for record, token_ids in encoded:
+                    writer.add(token_ids, record)
+        else:
+            with open(output_path, "w", encoding="utf-8") as output_file:
+                for record, token_ids in encoded:
+                    output_record: Dict = {
+                        "input_ids": token_ids,
+                        "token_count": len(token_ids),
+                        "split": split_name,
+                    }
+
+                    if include_metadata:
+                        for field in METADATA_FIELDS:
+                            if field in record:
+                                output_record[field] = record[field]
+
+                    output_file.write(json.dumps(output_record, ensure_ascii=False) + "\n")
+
+        if self.cache is not None:
+            self.cache.flush()
+            stats.cache_hits = self.cache.hits - hits_before
+            stats.cache_misses = self.cache.misses - misses_before
+        if histogram is not None:
+            histogram.flush()
+
+        stats.seconds = time.perf_counter() - started
         return stats
 
 
@@ -135,11 +207,40 @@ def parse_args() -> argparse.Namespace:
         default=Paths.TOKENIZED_DIR,
         help="Thư mục lưu JSONL tokenized.",
     )
+    parser.add_argument(
+        "--format",
+        choices=list(OUTPUT_FORMATS),
+        default="jsonl",
+        help="Định dạng output: jsonl (mặc định) hoặc bin (uint16 token stream + offsets, mmap được).",
+    )
     parser.add_argument(
         "--include-metadata",
         action="store_true",
         help="Ghi kèm metadata (novel_name, chapter_index, ...).",
     )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=DEFAULT_CACHE_DIR,
+        help="Thư mục cache token IDs theo (fingerprint tokenizer, hash paragraph).",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Tắt cache, encode lại toàn bộ paragraph.",
+    )
+    parser.add_argument(
+        "--vocab-report",
+        type=Path,
+        default=None,
+        help="Ghi báo cáo sử dụng vocabulary (dead tokens, Zipf, coverage từng split) ra file JSON.",
+    )
+    parser.add_argument(
+        "--bigram-top-k",
+        type=int,
+        default=DEFAULT_BIGRAM_TOP_K,
+        help="Số token phổ biến nhất được đếm bigram trong vocab report (0 = tắt).",
+    )
     parser.add_argument(
         "--show-progress",
         action="store_true",
@@ -151,14 +252,29 @@ def parse_args() -> argparse.Namespace:
 def main() -> None:
     setup_encoding()
     args = parse_args()
-    tokenizer = DatasetTokenizer(args.tokenizer_model)
+    cache_dir = None if args.no_cache else args.cache_dir
+    tokenizer = DatasetTokenizer(args.tokenizer_model, cache_dir=cache_dir)
+    if tokenizer.cache is not None:
+        print(
+            f"🗃️ Token cache: {tokenizer.cache.directory} "
+            f"({len(tokenizer.cache):,} paragraphs đã cache)"
+        )
+
+    histograms: Dict[str, TokenHistogram] = {}
+    tokenize_seconds = 0.0
 
     for split_name in args.splits:
+        histogram = None
+        if args.vocab_report:
+            histogram = TokenHistogram(tokenizer.vocab_size, bigram_top_k=args.bigram_top_k)
+            histograms[split_name] = histogram
         input_path = AVAILABLE_SPLITS[split_name]
         output_file = DEFAULT_OUTPUT_FILES[split_name]
         if args.output_dir:
             ensure_dir(args.output_dir)
             output_file = args.output_dir / output_file.name
+        if args.format == "bin":
+            output_file = output_file.with_suffix(TOKEN_STORE_SUFFIX)
 
         print(f"🔁 Tokenizing split '{split_name}' → {output_file}")
         stats = tokenizer.tokenize_split(
@@ -167,12 +283,37 @@ def main() -> None:
             output_path=output_file,
             include_metadata=args.include_metadata,
             show_progress=args.show_progress,
+            output_format=args.format,
+            histogram=histogram,
         )
+        tokenize_seconds += stats.seconds
 
         print(
             f"✅ {split_name}: {stats.total_records:,} records | "
             f"avg tokens {stats.avg_tokens:.1f} | max tokens {stats.max_tokens}"
         )
+        if tokenizer.cache is not None:
+            print(
+                f"   cache: {stats.cache_hits:,} hit / {stats.cache_misses:,} miss "
+                f"({stats.cache_hit_rate:.1%} hit rate)"
+            )
+
+    if args.vocab_report:
+        report = build_vocab_report(histograms, tokenizer.processor)
+        histogram_seconds = sum(h.seconds for h in histograms.values())
+        report["histogram_overhead"] = {
+            "histogram_seconds": histogram_seconds,
+            "tokenize_seconds": tokenize_seconds,
+            "ratio": histogram_seconds / tokenize_seconds if tokenize_seconds else 0.0,
+        }
+        save_json(args.vocab_report, report)
+        save_histograms(args.vocab_report.with_suffix(".npz"), histograms)
+        print(
+            f"📊 Vocab: dùng {report['used_tokens']:,}/{report['vocab_size']:,} ids "
+            f"({report['coverage']:.1%}) | dead={report['dead_tokens']['count']:,} | "
+            f"zipf s={report['zipf']['exponent'] or 0:.2f} | "
+            f"overhead {report['histogram_overhead']['ratio']:.1%} → {args.vocab_report}"
+        )
 
 
 if __name__ == "__main__":
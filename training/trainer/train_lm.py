@@ -1,10 +1,16 @@
 """
-Huấn luyện GPT-style LM trên dữ liệu đã pack (.pt) – tối ưu cho Kaggle GPU.
+Huấn luyện GPT-style LM trên dữ liệu đã pack (.pt hoặc .bin) – tối ưu cho Kaggle GPU.
 
 Pipeline:
 1. Tokenize paragraphs → training/trainer/tokenize_dataset.py
 2. Pack thành fixed-length sequences → training/trainer/pack_tokenized_dataset.py
 3. Train model → script này (train_lm.py)
+
+Corpus lớn hơn RAM: pack thành nhiều shard `.bin` trong một thư mục rồi đặt
+`paths.train_shards` trong config → ShardedPackedDataset stream từng shard.
+
+Nhiều GPU/process: `torchrun --nproc_per_node=N -m training.trainer.train_lm ...`
+(DDP, xem `distributed.py`).
 """
 
 from __future__ import annotations
@@ -12,53 +18,610 @@ from __future__ import annotations
 import argparse
 import json
 import math
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from itertools import islice
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Sampler, Subset, get_worker_info
 from transformers import (
     GPT2Config,
     GPT2LMHeadModel,
     get_linear_schedule_with_warmup,
 )
 
+from .packed_store import (
+    PACKED_STREAM_FORMAT,
+    is_packed_bin,
+    open_packed_bin,
+    open_packed_stream,
+    read_packed_meta,
+)
+from .checkpointing import (
+    AsyncCheckpointer,
+    CheckpointManager,
+    StateSnapshotter,
+    build_payload,
+    load_checkpoint,
+    write_checkpoint,
+)
+from .activation_checkpointing import checkpoint_blocks, checkpoint_label
+from .async_eval import AsyncEvaluator
+from .auto_batch import find_micro_batch, write_result
+from .device_prefetch import DataWaitTimer, iter_device_batches
+from .distributed import (
+    DistInfo,
+    all_reduce,
+    broadcast_object,
+    cleanup_distributed,
+    gather_rng_state,
+    init_distributed,
+    restore_rank_rng_state,
+)
+from .pack_tokenized_dataset import iter_token_ids, new_pack_stats
+from .train_metrics import TrainMetrics
+from .token_store import is_token_store, token_store_paths
 from .utils import ensure_dir, setup_encoding
 
 
+def collate_token_rows(rows: List) -> Dict[str, torch.Tensor]:
+    """Stack một batch row (numpy/memmap hoặc tensor) thành LongTensor [B, L] bằng một lần copy.
+
+    Labels/attention_mask không được tạo ở đây mà trong `lm_inputs`, sau khi
+    batch đã lên device.
+    """
+    if isinstance(rows[0], torch.Tensor):
+        return {"input_ids": torch.stack(rows).long()}
+    return {"input_ids": torch.from_numpy(np.stack(rows).astype(np.int64, copy=False))}
+
+
+def lm_inputs(input_ids: torch.Tensor, pad_token_id: int, use_attention_mask: bool = True) -> Dict[str, torch.Tensor]:
+    """Causal labels (padding = -100) và attention_mask cho cả batch bằng một phép so sánh."""
+    is_pad = input_ids == pad_token_id
+    batch = {"input_ids": input_ids, "labels": input_ids.masked_fill(is_pad, -100)}  # bỏ padding khỏi loss
+    if use_attention_mask:
+        batch["attention_mask"] = (~is_pad).long()
+    return batch
+
+
+def warmup_seq_len(step: int, full_len: int, start: int, warmup_steps: int) -> int:
+    """Context length tại optimizer step `step` khi bật sequence-length warmup.
+
+    Tăng tuyến tính từ `start` lên `full_len` trong `warmup_steps` step, làm tròn
+    xuống độ dài lớn nhất là bội của `start` và chia hết `full_len` (để cắt mỗi
+    row packed thành các window liền nhau, ví dụ 128 → 256 → 512 → 1024).
+    """
+    if warmup_steps <= 0 or start <= 0 or start >= full_len or step >= warmup_steps:
+        return full_len
+    target = start + (full_len - start) * step / warmup_steps
+    current = start
+    for length in range(start, full_len, start):
+        if length > target:
+            break
+        if full_len % length == 0:
+            current = length
+    return current
+
+
+def split_rows(batch: Dict[str, torch.Tensor], seq_len: int) -> Dict[str, torch.Tensor]:
+    """Cắt batch [B, L] thành [B * L / seq_len, seq_len] (cùng số token → batch lớn hơn, context ngắn hơn).
+
+    Window toàn padding (đuôi của row được pad) bị bỏ vì không còn token nào để attend.
+    """
+    if batch["input_ids"].size(1) == seq_len:
+        return batch
+    split = {key: value.reshape(-1, seq_len) for key, value in batch.items()}
+    if "attention_mask" in split:
+        keep = split["attention_mask"].any(dim=1)
+        split = {key: value[keep] for key, value in split.items()}
+    return split
+
+
+def needs_attention_mask(meta: Dict) -> bool:
+    """False khi pack meta xác nhận không có sequence nào bị pad (padded_sequences == 0)."""
+    return meta.get("padded_sequences") != 0
+
+
 class PackedTensorDataset(Dataset):
-    """Dataset đọc tensor sequences (shape [N, seq_len]) và trả về causal labels."""
+    """Dataset đọc tensor sequences (shape [N, seq_len]) và trả về causal labels.
+
+    Nhận `.pt` (torch pickle, load toàn bộ vào RAM) hoặc packed store `.bin`
+    (memory-map, chỉ convert row được sample sang int64).
+    """
 
     def __init__(self, tensor_path: Path, pad_token_id: int = 0):
         if not tensor_path.exists():
             raise FileNotFoundError(f"Không tìm thấy tensor: {tensor_path}")
-        payload = torch.load(tensor_path)
-        if "input_ids" not in payload:
-            raise KeyError(f"File {tensor_path} không chứa key 'input_ids'")
-        self.input_ids = payload["input_ids"].long()
-        self.meta = payload.get("meta", {})
+        self.tensor_path = tensor_path
+        self.pad_token_id = pad_token_id
+        self.input_ids: Optional[torch.Tensor] = None
+        self._array: Optional[np.ndarray] = None
+        if is_packed_bin(tensor_path):
+            self.meta = read_packed_meta(tensor_path)
+            self._num_rows = int(self.meta["num_sequences"])
+        else:
+            payload = torch.load(tensor_path)
+            if "input_ids" not in payload:
+                raise KeyError(f"File {tensor_path} không chứa key 'input_ids'")
+            self.input_ids = payload["input_ids"].long()
+            self.meta = payload.get("meta", {})
+            self._num_rows = self.input_ids.size(0)
+
+    @property
+    def array(self) -> np.ndarray:
+        # Mở memmap lazily để mỗi DataLoader worker tự map file thay vì pickle dữ liệu.
+        if self._array is None:
+            self._array = open_packed_bin(self.tensor_path, self.meta)
+        return self._array
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+    def __len__(self) -> int:
+        return self._num_rows
+
+    def __getitem__(self, idx: int):
+        # Trả về row thô (tensor hoặc view memmap); collate_token_rows stack cả batch.
+        if self.input_ids is not None:
+            return self.input_ids[idx]
+        return self.array[idx]
+
+
+class SlidingWindowDataset(Dataset):
+    """Dataset đọc packed layout stream: lưu token stream một lần, cắt window khi sample.
+
+    Window `i` là slice zero-copy `stream[i * stride : i * stride + seq_len]` của
+    memmap; chỉ window cuối (remainder, nếu được giữ) cần padding.
+    """
+
+    def __init__(self, stream_path: Path, pad_token_id: int = 0):
+        if not stream_path.exists():
+            raise FileNotFoundError(f"Không tìm thấy token stream: {stream_path}")
+        self.stream_path = stream_path
         self.pad_token_id = pad_token_id
+        self.meta = read_packed_meta(stream_path)
+        if self.meta.get("format") != PACKED_STREAM_FORMAT:
+            raise ValueError(f"{stream_path} không phải packed layout stream.")
+        self.seq_len = int(self.meta["seq_len"])
+        self.stride = int(self.meta["stride"])
+        self._num_windows = int(self.meta["num_sequences"])
+        self._stream: Optional[np.ndarray] = None
+
+    @property
+    def stream(self) -> np.ndarray:
+        if self._stream is None:
+            self._stream = open_packed_stream(self.stream_path, self.meta)
+        return self._stream
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state["_stream"] = None
+        return state
 
     def __len__(self) -> int:
-        return self.input_ids.size(0)
-
-    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
-        ids = self.input_ids[idx]
-        attention_mask = (ids != self.pad_token_id).long()
-        labels = ids.clone()
-        labels[ids == self.pad_token_id] = -100  # bỏ padding khỏi loss
-        return {
-            "input_ids": ids,
-            "labels": labels,
-            "attention_mask": attention_mask,
+        return self._num_windows
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if idx < 0:
+            idx += self._num_windows
+        start = idx * self.stride
+        window = self.stream[start:start + self.seq_len]
+        if window.shape[0] == self.seq_len:
+            return window
+        ids = np.full(self.seq_len, self.pad_token_id, dtype=np.int64)
+        ids[: window.shape[0]] = window
+        return ids
+
+
+def buffered_shuffle(items: Iterable, buffer_size: int, rng: np.random.Generator) -> Iterator:
+    """Shuffle xấp xỉ một stream bằng buffer cố định (buffer_size <= 1 → giữ nguyên thứ tự)."""
+    if buffer_size <= 1:
+        yield from items
+        return
+    buffer: List = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        slot = int(rng.integers(len(buffer)))
+        yield buffer[slot]
+        buffer[slot] = item
+    for slot in (rng.permutation(len(buffer)) if buffer else []):
+        yield buffer[slot]
+
+
+class DataResumeState:
+    """Epoch + data state (epoch, số batch đã tiêu thụ) dùng chung cho dataset stream và sampler."""
+
+    def __init__(self, batch_size: int, seed: int):
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.rank = 0
+        self.num_replicas = 1
+        self._resume: Optional[Tuple[int, int]] = None  # (epoch, batches đã tiêu thụ)
+
+    def set_rank(self, rank: int, num_replicas: int) -> None:
+        """DDP: rank này chỉ đọc phần dữ liệu của mình (batches trong data state tính theo rank)."""
+        self.rank = rank
+        self.num_replicas = num_replicas
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        if self._resume is not None and self._resume[0] != epoch:
+            self._resume = None
+
+    def fingerprint(self) -> Dict:
+        """Cấu hình cần giữ nguyên để resume chính xác."""
+        fingerprint = {"seed": self.seed, "batch_size": self.batch_size}
+        if self.num_replicas > 1:
+            fingerprint["num_replicas"] = self.num_replicas
+        return fingerprint
+
+    def state_dict(self, epoch: int, batches: int) -> Dict:
+        return {"epoch": epoch, "batches": batches, **self.fingerprint()}
+
+    def load_state_dict(self, state: Dict) -> None:
+        changed = {
+            key: (state.get(key), value) for key, value in self.fingerprint().items() if state.get(key) != value
         }
+        if changed:
+            print(f"⚠️ Data state khác cấu hình hiện tại {changed}; resume không còn chính xác tuyệt đối.")
+        self._resume = (int(state["epoch"]), int(state["batches"]))
+        self.epoch = self._resume[0]
+
+
+class ResumableRandomSampler(DataResumeState, Sampler):
+    """Random sampler cho dataset map-style, resume chính xác giữa epoch.
+
+    Hoán vị của epoch `e` sinh lại được từ `seed + e`, nên data state chỉ cần
+    (epoch, số batch đã tiêu thụ); resume cắt hoán vị tại `batches * batch_size`
+    mà không phải đọc lại các sample đã train.
+
+    DDP (`num_replicas > 1`): mọi rank sinh cùng hoán vị, lặp lại đầu hoán vị
+    cho chia hết `num_replicas` rồi rank `r` lấy `perm[r::num_replicas]` → các
+    rank có cùng số sample mỗi epoch và cùng data state.
+    """
+
+    def __init__(self, num_samples: int, batch_size: int, seed: int, num_replicas: int = 1, rank: int = 0):
+        DataResumeState.__init__(self, batch_size, seed)
+        self.set_rank(rank, num_replicas)
+        self.num_samples = num_samples
+        self.rank_samples = math.ceil(num_samples / num_replicas)
+
+    def fingerprint(self) -> Dict:
+        return {**super().fingerprint(), "num_samples": self.num_samples}
+
+    def permutation(self, epoch: int) -> torch.Tensor:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        perm = torch.randperm(self.num_samples, generator=generator)
+        if self.num_replicas == 1:
+            return perm
+        padding = self.rank_samples * self.num_replicas - self.num_samples
+        perm = torch.cat([perm, perm.repeat(math.ceil(padding / max(self.num_samples, 1)))[:padding]])
+        return perm[self.rank::self.num_replicas]
+
+    def _skip(self) -> int:
+        if self._resume is None or self._resume[0] != self.epoch:
+            return 0
+        return min(self._resume[1] * self.batch_size, self.rank_samples)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.permutation(self.epoch)[self._skip():].tolist())
+
+    def __len__(self) -> int:
+        return self.rank_samples - self._skip()
+
+
+class StreamingDataset(DataResumeState, IterableDataset):
+    """Nền chung cho dataset stream: epoch, data state và resume theo số batch.
+
+    Training loop lưu (epoch, số batch đã tiêu thụ) vào checkpoint. DataLoader
+    lấy batch luân phiên theo thứ tự worker và bỏ qua worker đã hết dữ liệu,
+    nên từ số batch của từng worker (`worker_batch_counts`) có thể tính lại
+    chính xác worker nào đã yield bao nhiêu batch (`resume_plan`). Lớp con
+    implement `iter_worker(role, num_workers, skip)` và bỏ qua `skip` sample
+    đầu của vai trò worker `role`.
+
+    DDP: `set_rank(rank, num_replicas)` → worker `w` của rank `r` đóng vai
+    worker toàn cục `r * num_workers + w` trong `num_replicas * num_workers`.
+    """
+
+    def __init__(self, pad_token_id: int, batch_size: int, seed: int):
+        DataResumeState.__init__(self, batch_size, seed)
+        self.pad_token_id = pad_token_id
+
+    def worker_batch_counts(self, num_workers: int) -> Optional[List[int]]:
+        """Số batch mỗi worker sẽ yield trong epoch hiện tại (None nếu không biết trước)."""
+        return None
+
+    def rank_batch_counts(self, num_workers: int) -> Optional[List[int]]:
+        """`worker_batch_counts` cho các worker của rank hiện tại."""
+        counts = self.worker_batch_counts(num_workers * self.num_replicas)
+        if counts is None:
+            return None
+        return counts[self.rank * num_workers:(self.rank + 1) * num_workers]
+
+    def resume_plan(self, batches: int, num_workers: int) -> Tuple[List[int], int]:
+        """Số batch mỗi worker đã yield sau `batches` batch, và worker sẽ cho batch kế tiếp."""
+        available = self.rank_batch_counts(num_workers) or [batches + 1] * num_workers
+        consumed = [0] * num_workers
+        start = 0
+        remaining = batches
+        while remaining > 0:
+            active = [w for w in range(num_workers) if consumed[w] < available[w]]
+            if not active:
+                break
+            rounds = min(remaining // len(active), min(available[w] - consumed[w] for w in active))
+            if rounds == 0:
+                active = active[:remaining]
+                rounds = 1
+            for w in active:
+                consumed[w] += rounds
+            remaining -= rounds * len(active)
+            start = (active[-1] + 1) % num_workers
+        return consumed, start
+
+    def iter_worker(self, role: int, num_workers: int, skip: int) -> Iterator[np.ndarray]:
+        raise NotImplementedError
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker else (0, 1)
+        offset, total = self.rank * num_workers, self.num_replicas * num_workers
+        if self._resume is None or self._resume[0] != self.epoch:
+            return self.iter_worker(offset + worker_id, total, 0)
+        # DataLoader mới bắt đầu lại từ worker 0, trong khi batch kế tiếp thuộc
+        # worker `start` của lần chạy trước → xoay vai trò worker.
+        consumed, start = self.resume_plan(self._resume[1], num_workers)
+        role = (worker_id + start) % num_workers
+        return self.iter_worker(offset + role, total, consumed[role] * self.batch_size)
+
+
+class ShardedPackedDataset(StreamingDataset):
+    """Stream sequences từ một thư mục packed shard `.bin` (corpus lớn hơn RAM).
+
+    - Mỗi epoch, thứ tự shard được hoán vị theo (seed, epoch); worker `w` trong
+      `W` DataLoader worker đọc các shard `order[w::W]`.
+    - Shuffle buffer chứa chỉ số (shard, row) chứ không chứa dữ liệu, row chỉ
+      được đọc từ memmap khi yield → resume chỉ cần chạy lại dãy chỉ số.
+    """
+
+    def __init__(
+        self,
+        shard_dir: Path,
+        pad_token_id: int = 0,
+        batch_size: int = 1,
+        shuffle_buffer: int = 10000,
+        shuffle_shards: bool = True,
+        seed: int = 42,
+        max_open_shards: int = 8,
+    ):
+        super().__init__(pad_token_id, batch_size, seed)
+        if not shard_dir.is_dir():
+            raise FileNotFoundError(f"Không tìm thấy thư mục shard: {shard_dir}")
+        self.shard_paths: List[Path] = sorted(path for path in shard_dir.glob("*.bin") if is_packed_bin(path))
+        if not self.shard_paths:
+            raise FileNotFoundError(f"Không có packed shard .bin nào trong {shard_dir}")
+        self.shard_metas = [read_packed_meta(path) for path in self.shard_paths]
+        for path, meta in zip(self.shard_paths, self.shard_metas):
+            if meta.get("format") == PACKED_STREAM_FORMAT:
+                raise ValueError(f"Shard {path} là layout stream; ShardedPackedDataset cần layout rows.")
+        seq_lens = {int(meta["seq_len"]) for meta in self.shard_metas}
+        if len(seq_lens) != 1:
+            raise ValueError(f"Các shard trong {shard_dir} có seq_len khác nhau: {sorted(seq_lens)}")
+        self.shard_dir = shard_dir
+        self.shuffle_buffer = shuffle_buffer
+        self.shuffle_shards = shuffle_shards
+        self.max_open_shards = max_open_shards
+        self.shard_rows = [int(meta["num_sequences"]) for meta in self.shard_metas]
+        self.meta = {
+            "seq_len": seq_lens.pop(),
+            "num_sequences": sum(self.shard_rows),
+            "num_shards": len(self.shard_paths),
+            "padded_sequences": sum(int(meta.get("padded_sequences", 1)) for meta in self.shard_metas),
+        }
+        self._open: "OrderedDict[int, np.ndarray]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return self.meta["num_sequences"]
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state["_open"] = OrderedDict()
+        return state
+
+    def fingerprint(self) -> Dict:
+        return {**super().fingerprint(), "num_shards": len(self.shard_paths)}
+
+    def shard_order(self, epoch: int) -> np.ndarray:
+        if not self.shuffle_shards:
+            return np.arange(len(self.shard_paths))
+        return np.random.default_rng([self.seed, epoch]).permutation(len(self.shard_paths))
+
+    def worker_batch_counts(self, num_workers: int) -> List[int]:
+        order = self.shard_order(self.epoch)
+        rows = [sum(self.shard_rows[shard] for shard in order[w::num_workers]) for w in range(num_workers)]
+        return [math.ceil(count / self.batch_size) for count in rows]
+
+    def iter_indices(self, epoch: int, worker_id: int, num_workers: int) -> Iterator[Tuple[int, int]]:
+        """Dãy (shard, row) mà worker sẽ yield, chỉ phụ thuộc (seed, epoch, worker)."""
+        rng = np.random.default_rng([self.seed, epoch, worker_id])
+        rows = (
+            (shard, row)
+            for shard in self.shard_order(epoch)[worker_id::num_workers].tolist()
+            for row in range(self.shard_rows[shard])
+        )
+        return buffered_shuffle(rows, self.shuffle_buffer, rng)
+
+    def _shard_array(self, shard: int) -> np.ndarray:
+        array = self._open.get(shard)
+        if array is None:
+            array = open_packed_bin(self.shard_paths[shard], self.shard_metas[shard])
+            self._open[shard] = array
+            if len(self._open) > self.max_open_shards:
+                self._open.popitem(last=False)
+        else:
+            self._open.move_to_end(shard)
+        return array
+
+    def iter_worker(self, role: int, num_workers: int, skip: int) -> Iterator[np.ndarray]:
+        if num_workers > len(self.shard_paths) and role == 0:
+            print(f"⚠️ {num_workers} workers nhưng chỉ có {len(self.shard_paths)} shard; một số worker sẽ rảnh.")
+        indices = self.iter_indices(self.epoch, role, num_workers)
+        for shard, row in islice(indices, skip, None):
+            yield self._shard_array(shard)[row]
+
+
+class OnTheFlyPackedDataset(StreamingDataset):
+    """Pack tokenized output (JSONL hoặc token store .bin) thành window seq_len ngay trong worker.
+
+    Bỏ qua bước pack: worker `w` đọc paragraph `w::W`, nối token thành stream
+    riêng và cắt window `seq_len` không overlap (window cuối của mỗi worker
+    được pad). Window đi qua shuffle buffer theo (seed, epoch, worker).
+    Với token store, số window của từng worker tính được từ offsets nên
+    `__len__`/resume chính xác; với JSONL thì không biết trước độ dài
+    (cần `max_steps`) và resume giả định các worker chưa hết dữ liệu.
+    """
+
+    def __init__(
+        self,
+        tokens_path: Path,
+        seq_len: int,
+        pad_token_id: int = 0,
+        batch_size: int = 1,
+        shuffle_buffer: int = 10000,
+        seed: int = 42,
+        chunk_windows: int = 64,
+    ):
+        super().__init__(pad_token_id, batch_size, seed)
+        if not tokens_path.exists():
+            raise FileNotFoundError(f"Không tìm thấy tokenized file: {tokens_path}")
+        self.tokens_path = tokens_path
+        self.seq_len = seq_len
+        self.shuffle_buffer = shuffle_buffer
+        self.chunk_windows = chunk_windows
+        self.lengths: Optional[np.ndarray] = None
+        self.meta: Dict = {"seq_len": seq_len, "source": str(tokens_path), "packing": "on_the_fly"}
+        if is_token_store(tokens_path):
+            self.lengths = np.diff(np.load(token_store_paths(tokens_path)["offsets"]))
+            self.meta["num_sequences"] = int(sum(self.worker_window_counts(1)))
+
+    def __len__(self) -> int:
+        if self.lengths is None:
+            raise TypeError(f"Không biết trước số window của {self.tokens_path} (JSONL); hãy đặt max_steps.")
+        return self.meta["num_sequences"]
+
+    def fingerprint(self) -> Dict:
+        return {**super().fingerprint(), "seq_len": self.seq_len, "source": str(self.tokens_path)}
+
+    def worker_window_counts(self, num_workers: int) -> List[int]:
+        return [math.ceil(int(self.lengths[w::num_workers].sum()) / self.seq_len) for w in range(num_workers)]
+
+    def worker_batch_counts(self, num_workers: int) -> Optional[List[int]]:
+        if self.lengths is None:
+            return None
+        return [math.ceil(count / self.batch_size) for count in self.worker_window_counts(num_workers)]
+
+    def iter_windows(self, worker_id: int, num_workers: int) -> Iterator[np.ndarray]:
+        """Window seq_len từ stream paragraph `worker_id::num_workers` (window cuối được pad)."""
+        records = iter_token_ids(
+            self.tokens_path, new_pack_stats(), False, worker_id=worker_id, num_workers=num_workers
+        )
+        chunk_tokens = self.chunk_windows * self.seq_len
+        pending: List[np.ndarray] = []
+        pending_tokens = 0
+        for token_ids in records:
+            pending.append(np.asarray(token_ids, dtype=np.int64))
+            pending_tokens += len(token_ids)
+            if pending_tokens < chunk_tokens:
+                continue
+            flat = np.concatenate(pending)
+            num_full = flat.shape[0] // self.seq_len
+            yield from flat[: num_full * self.seq_len].reshape(num_full, self.seq_len)
+            pending = [flat[num_full * self.seq_len:]]
+            pending_tokens = pending[0].shape[0]
+        if pending_tokens:
+            flat = np.concatenate(pending)
+            num_rows = math.ceil(flat.shape[0] / self.seq_len)
+            windows = np.full(num_rows * self.seq_len, self.pad_token_id, dtype=np.int64)
+            windows[: flat.shape[0]] = flat
+            yield from windows.reshape(num_rows, self.seq_len)
+
+    def iter_worker(self, role: int, num_workers: int, skip: int) -> Iterator[np.ndarray]:
+        rng = np.random.default_rng([self.seed, self.epoch, role])
+        windows = buffered_shuffle(self.iter_windows(role, num_workers), self.shuffle_buffer, rng)
+        return islice(windows, skip, None)
+
+
+def load_packed_dataset(path: Path, pad_token_id: int = 0) -> Dataset:
+    """Chọn dataset theo định dạng: layout stream → SlidingWindowDataset, còn lại PackedTensorDataset."""
+    if is_packed_bin(path) and path.exists() and read_packed_meta(path).get("format") == PACKED_STREAM_FORMAT:
+        return SlidingWindowDataset(path, pad_token_id=pad_token_id)
+    return PackedTensorDataset(path, pad_token_id=pad_token_id)
+
+
+def load_val_dataset(
+    val_tokens: Optional[Path],
+    val_bin: Path,
+    seq_len: int,
+    pad_token_id: int,
+    batch_size: int,
+    seed: int,
+) -> Dataset:
+    """Val từ token file (pack on-the-fly, không shuffle) hoặc packed `.pt`/`.bin`."""
+    if val_tokens:
+        return OnTheFlyPackedDataset(
+            Path(val_tokens),
+            seq_len=seq_len,
+            pad_token_id=pad_token_id,
+            batch_size=batch_size,
+            shuffle_buffer=0,
+            seed=seed,
+        )
+    return load_packed_dataset(Path(val_bin), pad_token_id=pad_token_id)
+
+
+def loader_generator(seed: int) -> torch.Generator:
+    """Generator riêng cho base seed worker của DataLoader.
+
+    Không có nó, mỗi lần tạo iterator (kể cả val loader persistent, chỉ tạo ở
+    lần eval đầu tiên của process) tiêu thụ RNG global → dropout sau resume
+    lệch so với run không bị ngắt.
+    """
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return generator
+
+
+def dataloader_kwargs(train_cfg: Dict, dataset: Dataset) -> Dict:
+    """num_workers / prefetch_factor / persistent_workers / pin_memory từ config training."""
+    num_workers = train_cfg.get("num_workers", 0)
+    kwargs = {"num_workers": num_workers, "pin_memory": train_cfg.get("pin_memory", True)}
+    if num_workers > 0:
+        persistent = train_cfg.get("persistent_workers", False)
+        if persistent and isinstance(dataset, StreamingDataset):
+            # Worker persistent giữ bản copy dataset cũ → không nhận set_epoch/resume mới.
+            print("⚠️ persistent_workers bị tắt cho dataset stream (cần nhận epoch mới mỗi vòng).")
+            persistent = False
+        kwargs["prefetch_factor"] = train_cfg.get("prefetch_factor", 2)
+        kwargs["persistent_workers"] = persistent
+    return kwargs
 
 
 def parse_args() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(description="Train GPT LM trên packed dataset (.pt).")
+    parser = argparse.ArgumentParser(description="Train GPT LM trên packed dataset (.pt/.bin).")
     parser.add_argument("--config", type=Path, default=Path("training/configs/training_config.json"))
-    parser.add_argument("--train-bin", type=Path, help="Override đường dẫn train .pt")
-    parser.add_argument("--val-bin", type=Path, help="Override đường dẫn val .pt")
+    parser.add_argument("--train-bin", type=Path, help="Override đường dẫn train .pt/.bin")
+    parser.add_argument("--val-bin", type=Path, help="Override đường dẫn val .pt/.bin")
     parser.add_argument("--output-dir", type=Path, help="Override output dir")
     parser.add_argument("--resume", type=Path, help="Checkpoint .pt để resume")
     parser.add_argument("--seed", type=int, default=42)
@@ -91,23 +654,76 @@ def build_model(cfg: Dict) -> GPT2LMHeadModel:
         embd_pdrop=cfg.get("embd_pdrop", 0.1),
         attn_pdrop=cfg.get("attn_pdrop", 0.1),
     )
-    return GPT2LMHeadModel(model_cfg)
+    model = GPT2LMHeadModel(model_cfg)
+    every = int(cfg.get("activation_checkpointing", 0) or 0)
+    if every:
+        checkpoint_blocks(model, every)
+    return model
+
+
+def rank_shard(dataset: Dataset, dist_info: DistInfo) -> Dataset:
+    """DDP eval: rank `r` chấm sample `r::world_size` (không lặp; tổng loss được all-reduce)."""
+    if not dist_info.enabled:
+        return dataset
+    if isinstance(dataset, StreamingDataset):
+        dataset.set_rank(dist_info.rank, dist_info.world_size)
+        return dataset
+    if isinstance(dataset, IterableDataset):
+        return dataset  # mọi rank chấm đủ → trung bình sau all-reduce vẫn đúng
+    return Subset(dataset, range(dist_info.rank, len(dataset), dist_info.world_size))
 
 
-def evaluate(model, dataloader, device) -> float:
+def eval_subset(dataset: Dataset, num_samples: int, seed: int) -> Dataset:
+    """Tập con val cố định (chọn ngẫu nhiên theo `seed`, giữ thứ tự tăng dần) cho eval nhanh."""
+    if isinstance(dataset, IterableDataset) or num_samples <= 0 or num_samples >= len(dataset):
+        return dataset
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)[:num_samples].sort().values.tolist()
+    return Subset(dataset, indices)
+
+
+def evaluate(
+    model,
+    dataloader,
+    device,
+    pad_token_id: int = 0,
+    use_attention_mask: bool = True,
+    *,
+    max_batches: int = 0,
+    amp_dtype: Optional[torch.dtype] = None,
+    token_weighted: bool = False,
+    distributed: bool = False,
+) -> float:
+    """Loss trung bình trên `dataloader` (tối đa `max_batches` batch, 0 = tất cả).
+
+    Mặc định trung bình theo sequence (mean loss mỗi batch × số sequence);
+    `token_weighted=True` cộng loss theo số token có label nên chính xác cả khi
+    batch có padding. Loss cộng dồn trên device, chỉ sync một lần ở cuối.
+    `distributed=True`: mỗi rank chấm phần val của mình, tổng loss và trọng số
+    được all-reduce (mọi rank phải gọi) → mọi rank nhận cùng kết quả.
+    """
     model.eval()
-    loss_sum = 0.0
-    total = 0
-    with torch.no_grad():
-        for batch in dataloader:
-            batch = {k: v.to(device) for k, v in batch.items()}
-            outputs = model(**batch)
-            loss = outputs.loss
-            bs = batch["input_ids"].size(0)
-            loss_sum += loss.item() * bs
-            total += bs
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+    total = torch.zeros((), dtype=torch.float64, device=device)
+    batches = islice(dataloader, max_batches) if max_batches else dataloader
+    with torch.inference_mode(), torch.autocast(
+        device_type=device.type, dtype=amp_dtype or torch.float32, enabled=amp_dtype is not None
+    ):
+        for batch in batches:
+            batch = lm_inputs(batch["input_ids"].to(device, non_blocking=True), pad_token_id, use_attention_mask)
+            loss = model(**batch).loss
+            if token_weighted:
+                weight = (batch["labels"][:, 1:] != -100).sum()
+            else:
+                weight = batch["input_ids"].size(0)
+            loss_sum += loss.double() * weight
+            total += weight
+    if distributed:
+        all_reduce(loss_sum)
+        all_reduce(total)
     model.train()
-    return loss_sum / max(total, 1)
+    return (loss_sum / total.clamp_min(1)).item()
 
 
 def save_checkpoint(
@@ -119,23 +735,11 @@ def save_checkpoint(
     tag: str,
     *,
     save_hf: bool = False,
+    data_state: Optional[Dict] = None,
 ) -> None:
-    ensure_dir(output_dir)
-    payload = {
-        "model_state": model.state_dict(),
-        "optimizer_state": optimizer.state_dict(),
-        "scheduler_state": scheduler.state_dict() if scheduler else None,
-        "step": step,
-    }
-    ckpt_path = output_dir / f"checkpoint_{tag}.pt"
-    torch.save(payload, ckpt_path)
-
-    latest_path = output_dir / "checkpoint_latest.pt"
-    torch.save(payload, latest_path)
-
-    if save_hf:
-        hf_dir = output_dir / "hf_best"
-        model.save_pretrained(hf_dir)
+    """Lưu checkpoint đồng bộ (training loop dùng `AsyncCheckpointer`)."""
+    payload = StateSnapshotter().snapshot(build_payload(model, optimizer, scheduler, step, data_state))
+    write_checkpoint(output_dir, tag, payload, model if save_hf else None)
 
 
 def run_training(
@@ -146,8 +750,16 @@ def run_training(
     resume: Optional[Path] = None,
     seed: int = 42,
     device_str: Optional[str] = None,
+    train_tokens_override: Optional[Path] = None,
+    val_tokens_override: Optional[Path] = None,
+    seq_len_override: Optional[int] = None,
 ) -> None:
-    """Run LM training either from CLI or programmatic caller."""
+    """Run LM training either from CLI or programmatic caller.
+
+    Nguồn dữ liệu train (ưu tiên từ trên xuống): `train_bin_override` →
+    `train_tokens_override` → `paths.train_shards` → `paths.train_tokens`
+    (pack on-the-fly) → `paths.train_bin`. Val tương tự, không có shards.
+    """
     setup_encoding()
     config = load_config(config_path)
 
@@ -155,17 +767,91 @@ def run_training(
     train_cfg = config.get("training", {})
     path_cfg = config.get("paths", {})
 
+    train_shards = path_cfg.get("train_shards") if train_bin_override is None else None
+    train_tokens = None if train_bin_override else train_tokens_override
+    if train_tokens is None and train_bin_override is None and not train_shards:
+        train_tokens = path_cfg.get("train_tokens")
+    val_tokens = None if val_bin_override else (val_tokens_override or path_cfg.get("val_tokens"))
     train_bin = Path(train_bin_override or path_cfg.get("train_bin", "train.pt"))
     val_bin = Path(val_bin_override or path_cfg.get("val_bin", "val.pt"))
+    seq_len = seq_len_override or train_cfg.get("seq_len") or model_cfg.get("n_positions", model_cfg.get("n_ctx", 1024))
     output_dir = Path(output_dir_override or path_cfg.get("output_dir", "training/model/output"))
 
+    if device_str is None:
+        device_str = "cuda" if torch.cuda.is_available() else "cpu"
+    dist_info = init_distributed(device_str, train_cfg.get("ddp_backend"))
+    device = torch.device(device_str)
+    if dist_info.enabled and device.type == "cuda":
+        device = torch.device("cuda", dist_info.local_rank)
+    if dist_info.enabled:
+        print(f"🌐 DDP: {dist_info.world_size} process, backend={torch.distributed.get_backend()}, device={device}")
+
     ensure_dir(output_dir)
+
+    auto_batch = None
+    if train_cfg.get("auto_batch"):
+        mixed = train_cfg.get("mixed_precision", "").lower()
+        probe_amp = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(mixed) if device.type == "cuda" else None
+        global_batch = train_cfg.get("batch_size") or (
+            train_cfg.get("micro_batch_size", 1) * train_cfg.get("gradient_accumulation_steps", 1) * dist_info.world_size
+        )
+        if dist_info.is_main:
+            print(f"🔎 Auto batch: probe micro-batch cho batch_size={global_batch}, seq_len={seq_len}...")
+            auto_batch = find_micro_batch(
+                model_cfg,
+                seq_len,
+                global_batch,
+                device,
+                world_size=dist_info.world_size,
+                amp_dtype=probe_amp,
+                options=train_cfg["auto_batch"] if isinstance(train_cfg["auto_batch"], dict) else None,
+            )
+            write_result(output_dir, auto_batch)
+        auto_batch = broadcast_object(auto_batch, dist_info)
+        train_cfg = {
+            **train_cfg,
+            "micro_batch_size": auto_batch["micro_batch_size"],
+            "gradient_accumulation_steps": auto_batch["gradient_accumulation_steps"],
+        }
+        model_cfg = {**model_cfg, "activation_checkpointing": auto_batch["activation_checkpointing"]}
+        print(
+            f"✅ Auto batch: micro_batch_size={auto_batch['micro_batch_size']} × "
+            f"grad_accum={auto_batch['gradient_accumulation_steps']} × world={dist_info.world_size}, "
+            f"activation checkpointing={checkpoint_label(auto_batch['activation_checkpointing'])} "
+            f"(~{auto_batch['tokens_per_s']:,.0f} tok/s/rank)"
+        )
     set_seed(seed)
 
-    print(f"🔁 Loading datasets: {train_bin} / {val_bin}")
     pad_token_id = train_cfg.get("pad_token_id", 0)
-    train_ds = PackedTensorDataset(train_bin, pad_token_id=pad_token_id)
-    val_ds = PackedTensorDataset(val_bin, pad_token_id=pad_token_id)
+    micro_batch_size = train_cfg.get("micro_batch_size", 1)
+    eval_batch_size = train_cfg.get("eval_batch_size", micro_batch_size)
+    max_eval_batches = train_cfg.get("max_eval_batches", 0)
+    eval_token_weighted = train_cfg.get("eval_token_weighted", False)
+    shuffle_buffer = train_cfg.get("shuffle_buffer", 10000)
+    val_source = val_tokens or val_bin
+    if train_tokens:
+        print(f"🔁 Loading datasets (pack on-the-fly, seq_len={seq_len}): {train_tokens} / {val_source}")
+        train_ds = OnTheFlyPackedDataset(
+            Path(train_tokens),
+            seq_len=seq_len,
+            pad_token_id=pad_token_id,
+            batch_size=micro_batch_size,
+            shuffle_buffer=shuffle_buffer,
+            seed=seed,
+        )
+    elif train_shards:
+        print(f"🔁 Loading datasets: shards {train_shards} / {val_source}")
+        train_ds = ShardedPackedDataset(
+            Path(train_shards),
+            pad_token_id=pad_token_id,
+            batch_size=micro_batch_size,
+            shuffle_buffer=shuffle_buffer,
+            seed=seed,
+        )
+    else:
+        print(f"🔁 Loading datasets: {train_bin} / {val_source}")
+        train_ds = load_packed_dataset(train_bin, pad_token_id=pad_token_id)
+    val_ds = load_val_dataset(val_tokens, val_bin, seq_len, pad_token_id, eval_batch_size, seed)
     if train_ds.meta:
         print(
             f"📊 train meta → seq_len={train_ds.meta.get('seq_len')} | "
@@ -177,16 +863,46 @@ def run_training(
             f"num_sequences={val_ds.meta.get('num_sequences')}"
         )
 
-    micro_batch_size = train_cfg.get("micro_batch_size", 1)
-    train_loader = DataLoader(train_ds, batch_size=micro_batch_size, shuffle=True, pin_memory=True)
-    val_loader = DataLoader(val_ds, batch_size=micro_batch_size, shuffle=False, pin_memory=True)
+    train_mask = needs_attention_mask(train_ds.meta)
+    val_mask = needs_attention_mask(val_ds.meta)
+    if not train_mask:
+        print("⚡ Train data không có padding → bỏ attention_mask (dùng attention kernel nhanh nhất).")
+
+    streaming = isinstance(train_ds, IterableDataset)
+    train_sampler = None
+    if not streaming:
+        train_sampler = ResumableRandomSampler(
+            len(train_ds), micro_batch_size, seed, num_replicas=dist_info.world_size, rank=dist_info.rank
+        )
+    data_resume: DataResumeState = train_ds if streaming else train_sampler
+    if streaming:
+        train_ds.set_rank(dist_info.rank, dist_info.world_size)
+    train_loader = DataLoader(
+        train_ds,
+        batch_size=micro_batch_size,
+        sampler=train_sampler,
+        collate_fn=collate_token_rows,
+        generator=loader_generator(seed),
+        **dataloader_kwargs(train_cfg, train_ds),
+    )
+    val_loader = DataLoader(
+        rank_shard(eval_subset(val_ds, max_eval_batches * eval_batch_size, seed), dist_info),
+        batch_size=eval_batch_size,
+        shuffle=False,
+        collate_fn=collate_token_rows,
+        generator=loader_generator(seed),
+        **dataloader_kwargs(train_cfg, val_ds),
+    )
+    if max_eval_batches:
+        print(f"🧪 Eval nhanh: tối đa {max_eval_batches} batch × {eval_batch_size} (tập con cố định); full val ở cuối.")
 
-    if device_str is None:
-        device_str = "cuda" if torch.cuda.is_available() else "cpu"
-    device = torch.device(device_str)
     model = build_model(model_cfg).to(device)
     if not hasattr(model.config, "pad_token_id") or model.config.pad_token_id is None:
         model.config.pad_token_id = pad_token_id
+    if model_cfg.get("activation_checkpointing"):
+        print(f"♻️  Activation checkpointing: {checkpoint_label(model_cfg['activation_checkpointing'])}.")
+    if dist_info.enabled:
+        set_seed(seed + dist_info.rank)  # weights đã giống nhau; dropout khác nhau giữa các rank
 
     optimizer = torch.optim.AdamW(
         model.parameters(),
@@ -198,8 +914,25 @@ def run_training(
     max_steps = train_cfg.get("max_steps", 0)
     num_epochs = train_cfg.get("num_epochs", 1)
     grad_accum = train_cfg.get("gradient_accumulation_steps", 1)
-    steps_per_epoch = math.ceil(len(train_loader) / max(grad_accum, 1))
-    total_train_steps = max_steps or num_epochs * steps_per_epoch
+
+    def rank_epoch_batches() -> Optional[int]:
+        """DDP + dataset stream: số batch mỗi rank train trong epoch hiện tại (min giữa các rank).
+
+        Các rank phải chạy cùng số micro-batch (mỗi backward đồng bộ là một
+        all-reduce) → cắt epoch theo rank ít dữ liệu nhất.
+        """
+        if not (dist_info.enabled and streaming):
+            return None
+        counts = train_ds.rank_batch_counts(max(train_cfg.get("num_workers", 0), 1))
+        if counts is None:
+            raise ValueError("DDP với dataset stream cần biết trước số window/rank (token store .bin hoặc shards).")
+        return int(all_reduce(torch.tensor(sum(counts), device=device), "min").item())
+
+    if max_steps:
+        total_train_steps = max_steps
+    else:
+        epoch_len = rank_epoch_batches() or len(train_loader)
+        total_train_steps = num_epochs * math.ceil(epoch_len / max(grad_accum, 1))
     scheduler = get_linear_schedule_with_warmup(
         optimizer,
         num_warmup_steps=train_cfg.get("warmup_steps", 1000),
@@ -210,7 +943,19 @@ def run_training(
     log_every = train_cfg.get("log_every", 50)
     eval_every = train_cfg.get("eval_every", 500)
     save_every = train_cfg.get("save_every", 1000)
+    device_prefetch = train_cfg.get("device_prefetch", 0)
     mixed_precision = train_cfg.get("mixed_precision", "").lower()
+    seq_warmup = train_cfg.get("seq_len_warmup") or {}
+    seq_warmup_start = int(seq_warmup.get("start", 0))
+    seq_warmup_steps = int(seq_warmup.get("steps", 0))
+    if seq_warmup_steps:
+        full_len = int(train_ds.meta.get("seq_len") or seq_len)
+        if seq_warmup_start <= 0 or full_len % seq_warmup_start:
+            raise ValueError(f"seq_len_warmup.start={seq_warmup_start} phải chia hết seq_len={full_len}.")
+        print(
+            f"📏 Seq-len warmup: {seq_warmup_start} → {full_len} trong {seq_warmup_steps} step "
+            f"(cắt row packed, giữ nguyên số token mỗi step)."
+        )
 
     use_amp = mixed_precision in {"fp16", "bf16"} and torch.cuda.is_available()
     amp_dtype = torch.float16 if mixed_precision == "fp16" else torch.bfloat16
@@ -218,104 +963,274 @@ def run_training(
 
     global_step = 0
     best_val = float("inf")
+    start_epoch = 0
+    resume_batches = 0
 
     if resume:
-        ckpt = torch.load(resume, map_location=device)
-        model.load_state_dict(ckpt["model_state"])
-        optimizer.load_state_dict(ckpt["optimizer_state"])
-        if scheduler and ckpt.get("scheduler_state"):
-            scheduler.load_state_dict(ckpt["scheduler_state"])
+        ckpt = load_checkpoint(Path(resume), model, optimizer, scheduler)
         global_step = ckpt.get("step", 0)
+        restore_rank_rng_state(ckpt.get("rng_state"), dist_info)
+        data_state = ckpt.get("data_state")
+        if data_state:
+            data_resume.load_state_dict(data_state)
+            start_epoch, resume_batches = data_state["epoch"], data_state["batches"]
+            print(f"🔄 Data resume: epoch {start_epoch}, bỏ qua {resume_batches} batch đã train")
         print(f"🔄 Resumed from {resume} at step {global_step}")
 
+    raw_model = model  # checkpoint / eval / snapshot dùng model gốc (key không có `module.`)
+    if dist_info.enabled:
+        model = DistributedDataParallel(model, device_ids=[device.index] if device.type == "cuda" else None)
+
+    def data_state_at(epoch: int, batches: int) -> Optional[Dict]:
+        return data_resume.state_dict(epoch, batches)
+
+    def to_model_inputs(input_ids: torch.Tensor) -> Dict[str, torch.Tensor]:
+        return lm_inputs(input_ids, pad_token_id, train_mask)
+
+    def run_eval(loader: DataLoader, max_batches: int = 0) -> float:
+        return evaluate(
+            raw_model,
+            loader,
+            device,
+            pad_token_id,
+            val_mask,
+            max_batches=max_batches,
+            amp_dtype=amp_dtype if use_amp else None,
+            token_weighted=eval_token_weighted,
+            distributed=dist_info.enabled,
+        )
+
+    def final_eval() -> None:
+        """Eval toàn bộ val set một lần khi kết thúc (eval định kỳ có thể chỉ là tập con)."""
+        if not eval_every:
+            return
+        loader = val_loader
+        if max_eval_batches:
+            loader = DataLoader(
+                rank_shard(val_ds, dist_info),
+                batch_size=eval_batch_size,
+                shuffle=False,
+                collate_fn=collate_token_rows,
+                generator=loader_generator(seed),
+                **{**dataloader_kwargs(train_cfg, val_ds), "persistent_workers": False},
+            )
+        started = time.perf_counter()
+        val_loss = run_eval(loader)
+        metrics.log_eval(global_step, val_loss, time.perf_counter() - started, full=True)
+        print(f"🧪 Final eval (full val) step {global_step}: val_loss={val_loss:.4f}")
+
+    if device_prefetch:
+        print(f"🚚 Device prefetch: giữ sẵn {device_prefetch} batch trên {device} (thread nền).")
+    retention = train_cfg.get("checkpoint_retention")
+    async_eval = bool(eval_every and train_cfg.get("async_eval", False))
+    checkpointer: Optional[AsyncCheckpointer] = None
+    if dist_info.is_main:
+        checkpointer = AsyncCheckpointer(
+            output_dir,
+            async_save=train_cfg.get("async_checkpoint", True),
+            manager=CheckpointManager.from_config(output_dir, retention, await_eval=async_eval),
+            fmt=train_cfg.get("checkpoint_format", "pt"),
+            max_shard_bytes=int(train_cfg.get("checkpoint_shard_mb", 1024)) << 20,
+            optimizer_state_dtype=train_cfg.get("optimizer_state_dtype", "fp32"),
+        )
+    if retention:
+        print(f"🗂️  Checkpoint retention: {retention}")
+        if async_eval and retention.get("keep_best"):
+            print(
+                "⚠️  async_eval + keep_best: checkpoint chưa có kết quả eval được giữ đến khi eval xong; "
+                "không ghi checkpoint_best.pt, bản tốt nhất là checkpoint step* được giữ lại."
+            )
+
+    def save(tag: str, **kwargs) -> None:
+        """Mọi rank gọi (gom RNG state của từng rank); chỉ rank 0 ghi checkpoint."""
+        rng_state = gather_rng_state(dist_info)
+        if checkpointer is not None:
+            checkpointer.save(raw_model, optimizer, scheduler, global_step, tag, rng_state=rng_state, **kwargs)
+
+    def wait_checkpoints() -> None:
+        if checkpointer is not None:
+            checkpointer.wait()
+
+    data_wait = DataWaitTimer()
+    metrics = TrainMetrics(
+        raw_model.config,
+        device,
+        output_dir / "metrics.jsonl" if dist_info.is_main else None,
+        half_precision=use_amp,
+        peak_tflops=train_cfg.get("peak_tflops"),
+        world_size=dist_info.world_size,
+        target_loss=train_cfg.get("target_loss"),
+    )
+    metrics.log_start(
+        step=global_step,
+        seq_len=seq_len,
+        micro_batch_size=micro_batch_size,
+        gradient_accumulation_steps=grad_accum,
+        world_size=dist_info.world_size,
+        seq_len_warmup=seq_warmup or None,
+        activation_checkpointing=model_cfg.get("activation_checkpointing", 0),
+        auto_batch={key: value for key, value in auto_batch.items() if key != "probes"} if auto_batch else None,
+        mixed_precision=mixed_precision if use_amp else "fp32",
+        num_parameters=raw_model.num_parameters(),
+    )
+    evaluator: Optional[AsyncEvaluator] = None
+    if async_eval and dist_info.is_main:
+        eval_device = train_cfg.get("async_eval_device", "cpu")
+        evaluator = AsyncEvaluator(
+            model_cfg,
+            {
+                "val_tokens": str(val_tokens) if val_tokens else None,
+                "val_bin": str(val_bin),
+                "seq_len": seq_len,
+                "pad_token_id": pad_token_id,
+                "batch_size": eval_batch_size,
+                "max_batches": max_eval_batches,
+                "token_weighted": eval_token_weighted,
+                "use_attention_mask": val_mask,
+                "amp_dtype": mixed_precision if use_amp else None,
+                "seed": seed,
+            },
+            output_dir,
+            device=eval_device,
+            num_threads=train_cfg.get("async_eval_threads", 2),
+            max_backlog=train_cfg.get("async_eval_max_backlog", 2),
+        )
+        print(f"🧪 Async eval: process riêng trên {eval_device} chấm snapshot mỗi {eval_every} step.")
+
+    def handle_async_eval(results: List[Dict]) -> None:
+        nonlocal best_val
+        for result in results:
+            if "error" in result:
+                print(f"⚠️ Async eval step {result['step']} lỗi: {result['error']}")
+                continue
+            metrics.log_eval(result["step"], result["val_loss"], result["eval_s"], async_eval=True)
+            checkpointer.manager.record_val_loss(result["step"], result["val_loss"])
+            print(f"🧪 Eval step {result['step']} (async): val_loss={result['val_loss']:.4f}")
+            if result["val_loss"] < best_val:
+                best_val = result["val_loss"]
+                print(f"🏆 hf_best ← step {result['step']}")
+
+    data_state = data_state_at(start_epoch, resume_batches)
     model.train()
-    for epoch in range(num_epochs if max_steps == 0 else 10**9):
-        for batch_idx, batch in enumerate(train_loader):
-            batch = {k: v.to(device) for k, v in batch.items()}
-            with torch.cuda.amp.autocast(enabled=use_amp, dtype=amp_dtype):
-                outputs = model(**batch)
-                loss = outputs.loss / grad_accum
-
-            if use_amp and mixed_precision == "fp16":
-                scaler.scale(loss).backward()
-            else:
-                loss.backward()
-
-            if (batch_idx + 1) % grad_accum == 0:
-                if clip_norm:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), clip_norm)
-                if use_amp and mixed_precision == "fp16":
-                    scaler.step(optimizer)
-                    scaler.update()
-                else:
-                    optimizer.step()
-                scheduler.step()
-                optimizer.zero_grad()
+    for epoch in range(start_epoch, num_epochs if max_steps == 0 else 10**9):
+        data_resume.set_epoch(epoch)
+        first_batch = resume_batches if epoch == start_epoch else 0
+        epoch_loader = train_loader
+        epoch_batches = rank_epoch_batches()
+        if epoch_batches is not None:
+            epoch_loader = islice(train_loader, max(epoch_batches - first_batch, 0))
+        batches = iter_device_batches(epoch_loader, device, to_model_inputs, prefetch=device_prefetch)
+        for batch_idx, batch in enumerate(data_wait.wrap(batches), start=first_batch):
+            data_state = data_state_at(epoch, batch_idx + 1)
+            if seq_warmup_steps:
+                full_len = batch["input_ids"].size(1)
+                batch = split_rows(batch, warmup_seq_len(global_step, full_len, seq_warmup_start, seq_warmup_steps))
+            metrics.add_batch(batch["input_ids"])
+            sync_step = (batch_idx + 1) % grad_accum == 0
+            # DDP: micro-batch giữa chừng không all-reduce gradient, chỉ cộng dồn local.
+            with nullcontext() if sync_step or not dist_info.enabled else model.no_sync():
+                with metrics.phase("forward"):
+                    with torch.cuda.amp.autocast(enabled=use_amp, dtype=amp_dtype):
+                        outputs = model(**batch)
+                        loss = outputs.loss / grad_accum
+
+                with metrics.phase("backward"):
+                    if use_amp and mixed_precision == "fp16":
+                        scaler.scale(loss).backward()
+                    else:
+                        loss.backward()
+
+            if sync_step:
+                with metrics.phase("optimizer"):
+                    if clip_norm:
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), clip_norm)
+                    if use_amp and mixed_precision == "fp16":
+                        scaler.step(optimizer)
+                        scaler.update()
+                    else:
+                        optimizer.step()
+                    scheduler.step()
+                    optimizer.zero_grad()
 
                 global_step += 1
+                if checkpointer is not None:
+                    checkpointer.check()
+                if evaluator is not None:
+                    handle_async_eval(evaluator.poll())
                 if global_step % log_every == 0:
+                    wait_seconds, waited_batches = data_wait.pop()
+                    step_loss = all_reduce(loss.detach() * grad_accum).item() / dist_info.world_size
+                    lr = scheduler.get_last_lr()[0]
+                    context = batch["input_ids"].size(1)
+                    record = metrics.log_step(
+                        global_step, wait_seconds, epoch=epoch, loss=step_loss, lr=lr, seq_len=context
+                    )
+                    mfu = f"{record['mfu']:.1%}" if record["mfu"] is not None else "n/a"
+                    warmup_note = f"seq_len={context} " if seq_warmup_steps else ""
                     print(
-                        f"[step {global_step}] loss={loss.item() * grad_accum:.4f} "
-                        f"lr={scheduler.get_last_lr()[0]:.2e}"
+                        f"[step {global_step}] loss={step_loss:.4f} lr={lr:.2e} {warmup_note}"
+                        f"tok/s={record['tokens_per_s']:,.0f} mfu={mfu} "
+                        f"data_wait={1000 * wait_seconds / max(waited_batches, 1):.1f}ms/batch "
+                        f"({wait_seconds / record['interval_s']:.1%})"
                     )
 
-                if eval_every and global_step % eval_every == 0:
-                    val_loss = evaluate(model, val_loader, device)
+                if evaluator is not None and global_step % eval_every == 0:
+                    evaluator.publish(global_step, raw_model)
+                elif eval_every and not async_eval and global_step % eval_every == 0:
+                    with metrics.paused():
+                        eval_started = time.perf_counter()
+                        val_loss = run_eval(val_loader, max_eval_batches)
+                        metrics.log_eval(global_step, val_loss, time.perf_counter() - eval_started)
                     print(f"🧪 Eval step {global_step}: val_loss={val_loss:.4f}")
+                    if checkpointer is not None:
+                        checkpointer.manager.record_val_loss(global_step, val_loss)
                     if val_loss < best_val:
                         best_val = val_loss
-                        save_checkpoint(
-                            model,
-                            optimizer,
-                            scheduler,
-                            global_step,
-                            output_dir,
-                            "best",
-                            save_hf=True,
-                        )
+                        with metrics.phase("checkpoint"):
+                            save("best", save_hf=True, data_state=data_state, val_loss=val_loss)
 
                 if save_every and global_step % save_every == 0:
-                    save_checkpoint(
-                        model,
-                        optimizer,
-                        scheduler,
-                        global_step,
-                        output_dir,
-                        f"step{global_step}",
-                    )
+                    with metrics.phase("checkpoint"):
+                        save(f"step{global_step}", data_state=data_state)
 
                 if max_steps and global_step >= max_steps:
-                    save_checkpoint(model, optimizer, scheduler, global_step, output_dir, "final")
+                    save("final", data_state=data_state)
+                    if evaluator is not None:
+                        handle_async_eval(evaluator.close())
+                    wait_checkpoints()
+                    final_eval()
                     print(f"✅ Reached max_steps={max_steps}. Training finished.")
                     return
 
+        data_state = data_state_at(epoch + 1, 0)
         if not max_steps:
-            save_checkpoint(
-                model,
-                optimizer,
-                scheduler,
-                global_step,
-                output_dir,
-                f"epoch{epoch + 1}",
-            )
+            with metrics.phase("checkpoint"):
+                save(f"epoch{epoch + 1}", data_state=data_state)
         if max_steps and global_step >= max_steps:
             break
 
-    save_checkpoint(model, optimizer, scheduler, global_step, output_dir, "last")
+    save("last", data_state=data_state)
+    if evaluator is not None:
+        handle_async_eval(evaluator.close())
+    wait_checkpoints()
+    final_eval()
     print(f"✅ Training hoàn tất. Checkpoints lưu tại {output_dir}")
 
 
 def main() -> None:
     args = parse_args()
-    run_training(
-        config_path=args.config,
-        train_bin_override=args.train_bin,
-        val_bin_override=args.val_bin,
-        output_dir_override=args.output_dir,
-        resume=args.resume,
-        seed=args.seed,
-        device_str=args.device,
-    )
+    try:
+        run_training(
+            config_path=args.config,
+            train_bin_override=args.train_bin,
+            val_bin_override=args.val_bin,
+            output_dir_override=args.output_dir,
+            resume=args.resume,
+            seed=args.seed,
+            device_str=args.device,
+        )
+    finally:
+        cleanup_distributed()
 
 
 if __name__ == "__main__":
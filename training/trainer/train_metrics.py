@@ -0,0 +1,356 @@
+"""
+Đo throughput training: tokens/s, phân rã thời gian step, MFU, peak memory.
+
+`TrainMetrics` gom số liệu theo từng khoảng log (`log_every` step) và ghi mỗi
+khoảng thành một dòng JSON vào `<output_dir>/metrics.jsonl` để vẽ dashboard
+hoặc so sánh regression giữa các run.
+
+Phân rã thời gian:
+- `data_wait`  : loop bị chặn chờ batch (lấy từ `DataWaitTimer`)
+- `forward` / `backward` / `optimizer` : đo bằng CUDA event trên stream hiện
+  tại (không synchronize giữa step; chỉ đọc event khi log, lúc `loss.item()`
+  đã sync), trên CPU đo bằng `perf_counter`
+- `checkpoint` : thời gian host bị chặn khi lưu checkpoint
+- `other`      : phần còn lại của khoảng (launch overhead, logging, ...)
+
+MFU = FLOPs model thực hiện / (thời gian × peak FLOPs của GPU). FLOPs mỗi token
+tính từ GPT2Config: 6·N (N = tham số không tính position embedding, LM head
+tied tính một lần) + 12·n_layer·n_embd·seq_len cho attention (fwd + bwd).
+
+DDP: chỉ rank 0 ghi file (`path=None` ở rank khác); tokens/s và FLOPs tính cho
+cả `world_size` rank (mỗi rank train batch cùng shape), MFU so với tổng peak.
+
+Time-to-target: mỗi dòng train có `train_s` (tổng thời gian train, không tính
+eval), `elapsed_s` (wall-clock từ lúc bắt đầu) và `total_tokens` cộng dồn; khi
+val_loss đầu tiên ≤ `training.target_loss` ghi thêm dòng `event: target`. So
+sánh nhiều run (ví dụ seq-len warmup với baseline seq_len cố định):
+
+    python -m training.trainer.train_metrics \
+        training/model/baseline/metrics.jsonl training/model/seq_warmup/metrics.jsonl \
+        --target-loss 4.0
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import torch
+from transformers import GPT2Config
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+DEVICE_PHASES = ("forward", "backward", "optimizer")
+HOST_PHASES = ("checkpoint",)
+
+# Peak dense TFLOPS (fp32, fp16/bf16 tensor core) theo tên GPU; khớp theo thứ tự.
+PEAK_TFLOPS: List[Tuple[str, float, float]] = [
+    ("H100", 67.0, 989.0),
+    ("A100", 19.5, 312.0),
+    ("L40S", 91.6, 362.0),
+    ("L4", 30.3, 121.0),
+    ("A10", 31.2, 125.0),
+    ("V100", 15.7, 125.0),
+    ("T4", 8.1, 65.0),
+    ("P100", 9.3, 18.7),
+]
+
+
+def gpt2_flops_per_token(config: GPT2Config, seq_len: int) -> float:
+    """FLOPs train (fwd + bwd) cho mỗi token của GPT-2 với context `seq_len`."""
+    d = config.n_embd
+    inner = config.n_inner or 4 * d
+    params = config.n_layer * (4 * d * d + 2 * d * inner) + config.vocab_size * d
+    return 6.0 * params + 12.0 * config.n_layer * d * seq_len
+
+
+def peak_flops(device: torch.device, half_precision: bool, override_tflops: Optional[float] = None) -> Optional[float]:
+    """Peak FLOPs/s của device; None nếu không biết (CPU hoặc GPU ngoài bảng)."""
+    if override_tflops:
+        return float(override_tflops) * 1e12
+    if device.type != "cuda":
+        return None
+    name = torch.cuda.get_device_name(device)
+    for key, fp32, half in PEAK_TFLOPS:
+        if key in name:
+            return (half if half_precision else fp32) * 1e12
+    return None
+
+
+def host_peak_rss_gb() -> Optional[float]:
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2  # Linux: KB
+
+
+class PhaseTimer:
+    """Cộng dồn thời gian theo phase; phase device dùng CUDA event, đọc lười khi `pop()`."""
+
+    def __init__(self, device: torch.device):
+        self.use_events = device.type == "cuda"
+        self.device = device
+        self.seconds: Dict[str, float] = {}
+        self._events: List[Tuple[str, Any, Any]] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        if self.use_events and name in DEVICE_PHASES:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            try:
+                yield
+            finally:
+                end.record()
+                self._events.append((name, start, end))
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - started
+
+    def pop(self) -> Dict[str, float]:
+        if self._events:
+            self._events[-1][2].synchronize()
+            for name, start, end in self._events:
+                self.seconds[name] = self.seconds.get(name, 0.0) + start.elapsed_time(end) / 1000.0
+        result = self.seconds
+        self.seconds = {}
+        self._events = []
+        return result
+
+
+class TrainMetrics:
+    """Số liệu throughput theo khoảng log + ghi `metrics.jsonl`."""
+
+    def __init__(
+        self,
+        model_config: GPT2Config,
+        device: torch.device,
+        path: Optional[Path],
+        half_precision: bool = False,
+        peak_tflops: Optional[float] = None,
+        world_size: int = 1,
+        target_loss: Optional[float] = None,
+    ):
+        self.model_config = model_config
+        self.device = device
+        self.path = path
+        self.world_size = world_size
+        peak = peak_flops(device, half_precision, peak_tflops)
+        self.peak = peak * world_size if peak else None
+        self.target_loss = target_loss
+        self.timer = PhaseTimer(device)
+        self._dense_flops = gpt2_flops_per_token(model_config, 0)
+        self._attn_flops = 12.0 * model_config.n_layer * model_config.n_embd
+        self.run_started = time.perf_counter()
+        self.train_seconds = 0.0
+        self.total_tokens = 0
+        self.progress: List[Tuple[int, float, float, int]] = []  # (step, train_s, elapsed_s, total_tokens)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.tokens = 0
+        self.sequences = 0
+        self.flops = 0.0
+        self.started = time.perf_counter()
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def phase(self, name: str):
+        return self.timer.phase(name)
+
+    def add_batch(self, input_ids: torch.Tensor) -> None:
+        batch_size, seq_len = input_ids.shape
+        batch_size *= self.world_size
+        tokens = batch_size * seq_len
+        self.tokens += tokens
+        self.sequences += batch_size
+        self.flops += tokens * (self._dense_flops + self._attn_flops * seq_len)
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """Không tính đoạn này (eval) vào khoảng đo throughput."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.started += time.perf_counter() - started
+
+    def write(self, record: Dict[str, Any]) -> None:
+        if self.path is None:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"time": time.time(), **record}, ensure_ascii=False) + "\n")
+
+    def log_start(self, **fields: Any) -> None:
+        self.write(
+            {
+                "event": "start",
+                "device": torch.cuda.get_device_name(self.device) if self.device.type == "cuda" else self.device.type,
+                "peak_tflops": self.peak / self.world_size / 1e12 if self.peak else None,
+                "n_layer": self.model_config.n_layer,
+                "n_embd": self.model_config.n_embd,
+                **fields,
+            }
+        )
+        self.run_started = time.perf_counter()
+        self._reset()
+
+    def log_step(self, step: int, data_wait: float, **fields: Any) -> Dict[str, Any]:
+        """Chốt khoảng log hiện tại (gọi sau `loss.item()`), ghi JSONL và trả về record."""
+        phases = self.timer.pop()
+        interval = max(time.perf_counter() - self.started, 1e-9)
+        breakdown = {"data_wait": data_wait}
+        for name in DEVICE_PHASES + HOST_PHASES:
+            breakdown[name] = phases.get(name, 0.0)
+        breakdown["other"] = max(interval - sum(breakdown.values()), 0.0)
+        achieved = self.flops / interval
+        self.train_seconds += interval
+        self.total_tokens += self.tokens
+        elapsed = time.perf_counter() - self.run_started
+        self.progress.append((step, self.train_seconds, elapsed, self.total_tokens))
+        record: Dict[str, Any] = {
+            "event": "train",
+            "step": step,
+            **fields,
+            "interval_s": interval,
+            "tokens": self.tokens,
+            "tokens_per_s": self.tokens / interval,
+            "sequences_per_s": self.sequences / interval,
+            "model_tflops": achieved / 1e12,
+            "mfu": achieved / self.peak if self.peak else None,
+            "time_s": breakdown,
+            "train_s": self.train_seconds,
+            "elapsed_s": elapsed,
+            "total_tokens": self.total_tokens,
+        }
+        if self.device.type == "cuda":
+            record["peak_mem_gb"] = torch.cuda.max_memory_allocated(self.device) / 1024 ** 3
+            record["peak_reserved_gb"] = torch.cuda.max_memory_reserved(self.device) / 1024 ** 3
+        record["host_peak_rss_gb"] = host_peak_rss_gb()
+        self.write(record)
+        self._reset()
+        return record
+
+    def log_eval(self, step: int, val_loss: float, seconds: float, **fields: Any) -> None:
+        self.write({"event": "eval", "step": step, "val_loss": val_loss, "eval_s": seconds, **fields})
+        if self.target_loss is not None and val_loss <= self.target_loss:
+            train_s, elapsed, tokens = progress_at(self.progress, step)
+            self.write(
+                {
+                    "event": "target",
+                    "step": step,
+                    "target_loss": self.target_loss,
+                    "val_loss": val_loss,
+                    "train_s": train_s,
+                    "elapsed_s": elapsed,
+                    "total_tokens": tokens,
+                }
+            )
+            print(
+                f"🎯 Đạt target_loss={self.target_loss} tại step {step}: "
+                f"{train_s:.0f}s train ({elapsed:.0f}s wall), {tokens:,} tokens"
+            )
+            self.target_loss = None  # chỉ ghi lần đầu
+
+
+def progress_at(progress: List[Tuple[int, float, float, int]], step: int) -> Tuple[float, float, int]:
+    """(train_s, elapsed_s, total_tokens) tại `step`, nội suy tuyến tính giữa các dòng train đã log."""
+    if not progress:
+        return 0.0, 0.0, 0
+    previous = (0, 0.0, 0.0, 0)
+    for point in progress:
+        if point[0] >= step:
+            span = max(point[0] - previous[0], 1)
+            frac = (step - previous[0]) / span
+            return (
+                previous[1] + frac * (point[1] - previous[1]),
+                previous[2] + frac * (point[2] - previous[2]),
+                int(previous[3] + frac * (point[3] - previous[3])),
+            )
+        previous = point
+    return progress[-1][1], progress[-1][2], progress[-1][3]
+
+
+def load_run(path: Path) -> Tuple[List[Tuple[int, float, float, int]], List[Tuple[int, float]], Dict[str, Any]]:
+    """Đọc `metrics.jsonl` → (progress, [(step, val_loss)], dòng start đầu tiên).
+
+    Run được resume ghi nhiều dòng start và bộ đếm `train_s`/`total_tokens`
+    bắt đầu lại từ 0 → cộng dồn offset qua từng đoạn.
+    """
+    progress: List[Tuple[int, float, float, int]] = []
+    evals: List[Tuple[int, float]] = []
+    start: Dict[str, Any] = {}
+    offset = (0.0, 0.0, 0)
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            event = record.get("event")
+            if event == "start":
+                start = start or record
+                if progress:
+                    offset = progress[-1][1:]
+            elif event == "train" and "train_s" in record:
+                progress.append(
+                    (
+                        record["step"],
+                        offset[0] + record["train_s"],
+                        offset[1] + record["elapsed_s"],
+                        offset[2] + record["total_tokens"],
+                    )
+                )
+            elif event == "eval":
+                evals.append((record["step"], record["val_loss"]))
+    return progress, sorted(evals), start
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="So sánh thời gian/tokens để đạt target val loss giữa các run")
+    parser.add_argument("metrics", nargs="+", type=Path, help="metrics.jsonl của từng run (run đầu là baseline)")
+    parser.add_argument(
+        "--target-loss",
+        type=float,
+        default=None,
+        help="Val loss mục tiêu (mặc định: loss tốt nhất mà mọi run đều đạt)",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    runs = {str(path): load_run(path) for path in args.metrics}
+    target = args.target_loss
+    if target is None:
+        target = max(min((loss for _, loss in evals), default=float("inf")) for _, evals, _ in runs.values())
+    print(f"📊 Thời gian để val_loss ≤ {target:.4f} (run đầu là baseline):")
+    baseline: Optional[float] = None
+    for index, (name, (progress, evals, start)) in enumerate(runs.items()):
+        warmup = start.get("seq_len_warmup")
+        label = f"{name} (seq_len {start.get('seq_len')}" + (f", warmup {warmup}" if warmup else "") + ")"
+        hit = next((step for step, loss in evals if loss <= target), None)
+        if hit is None:
+            best = min((loss for _, loss in evals), default=float("nan"))
+            print(f"  {label}: chưa đạt (best val_loss={best:.4f})")
+            continue
+        train_s, elapsed, tokens = progress_at(progress, hit)
+        if index == 0:
+            baseline = train_s
+        if baseline is None:
+            speedup = "không tính được speedup (baseline chưa đạt target)"
+        else:
+            speedup = f"speedup ×{baseline / train_s if train_s else float('nan'):.2f}"
+        print(f"  {label}: step {hit} | {tokens:,} tokens | train {train_s:.1f}s | wall {elapsed:.1f}s | {speedup}")
+
+
+if __name__ == "__main__":
+    main()
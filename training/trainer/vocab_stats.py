@@ -0,0 +1,190 @@
+"""
+Token frequency histograms and vocabulary utilization report.
+
+`TokenHistogram` is fed paragraph by paragraph while `tokenize_dataset`
+encodes a split. Token IDs are buffered and counted in large chunks with
+`np.bincount`, so the per-paragraph cost is a list append. Bigram counts are
+kept for the top-K tokens only, in a dense K x K matrix; the top-K set is
+chosen from the first flushed chunk (exact when the split fits in one chunk,
+and Zipf heads stabilise quickly otherwise).
+
+`build_vocab_report` turns the per-split histograms into a JSON report:
+dead tokens, per-split coverage, rank/frequency (Zipf) curve and top bigrams.
+"""
+
+from __future__ import annotations
+
+import time
+from itertools import chain
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+DEFAULT_FLUSH_TOKENS = 1 << 20
+DEFAULT_BIGRAM_TOP_K = 256
+
+
+class TokenHistogram:
+    """Unigram counts over the full vocabulary plus top-K bigram counts."""
+
+    def __init__(
+        self,
+        vocab_size: int,
+        bigram_top_k: int = DEFAULT_BIGRAM_TOP_K,
+        flush_tokens: int = DEFAULT_FLUSH_TOKENS,
+    ):
+        self.vocab_size = vocab_size
+        self.bigram_top_k = min(bigram_top_k, vocab_size)
+        self.flush_tokens = flush_tokens
+        self.unigram = np.zeros(vocab_size, dtype=np.int64)
+        self.bigram = np.zeros((self.bigram_top_k, self.bigram_top_k), dtype=np.int64)
+        self.top_ids: Optional[np.ndarray] = None
+        self._rank: Optional[np.ndarray] = None
+        self._pending: List[Sequence[int]] = []
+        self._pending_tokens = 0
+        self.seconds = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return int(self.unigram.sum()) + self._pending_tokens
+
+    def add(self, token_ids: Sequence[int]) -> None:
+        """Queue one paragraph; counting happens in chunks of `flush_tokens`."""
+        self._pending.append(token_ids)
+        self._pending_tokens += len(token_ids)
+        if self._pending_tokens >= self.flush_tokens:
+            self.flush()
+
+    def flush(self) -> None:
+        """Count every queued paragraph."""
+        if not self._pending:
+            return
+        started = time.perf_counter()
+        ids = np.fromiter(
+            chain.from_iterable(self._pending), dtype=np.int64, count=self._pending_tokens
+        )
+        chunk_counts = np.bincount(ids, minlength=self.vocab_size)
+        self.unigram += chunk_counts
+
+        if self.bigram_top_k:
+            if self._rank is None:
+                self.top_ids = np.argsort(-chunk_counts, kind="stable")[: self.bigram_top_k]
+                self._rank = np.full(self.vocab_size, -1, dtype=np.int64)
+                self._rank[self.top_ids] = np.arange(self.bigram_top_k)
+            ranks = self._rank[ids]
+            left, right = ranks[:-1], ranks[1:]
+            valid = (left >= 0) & (right >= 0)
+            # Pairs that straddle two paragraphs are not real bigrams.
+            lengths = np.fromiter(map(len, self._pending), dtype=np.int64, count=len(self._pending))
+            paragraph_ends = np.cumsum(lengths)[:-1] - 1
+            valid[paragraph_ends[(paragraph_ends >= 0) & (paragraph_ends < valid.size)]] = False
+            pair_codes = left[valid] * self.bigram_top_k + right[valid]
+            self.bigram += np.bincount(
+                pair_codes, minlength=self.bigram_top_k * self.bigram_top_k
+            ).reshape(self.bigram_top_k, self.bigram_top_k)
+
+        self._pending = []
+        self._pending_tokens = 0
+        self.seconds += time.perf_counter() - started
+
+
+def zipf_curve(counts: np.ndarray, points: int = 64) -> Dict[str, Any]:
+    """Rank/frequency samples at log-spaced ranks plus a least-squares Zipf exponent."""
+    ranked = np.sort(counts[counts > 0])[::-1]
+    if ranked.size == 0:
+        return {"exponent": None, "r2": None, "curve": []}
+    ranks = np.unique(np.logspace(0, np.log10(ranked.size), points).astype(np.int64))
+    log_rank = np.log(ranks.astype(np.float64))
+    log_count = np.log(ranked[ranks - 1].astype(np.float64))
+    exponent = r2 = None
+    if ranks.size >= 2:
+        slope, intercept = np.polyfit(log_rank, log_count, 1)
+        residual = log_count - (slope * log_rank + intercept)
+        total = np.sum((log_count - log_count.mean()) ** 2)
+        exponent = float(-slope)
+        r2 = float(1.0 - residual @ residual / total) if total > 0 else 1.0
+    return {
+        "exponent": exponent,
+        "r2": r2,
+        "curve": [{"rank": int(r), "count": int(ranked[r - 1])} for r in ranks],
+    }
+
+
+def build_vocab_report(
+    histograms: Dict[str, TokenHistogram],
+    processor,
+    top_n: int = 50,
+    max_listed_dead: int = 1000,
+) -> Dict[str, Any]:
+    """Summarise vocabulary usage across splits (processor: SentencePieceProcessor)."""
+    vocab_size = processor.get_piece_size()
+    special = np.array(
+        [processor.is_control(i) or processor.is_unknown(i) for i in range(vocab_size)], dtype=bool
+    )
+
+    def piece(token_id: int) -> str:
+        return processor.id_to_piece(int(token_id))
+
+    total = np.zeros(vocab_size, dtype=np.int64)
+    for histogram in histograms.values():
+        total += histogram.unigram
+
+    train_seen = histograms["train"].unigram > 0 if "train" in histograms else None
+    splits: Dict[str, Any] = {}
+    for split, histogram in histograms.items():
+        counts = histogram.unigram
+        num_tokens = int(counts.sum())
+        used = counts > 0
+        top = np.argsort(-counts, kind="stable")[:top_n]
+        split_report: Dict[str, Any] = {
+            "total_tokens": num_tokens,
+            "used_tokens": int(used.sum()),
+            "coverage": float(used.sum() / vocab_size),
+            "singleton_tokens": int((counts == 1).sum()),
+            "top_tokens": [
+                {"id": int(i), "piece": piece(i), "count": int(counts[i]), "freq": float(counts[i] / max(num_tokens, 1))}
+                for i in top
+                if counts[i] > 0
+            ],
+        }
+        if train_seen is not None and split != "train":
+            unseen = used & ~train_seen
+            split_report["ids_unseen_in_train"] = int(unseen.sum())
+            split_report["tokens_unseen_in_train"] = int(counts[unseen].sum())
+        if histogram.top_ids is not None:
+            flat = histogram.bigram.ravel()
+            best = np.argsort(-flat, kind="stable")[:top_n]
+            k = histogram.bigram_top_k
+            split_report["top_bigrams"] = [
+                {
+                    "ids": [int(histogram.top_ids[code // k]), int(histogram.top_ids[code % k])],
+                    "pieces": [piece(histogram.top_ids[code // k]), piece(histogram.top_ids[code % k])],
+                    "count": int(flat[code]),
+                }
+                for code in best
+                if flat[code] > 0
+            ]
+        splits[split] = split_report
+
+    dead = np.flatnonzero((total == 0) & ~special)
+    return {
+        "vocab_size": vocab_size,
+        "used_tokens": int((total > 0).sum()),
+        "coverage": float((total > 0).sum() / vocab_size),
+        "special_tokens": [piece(i) for i in np.flatnonzero(special)],
+        "dead_tokens": {
+            "count": int(dead.size),
+            "ratio": float(dead.size / vocab_size),
+            "ids": dead[:max_listed_dead].tolist(),
+            "pieces": [piece(i) for i in dead[:max_listed_dead]],
+        },
+        "zipf": zipf_curve(total),
+        "splits": splits,
+    }
+
+
+def save_histograms(path: Path, histograms: Dict[str, TokenHistogram]) -> None:
+    """Store raw unigram counts (one array per split) for later analysis."""
+    np.savez_compressed(path, **{split: histogram.unigram for split, histogram in histograms.items()})